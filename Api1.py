@@ -1,11 +1,15 @@
 from enum import Enum
+import base64
+import os
 import uvicorn
-from fastapi import FastAPI, HTTPException, Path, Query
+from fastapi import FastAPI, HTTPException, Path, Query, Response
 from pydantic import BaseModel, Field
+from Metrics import Metrics
+from Storage import RedisRepository, create_repository
 
 app = FastAPI(
     title="Api1",
-    description="Test API using dictionary of tools",
+    description="Test API using a dictionary of tools, stored in memory, Redis or SQLite",
     version="0.1"
 )
 
@@ -22,69 +26,141 @@ class Item(BaseModel):
     id: int = Field(description="Unique identifier of the item")
     category: Category = Field(description="Category of the item")
 
-items = {
-    0: Item(name="Hammer", price=9.99, count=20, id=0, category=Category.TOOLS),
-    1: Item(name="APliers", price=3.5, count=5, id=1, category=Category.TOOLS),
-    2: Item(name="Nails", price=5.99, count=4, id=2, category=Category.CONSUMABLES)
-}
+#Backend holding the items: memory, redis or sqlite (see Storage.py)
+STORAGE_BACKEND = os.environ.get("API1_STORAGE", "memory")
+repository = create_repository(Item, "api1_items", STORAGE_BACKEND)
+
+#Request latency per route (and Redis timings with the redis backend), served on /metrics
+metrics = Metrics(app)
+if isinstance(repository, RedisRepository):
+    metrics.instrument_redis(repository.redis)
+
+#Items the store starts with when it is empty
+SEED_ITEMS = [
+    Item(name="Hammer", price=9.99, count=20, id=0, category=Category.TOOLS),
+    Item(name="APliers", price=3.5, count=5, id=1, category=Category.TOOLS),
+    Item(name="Nails", price=5.99, count=4, id=2, category=Category.CONSUMABLES)
+]
 
 Selection = dict[str,str|int|float|Category|None]
 
+#Page size used when a cursor is given without a limit, and the largest limit a client may ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(last_id: int) -> str:
+    """Opaque cursor handed to clients, pointing after the last id of a page"""
+    return base64.urlsafe_b64encode(f"id:{last_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        kind, last_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        if kind == "id":
+            return int(last_id)
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail=f"Invalid cursor.")
+
+async def page(cursor: str | None, limit: int | None, **filters):
+    """The first limit items (in id order) after the cursor that match the filters, and the cursor for the next page"""
+    limit = limit or DEFAULT_PAGE_SIZE
+    after = decode_cursor(cursor) if cursor is not None else None
+    selected = await repository.find(after=after, limit=limit + 1, **filters)
+    if len(selected) > limit:
+        selected = selected[:limit]
+        return selected, encode_cursor(selected[-1].id)
+    return selected, None
+
+def apply_changes(item: Item, name, price, count, category) -> Item:
+    if name is not None:
+        item.name = name
+    if price is not None:
+        item.price = price
+    if count is not None:
+        item.count = count
+    if category is not None:
+        item.category = category
+    return item
+
+@app.on_event("startup")
+async def startup_event():
+    await repository.seed(SEED_ITEMS)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await repository.close()
+
 #GET------------------------------------------------------------------------
 @app.get("/items")
-def index() -> dict[str,dict[int, Item]]:
-    return {"items":items}
+async def index(
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE)) -> dict[str,dict[int, Item]|str|None]:
+    if cursor is not None or limit is not None:
+        selected, next_cursor = await page(cursor, limit)
+        return {"items": {item.id: item for item in selected}, "next_cursor": next_cursor}
+    return {"items": {item.id: item for item in await repository.scan()}}
 
 @app.get("/items/{item_id}")
-def query_item_by_id(item_id: int = Path(ge=0)) -> Item:
-    if item_id not in items:
+async def query_item_by_id(item_id: int = Path(ge=0)) -> Item:
+    item = await repository.get(item_id)
+    if item is None:
         raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
-    return items[item_id]
+    return item
 
 @app.get("/sth")
 def show_test_string() -> str:
     return "something"
 
 @app.get("/testing")
-def query_all_items() -> dict[int, Item]:
-    return items
+async def query_all_items(
+        response: Response,
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE)) -> dict[int, Item]:
+    if cursor is not None or limit is not None:
+        #the body is the bare dict of items, so the next cursor travels in a header
+        selected, next_cursor = await page(cursor, limit)
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return {item.id: item for item in selected}
+    return {item.id: item for item in await repository.scan()}
 
 @app.get("/chooseitem")
-def query_item_by_parameters(
+async def query_item_by_parameters(
         name: str | None = None,
         price: float | None = Query(default=None,ge=0),
         count: int | None = Query(default=None,ge=0),
-        category: Category | None = None) -> dict[str, list | Selection]:
-    def check_item(item: Item) -> bool:
-        return all(
-            (
-                name is None or item.name == name,
-                price is None or item.price == price,
-                count is None or item.count == count,
-                category is None or item.category is category
-            )
-        )
-    selection = [item for item in items.values() if check_item(item)]
+        category: Category | None = None,
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE)) -> dict[str, list | Selection | str | None]:
+    query = {"name": name, "price": price, "count": count, "category": category}
+    if cursor is not None or limit is not None:
+        selection, next_cursor = await page(cursor, limit, **query)
+        return {
+            "query": query,
+            "selection": selection,
+            "next_cursor": next_cursor
+        }
+    selection = await repository.find(**query)
     return {
-        "query": {"name": name, "price": price, "count": count, "category": category},
+        "query": query,
         "selection": selection
     }
 
 
 #POST------------------------------------------------------------------------
 @app.post("/items")
-def add_item(item: Item) -> dict[str, Item]:
+async def add_item(item: Item) -> dict[str, Item]:
 
-    if item.id in items:
+    if await repository.exists(item.id):
         raise HTTPException(status_code=400, detail=f"Item with {item.id=} already exists.")
 
-    items[item.id] = item
+    await repository.put(item)
     return {"added":item}
 
 
 #PUT------------------------------------------------------------------------
 @app.put("/items/{item_id}")
-def updateoradd(
+async def updateoradd(
         item_id: int = Path(ge=0),
         name: str | None = None,
         price: float | None = Query(default=None,ge=0),
@@ -94,20 +170,15 @@ def updateoradd(
     #    raise HTTPException(status_code=400, detail=f"Item with {item_id=} does not exist.")
     if all(info is None for info in (name, price, count, category)):
         raise HTTPException(status_code=400, detail=f"No parameters provided.")
-    if item_id in items:
-        item = items[item_id]
-        if name is not None:
-            item.name = name
-        if price is not None:
-            item.price = price
-        if count is not None:
-            item.name = count
-        if category is not None:
-            item.category = category
+    item = await repository.get(item_id)
+    if item is not None:
+        item = apply_changes(item, name, price, count, category)
+        await repository.put(item)
         return {"updated": item}
     elif all(info is not None for info in (name, price, count, category)):
-        items[item_id] = Item(name=name, price=price, count=count, id=item_id, category=category)
-        return {"added": items[item_id]}
+        item = Item(name=name, price=price, count=count, id=item_id, category=category)
+        await repository.put(item)
+        return {"added": item}
     else:
         raise HTTPException(status_code=400, detail=f"Item with {item_id=} does not exist and not all parameters were added for creating a new Item")
 
@@ -119,38 +190,30 @@ def updateoradd(
                400: {"description": "No arguments specified"},
            }
 )
-def update(
+async def update(
         item_id: int = Path(ge=0),
         name: str | None = None,
         price: float | None = Query(default=None,ge=0),
         count: int | None = Query(default=None,ge=0),
         category: Category | None = None) -> dict[str, Item]:
-    if item_id not in items:
+    item = await repository.get(item_id)
+    if item is None:
         raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
     if all(info is None for info in (name, price, count, category)):
         raise HTTPException(status_code=400, detail=f"No parameters provided for update.")
 
-    item = items[item_id]
-    if name is not None:
-        item.name = name
-    if price is not None:
-        item.price = price
-    if count is not None:
-        item.name = count
-    if category is not None:
-        item.category = category
-
+    item = apply_changes(item, name, price, count, category)
+    await repository.put(item)
     return {"updated": item}
 
 
 #DELETE------------------------------------------------------------------------
 @app.delete("/items/{item_id}")
-def delete_item(item_id: int = Path(ge=0)) -> dict[str, Item]:
+async def delete_item(item_id: int = Path(ge=0)) -> dict[str, Item]:
 
-    if item_id not in items:
+    item = await repository.delete(item_id)
+    if item is None:
         raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
-
-    item = items.pop(item_id)
     return {"deleted": item}
 
 
@@ -159,4 +222,4 @@ print("Working")
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=5050)
\ No newline at end of file
+    uvicorn.run(app, host="127.0.0.1", port=5050)
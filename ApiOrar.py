@@ -1,7 +1,26 @@
 from enum import Enum
+import base64
+import bisect
+import heapq
+import itertools
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import nullcontext
+from email.utils import formatdate
 import uvicorn
-from fastapi import FastAPI, HTTPException, Path, Query
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Path, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from pydantic_core import to_json
+from starlette.concurrency import run_in_threadpool
+from JurnalOrar import Jurnal
+from Metrics import Metrics
+from Profiling import Profiling
+from Planificator import Planificator
 
 app = FastAPI(
     title="Api Parser",
@@ -9,16 +28,70 @@ app = FastAPI(
     version="0.1"
 )
 
+#Durata cererilor pe fiecare ruta si cererile in curs, servite pe /metrics
+metrics = Metrics(app)
+#Profilarea pornita prin /admin/profile si jurnalul cererilor lente (vezi Profiling.py)
+profiling = Profiling(app)
+metrics.gauge("orar_activitati", "Activitatile din orar", collect=lambda: {(): len(activitati)})
+metrics.gauge("orar_versiune_colectie", "Versiunea colectiei de activitati", collect=lambda: {(): versiune_colectie})
+
 def next_id_funct():
-    """Ia lista sortata cu toate id-urile activitatilor
-    si gaseste cel mai mic id nefolosit inca, pentru a putea fi alocat"""
-    prec = -1
-    sortat = sorted(activitati)
-    for x in sortat:
-        if x > prec+1:
-            return prec+1
-        prec = x
-    return x+1
+    """Cel mai mic id nefolosit inca, pentru a putea fi alocat.
+    Doar il citeste din alocator, nu il rezerva"""
+    return alocator_id.urmatorul()
+
+#Cate intrari invechite poate tine heap-ul alocatorului peste dublul id-urilor libere inainte de compactare
+MARJA_COMPACTARE_ID = 64
+
+class AlocatorId:
+    """Aloca cel mai mic id nefolosit fara a sorta toate id-urile la fiecare inserare.
+    Tine un min-heap cu inceputurile intervalelor libere aflate sub `urmatorul_nou`
+    (primul id mai mare decat toate cele folosite). Intrarile din heap care intre timp
+    au fost ocupate sunt aruncate cand ajung in varf, iar cand heap-ul ajunge la peste dublul
+    id-urilor libere (un update elibereaza si ocupa acelasi id) este compactat"""
+
+    def __init__(self, folosite):
+        self.folosite = folosite
+        self.libere: list[int] = []
+        self.urmatorul_nou = 0
+        self.lacat = threading.Lock()
+        prec = -1
+        for x in sorted(folosite):
+            if x > prec+1:
+                self.libere.append(prec+1)
+            prec = x
+        self.urmatorul_nou = prec+1
+
+    def _curata(self):
+        while self.libere and self.libere[0] in self.folosite:
+            heapq.heappop(self.libere)
+
+    def _adauga_liber(self, id: int):
+        heapq.heappush(self.libere, id)
+        if len(self.libere) > 2 * (self.urmatorul_nou - len(self.folosite)) + MARJA_COMPACTARE_ID:
+            #o lista sortata este deja un min-heap
+            self.libere = sorted({x for x in self.libere if x not in self.folosite})
+
+    def urmatorul(self) -> int:
+        with self.lacat:
+            self._curata()
+            return self.libere[0] if self.libere else self.urmatorul_nou
+
+    def ocupat(self, id: int):
+        """Apelat dupa ce id-ul a fost adaugat in activitati"""
+        with self.lacat:
+            if id >= self.urmatorul_nou:
+                if id > self.urmatorul_nou:
+                    self._adauga_liber(self.urmatorul_nou)
+                self.urmatorul_nou = id+1
+            elif id+1 < self.urmatorul_nou and id+1 not in self.folosite:
+                #intervalul liber in care era id-ul continua de la id+1
+                self._adauga_liber(id+1)
+
+    def eliberat(self, id: int):
+        """Apelat dupa ce id-ul a fost scos din activitati"""
+        with self.lacat:
+            self._adauga_liber(id)
 
 class Zile(Enum):
     """Zilele saptamanii"""
@@ -47,6 +120,265 @@ class Activitate(BaseModel):
     ora: int = Field(description="Ora la care incepe activitatea", ge=1, le=24)
     categorie: Categorie = Field(description="Categoria activitatii (curs,seminar sau laborator)")
 
+CAMPURI_INDEXATE = ("profesor", "sala", "zi", "ora", "categorie")
+
+#Pentru fiecare camp indexat: valoare -> id-urile activitatilor cu acea valoare
+index_campuri: dict[str, dict[str | int | Zile | Categorie, set[int]]] = {camp: {} for camp in CAMPURI_INDEXATE}
+#Toti parametrii unei activitati (fara id) -> id-ul activitatii
+index_unicitate: dict[tuple, int] = {}
+#Id-urile tuturor activitatilor, sortate, pentru ca paginarea sa gaseasca inceputul paginii cu bisect
+ids_sortate: list[int] = []
+
+#Orele unei zile in care poate avea loc o activitate (ora 24 tine pana la 25)
+PRIMA_ORA = 1
+ULTIMA_ORA = 25
+
+def masca_ore(inceput: int, sfarsit: int) -> int:
+    """Masca de biti cu orele inceput..sfarsit-1"""
+    return (1 << sfarsit) - (1 << inceput)
+
+def intervale_libere(masca: int, inceput: int = PRIMA_ORA, sfarsit: int = ULTIMA_ORA) -> list[dict[str, int]]:
+    """Intervalele maximale de ore libere (biti nesetati) din inceput..sfarsit-1"""
+    intervale = []
+    h = inceput
+    while h < sfarsit:
+        if masca >> h & 1:
+            h += 1
+            continue
+        start = h
+        while h < sfarsit and not masca >> h & 1:
+            h += 1
+        intervale.append({"de_la": start, "pana_la": h})
+    return intervale
+
+class GrilaOcupare:
+    """Pentru fiecare cheie (o sala sau un profesor, impreuna cu ziua): ora -> id-urile activitatilor care o ocupa.
+    O activitate ocupa orele ora..ora+durata-1, asa ca verificarea unei activitati costa O(durata),
+    indiferent cate activitati sunt in orar. Pe langa asta tine pentru fiecare cheie o masca de biti
+    (bitul h setat daca ora h este ocupata), din care interogarile de disponibilitate se fac cu o singura operatie"""
+
+    def __init__(self):
+        self.ore: dict[tuple, dict[int, set[int]]] = {}
+        self.masti: dict[tuple, int] = {}
+
+    def ocupa(self, cheie: tuple, ora: int, durata: int, id: int):
+        ore = self.ore.setdefault(cheie, {})
+        for h in range(ora, ora + durata):
+            ore.setdefault(h, set()).add(id)
+        self.masti[cheie] = self.masti.get(cheie, 0) | masca_ore(ora, ora + durata)
+
+    def elibereaza(self, cheie: tuple, ora: int, durata: int, id: int):
+        ore = self.ore.get(cheie)
+        if ore is None:
+            return
+        for h in range(ora, ora + durata):
+            ids = ore.get(h)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del ore[h]
+                    self.masti[cheie] &= ~(1 << h)
+        if not ore:
+            del self.ore[cheie]
+            del self.masti[cheie]
+
+    def masca(self, cheie: tuple) -> int:
+        return self.masti.get(cheie, 0)
+
+    def ocupate(self, cheie: tuple, ora: int, durata: int, ignora: int | None = None) -> set[int]:
+        """Id-urile activitatilor care ocupa macar o ora din ora..ora+durata-1 (fara `ignora`)"""
+        ore = self.ore.get(cheie)
+        if not ore:
+            return set()
+        ids = set()
+        for h in range(ora, ora + durata):
+            ids |= ore.get(h, set())
+        ids.discard(ignora)
+        return ids
+
+    def suprapuneri(self):
+        """Intr-o singura trecere prin grila: (cheie, pereche de id-uri, orele comune) pentru fiecare suprapunere"""
+        for cheie, ore in self.ore.items():
+            perechi: dict[tuple[int, int], list[int]] = {}
+            for h, ids in sorted(ore.items()):
+                if len(ids) > 1:
+                    ids = sorted(ids)
+                    for i, a in enumerate(ids):
+                        for b in ids[i + 1:]:
+                            perechi.setdefault((a, b), []).append(h)
+            for pereche, ore_comune in perechi.items():
+                yield cheie, pereche, ore_comune
+
+#Ocuparea orelor pentru fiecare (sala, zi) si (profesor, zi)
+grila_sali = GrilaOcupare()
+grila_profesori = GrilaOcupare()
+
+#Pozitia fiecarei zile in saptamana, pentru sortarea activitatilor
+ORDINE_ZILE = {zi: i for i, zi in enumerate(Zile)}
+
+class VedereOrar:
+    """Activitatile grupate dupa un camp (profesor sau sala), fiecare grup tinut sortat dupa (zi, ora, id)
+    cu bisect la fiecare adaugare sau stergere. Pentru fiecare grup citit este pastrat si JSON-ul lui gata serializat,
+    aruncat cand grupul se schimba si refacut la prima citire de dupa, asa ca o citire costa de obicei o cautare in dict"""
+
+    def __init__(self, camp: str):
+        self.camp = camp
+        self.grupuri: dict[str, list[tuple[int, int, int]]] = {}
+        self.serializate: dict[str, bytes] = {}
+
+    @staticmethod
+    def cheie_sortare(activitate: Activitate) -> tuple[int, int, int]:
+        return ORDINE_ZILE[activitate.zi], activitate.ora, activitate.id
+
+    def adauga(self, activitate: Activitate):
+        valoare = getattr(activitate, self.camp)
+        bisect.insort(self.grupuri.setdefault(valoare, []), self.cheie_sortare(activitate))
+        self.serializate.pop(valoare, None)
+
+    def scoate(self, activitate: Activitate):
+        valoare = getattr(activitate, self.camp)
+        grup = self.grupuri.get(valoare)
+        if grup is None:
+            return
+        cheie = self.cheie_sortare(activitate)
+        i = bisect.bisect_left(grup, cheie)
+        if i < len(grup) and grup[i] == cheie:
+            del grup[i]
+        if not grup:
+            del self.grupuri[valoare]
+        self.serializate.pop(valoare, None)
+
+    def serializat(self, valoare: str) -> bytes:
+        """Vectorul JSON cu activitatile grupului, in ordine. Apelata sub lacat_activitati"""
+        corp = self.serializate.get(valoare)
+        if corp is None:
+            corp = ADAPTOR_LISTA_ACTIVITATI.dump_json([activitati[id] for _, _, id in self.grupuri.get(valoare, ())])
+            if valoare in self.grupuri:
+                self.serializate[valoare] = corp
+        return corp
+
+#Orarul saptamanal al fiecarui profesor si al fiecarei sali
+vedere_profesori = VedereOrar("profesor")
+vedere_sali = VedereOrar("sala")
+
+def cheie_unicitate(nume, durata, profesor, sala, zi, ora, categorie) -> tuple:
+    """Cheia dupa care doua activitati sunt considerate identice"""
+    return (nume, durata, profesor, sala, zi, ora, categorie)
+
+def cheie_activitate(activitate: Activitate) -> tuple:
+    return cheie_unicitate(activitate.nume, activitate.durata, activitate.profesor, activitate.sala, activitate.zi, activitate.ora, activitate.categorie)
+
+def indexeaza(activitate: Activitate):
+    """Adauga activitatea in toti indecsii"""
+    for camp in CAMPURI_INDEXATE:
+        index_campuri[camp].setdefault(getattr(activitate, camp), set()).add(activitate.id)
+    index_unicitate[cheie_activitate(activitate)] = activitate.id
+    i = bisect.bisect_left(ids_sortate, activitate.id)
+    if i == len(ids_sortate) or ids_sortate[i] != activitate.id:
+        ids_sortate.insert(i, activitate.id)
+    grila_sali.ocupa((activitate.sala, activitate.zi), activitate.ora, activitate.durata, activitate.id)
+    grila_profesori.ocupa((activitate.profesor, activitate.zi), activitate.ora, activitate.durata, activitate.id)
+    vedere_profesori.adauga(activitate)
+    vedere_sali.adauga(activitate)
+
+def deindexeaza(activitate: Activitate):
+    """Scoate activitatea din toti indecsii"""
+    for camp in CAMPURI_INDEXATE:
+        valoare = getattr(activitate, camp)
+        ids = index_campuri[camp].get(valoare)
+        if ids is not None:
+            ids.discard(activitate.id)
+            if not ids:
+                del index_campuri[camp][valoare]
+    cheie = cheie_activitate(activitate)
+    if index_unicitate.get(cheie) == activitate.id:
+        del index_unicitate[cheie]
+    i = bisect.bisect_left(ids_sortate, activitate.id)
+    if i < len(ids_sortate) and ids_sortate[i] == activitate.id:
+        del ids_sortate[i]
+    grila_sali.elibereaza((activitate.sala, activitate.zi), activitate.ora, activitate.durata, activitate.id)
+    grila_profesori.elibereaza((activitate.profesor, activitate.zi), activitate.ora, activitate.durata, activitate.id)
+    vedere_profesori.scoate(activitate)
+    vedere_sali.scoate(activitate)
+
+#Toate modificarile lui activitati (impreuna cu verificarile dinaintea lor) se fac sub acest lacat
+lacat_activitati = threading.RLock()
+
+#Jurnalul in care sunt salvate modificarile, daca persistenta este pornita (vezi ORAR_DATE mai jos)
+jurnal: Jurnal | None = None
+
+def activitate_ca_tupla(activitate: Activitate) -> tuple:
+    """Forma compacta in care activitatile sunt salvate in jurnal si in snapshot"""
+    return (activitate.id, activitate.nume, activitate.durata, activitate.profesor, activitate.sala, activitate.zi.value, activitate.ora, activitate.categorie.value)
+
+def tupla_ca_activitate(tupla) -> Activitate:
+    """Inversul lui activitate_ca_tupla. Datele au fost validate cand au fost scrise, asa ca nu mai sunt validate din nou"""
+    id, nume, durata, profesor, sala, zi, ora, categorie = tupla
+    return Activitate.model_construct(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=Zile(zi), ora=ora, categorie=Categorie(categorie))
+
+#Versiunea colectiei, marita la fiecare modificare. Porneste de la momentul pornirii (in microsecunde),
+#asa ca ramane mai mare decat orice versiune data clientilor de o rulare anterioara
+VERSIUNE_PORNIRE = time.time_ns() // 1000
+versiune_colectie = VERSIUNE_PORNIRE
+modificat_la = time.time()
+#id -> versiunea ultimei modificari, in ordinea versiunilor (un id modificat din nou este mutat la sfarsit)
+istoric_modificari: dict[int, int] = {}
+
+def marcheaza_modificare(id: int):
+    """Apelata sub lacat de fiecare adaugare sau stergere din activitati"""
+    global versiune_colectie, modificat_la
+    versiune_colectie += 1
+    modificat_la = time.time()
+    istoric_modificari.pop(id, None)
+    istoric_modificari[id] = versiune_colectie
+
+def grup_jurnal():
+    """Modificarile facute in interior sunt salvate impreuna, ca o singura intrare in jurnal"""
+    return jurnal.in_grup() if jurnal is not None else nullcontext()
+
+def inregistreaza_activitate(activitate: Activitate):
+    """Singurul loc prin care o activitate este adaugata in activitati, pentru ca indecsii sa ramana la zi"""
+    with lacat_activitati:
+        activitati[activitate.id] = activitate
+        indexeaza(activitate)
+        alocator_id.ocupat(activitate.id)
+        marcheaza_modificare(activitate.id)
+        if jurnal is not None:
+            jurnal.scrie("p", activitate_ca_tupla(activitate))
+
+def elimina_activitate(id: int) -> Activitate:
+    """Singurul loc prin care o activitate este scoasa din activitati"""
+    with lacat_activitati:
+        activitate = activitati.pop(id)
+        deindexeaza(activitate)
+        alocator_id.eliberat(id)
+        marcheaza_modificare(id)
+        if jurnal is not None:
+            jurnal.scrie("d", id)
+        return activitate
+
+def cauta_in_index(**valori) -> set[int] | None:
+    """Intersectia indecsilor pentru campurile date (cele None sunt ignorate).
+    Intoarce None daca niciun camp indexat nu a fost dat"""
+    seturi = [index_campuri[camp].get(valoare, set()) for camp, valoare in valori.items() if valoare is not None]
+    if not seturi:
+        return None
+    seturi.sort(key=len)
+    rezultat = set(seturi[0])
+    for ids in seturi[1:]:
+        if not rezultat:
+            break
+        rezultat &= ids
+    return rezultat
+
+def conflicte_activitate(sala: str, profesor: str, zi: Zile, ora: int, durata: int, ignora: int | None = None) -> dict[str, list[int]]:
+    """Activitatile care s-ar suprapune cu una tinuta in sala data sau de profesorul dat, in ziua si orele date"""
+    conflicte = {
+        "sala": sorted(grila_sali.ocupate((sala, zi), ora, durata, ignora)),
+        "profesor": sorted(grila_profesori.ocupate((profesor, zi), ora, durata, ignora)),
+    }
+    return {tip: ids for tip, ids in conflicte.items() if ids}
+
 def verifica_exista(
     id: int | None = Query(default=None, ge=0),
     nume: str | None = None,
@@ -58,23 +390,11 @@ def verifica_exista(
     categorie: Categorie | None = None,
 ):
     """Daca este oferit un ID, cauta activitatea dupa ID.
-    Daca nu, o cauta dupa parametri"""
+    Daca nu, o cauta dupa parametri in indexul de unicitate"""
     if id is not None and id in activitati:
         return id
     else:
-        exista = -1
-        for id_curent, existing in activitati.items():
-            if (
-                    existing.nume == nume and
-                    existing.durata == durata and
-                    existing.profesor == profesor and
-                    existing.sala == sala and
-                    existing.zi == zi and
-                    existing.ora == ora and
-                    existing.categorie == categorie
-            ):
-                exista = id_curent
-        return exista
+        return index_unicitate.get(cheie_unicitate(nume, durata, profesor, sala, zi, ora, categorie), -1)
 
 def adauga_activitate(
     id: int | None = Query(default=None, ge=0),
@@ -86,18 +406,21 @@ def adauga_activitate(
     ora: int | None = Query(default=None, ge=1, le=24),
     categorie: Categorie | None = None,
 ):
-    """Verifica daca deja exista o activitate cu aceeasi parametri,
+    """Verifica daca deja exista o activitate cu aceeasi parametri sau una care s-ar suprapune cu ea (-3),
      daca nu exista o creeaza ori cu id-ul dat, ori cu urmatorul id care nu a fost folosit"""
-    exista = verifica_exista(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
-    if exista != -1:
-        return -1
-    if any(info is None for info in (nume, durata, profesor, sala, zi, ora, categorie)):
-        return -2
-    if id is None:
-        id = next_id_funct()
+    with lacat_activitati:
+        exista = verifica_exista(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
+        if exista != -1:
+            return -1
+        if any(info is None for info in (nume, durata, profesor, sala, zi, ora, categorie)):
+            return -2
+        if conflicte_activitate(sala, profesor, zi, ora, durata):
+            return -3
+        if id is None:
+            id = alocator_id.urmatorul()
 
-    activitati[id] = Activitate(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
-    return id
+        inregistreaza_activitate(Activitate(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie))
+        return id
 
 def update_activitate(
     id_vechi: int = Field(ge=0),
@@ -111,37 +434,54 @@ def update_activitate(
     categorie: Categorie | None = None,
 ):
     """Update activitate dupa ID"""
-    #Verificare mai intai daca id-ul nou nu exista deja
-    if id is not None and id in activitati:
-        return -1
-
-    #Verificare daca exista o activitate cu restul din noii parametrii
-    exista = verifica_exista(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
-    if exista != -1:
-        return -2
-
-    activitate = activitati[id_vechi]
-    if id is not None:
-        #daca este oferit un update pentru vechiul id, vechia intrare este stearsa si mutata pe noul id
-        activitate = activitati.pop(id_vechi)
-        activitati[id] = activitate
-        activitate.id = id
-    if nume is not None:
-        activitate.nume = nume
-    if durata is not None:
-        activitate.durata = durata
-    if profesor is not None:
-        activitate.profesor = profesor
-    if sala is not None:
-        activitate.sala = sala
-    if zi is not None:
-        activitate.zi = zi
-    if ora is not None:
-        activitate.ora = ora
-    if categorie is not None:
-        activitate.categorie = categorie
-
-    return id
+    with lacat_activitati:
+        #Verificare mai intai daca id-ul nou nu exista deja
+        if id is not None and id in activitati:
+            return -1
+
+        #Verificare daca activitatea rezultata ar fi identica cu alta activitate deja existenta
+        activitate = activitati[id_vechi]
+        noua = dict(
+            nume=nume if nume is not None else activitate.nume,
+            durata=durata if durata is not None else activitate.durata,
+            profesor=profesor if profesor is not None else activitate.profesor,
+            sala=sala if sala is not None else activitate.sala,
+            zi=zi if zi is not None else activitate.zi,
+            ora=ora if ora is not None else activitate.ora,
+            categorie=categorie if categorie is not None else activitate.categorie,
+        )
+        exista = index_unicitate.get(cheie_unicitate(**noua), -1)
+        if exista not in (-1, id_vechi):
+            return -2
+
+        #Verificare daca activitatea rezultata s-ar suprapune cu alta in aceeasi sala sau cu acelasi profesor
+        if conflicte_activitate(noua["sala"], noua["profesor"], noua["zi"], noua["ora"], noua["durata"], ignora=id_vechi):
+            return -3
+
+        #activitatea este scoasa din indecsi inainte de modificare si readaugata dupa,
+        #iar in jurnal cele doua operatii sunt salvate impreuna
+        with grup_jurnal():
+            activitate = elimina_activitate(id_vechi)
+            if id is not None:
+                #daca este oferit un update pentru vechiul id, vechia intrare este mutata pe noul id
+                activitate.id = id
+            if nume is not None:
+                activitate.nume = nume
+            if durata is not None:
+                activitate.durata = durata
+            if profesor is not None:
+                activitate.profesor = profesor
+            if sala is not None:
+                activitate.sala = sala
+            if zi is not None:
+                activitate.zi = zi
+            if ora is not None:
+                activitate.ora = ora
+            if categorie is not None:
+                activitate.categorie = categorie
+            inregistreaza_activitate(activitate)
+
+        return activitate.id
 
 
 activitati = {
@@ -151,14 +491,202 @@ activitati = {
     3: Activitate(id=3, nume="Sport", durata=2, profesor="Catalin", sala="B003", zi=Zile.JOI, ora=10, categorie=Categorie.LABORATOR),
 }
 
+#Persistenta optionala: cu ORAR_DATE=<director> (de exemplu date_orar, ignorat de git) activitatile de mai sus sunt doar starea initiala,
+#iar la urmatoarele porniri sunt incarcate din snapshot-ul si jurnalul din acel director.
+#ORAR_FSYNC: secunde intre doua fsync-uri ale jurnalului (0 = la fiecare scriere, "never" = niciodata)
+#ORAR_COMPACTARE: dupa cate intrari in jurnal este scris un snapshot nou
+DIRECTOR_DATE = os.environ.get("ORAR_DATE")
+if DIRECTOR_DATE:
+    _fsync = os.environ.get("ORAR_FSYNC", "0.05")
+    jurnal = Jurnal(
+        DIRECTOR_DATE,
+        stare=lambda: map(activitate_ca_tupla, activitati.values()),
+        interval_fsync=None if _fsync == "never" else float(_fsync),
+        prag_compactare=int(os.environ.get("ORAR_COMPACTARE", "10000")),
+    )
+    _salvate = jurnal.incarca()
+    if _salvate is None:
+        jurnal.compacteaza()
+    else:
+        activitati = {id: tupla_ca_activitate(tupla) for id, tupla in _salvate.items()}
+
+for _activitate in activitati.values():
+    indexeaza(_activitate)
+    istoric_modificari[_activitate.id] = VERSIUNE_PORNIRE
+alocator_id = AlocatorId(activitati)
+
 Selectie = dict[str,str|int|Categorie|Zile|None]
 
+#Marimea paginii cand este dat doar cursorul, si cea mai mare limita pe care o poate cere un client
+MARIME_IMPLICITA_PAGINA = 100
+MARIME_MAXIMA_PAGINA = 1000
+
+def codifica_cursor(ultimul_id: int) -> str:
+    """Cursor opac dat clientilor, care indica dupa ultimul id al unei pagini"""
+    return base64.urlsafe_b64encode(f"id:{ultimul_id}".encode()).decode()
+
+def decodifica_cursor(cursor: str) -> int:
+    try:
+        tip, ultimul_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        if tip == "id":
+            return int(ultimul_id)
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail=f"Cursor invalid.")
+
+def pagina(ids: list[int], dupa: int | None, limit: int | None, potrivit=None):
+    """Primele `limit` id-uri de dupa id-ul `dupa` (cel decodificat din cursor) dintr-o lista sortata de id-uri
+    (doar cele pentru care potrivit(id) este adevarat, daca este dat), si cursorul paginii urmatoare. Inceputul paginii este gasit cu bisect,
+    asa ca o pagina costa cat id-urile parcurse pana se umple, oricat de departe ar fi in colectie"""
+    limit = limit or MARIME_IMPLICITA_PAGINA
+    inceput = bisect.bisect_right(ids, dupa) if dupa is not None else 0
+    if potrivit is None:
+        selectate = ids[inceput:inceput + limit]
+        mai_multe = inceput + limit < len(ids)
+    else:
+        selectate = list(itertools.islice((id for id in itertools.islice(ids, inceput, None) if potrivit(id)), limit + 1))
+        mai_multe = len(selectate) > limit
+        selectate = selectate[:limit]
+    return selectate, codifica_cursor(selectate[-1]) if mai_multe else None
+
+CAMPURI_ACTIVITATE = tuple(Activitate.model_fields)
+
+def citeste_campuri(fields: str | None) -> set[str] | None:
+    """Proiectia ceruta prin `fields=` (campuri separate prin virgula), sau None pentru activitatile intregi"""
+    if fields is None:
+        return None
+    campuri = {camp.strip() for camp in fields.split(",") if camp.strip()}
+    if not campuri or not campuri <= set(CAMPURI_ACTIVITATE):
+        raise HTTPException(status_code=400, detail=f"Campuri invalide {fields!r}, se pot cere doar dintre: {', '.join(CAMPURI_ACTIVITATE)}.")
+    return campuri
+
+def proiecteaza(activitate: Activitate, campuri: set[str] | None) -> dict:
+    """Doar campurile cerute ale activitatii, deja ca valori JSON"""
+    return activitate.model_dump(mode="json", include=campuri)
+
+#Serializatoarele folosite de calea rapida (fast=true): colectia este scrisa direct in JSON de pydantic,
+#fara validarea modelului de raspuns si fara jsonable_encoder
+ADAPTOR_DICT_ACTIVITATI = TypeAdapter(dict[int, Activitate])
+ADAPTOR_LISTA_ACTIVITATI = TypeAdapter(list[Activitate])
+
+def raspuns_json(**parti) -> Response:
+    """Raspuns JSON construit din parti deja serializate (bytes) sau valori simple"""
+    corp = b",".join(b'"' + nume.encode() + b'":' + (valoare if isinstance(valoare, bytes) else to_json(valoare)) for nume, valoare in parti.items())
+    return Response(b"{" + corp + b"}", media_type="application/json")
+
+def include_campuri(campuri: set[str] | None) -> dict | None:
+    """Argumentul include al serializatoarelor de colectii pentru proiectia data"""
+    return None if campuri is None else {"__all__": campuri}
+
+#Cate activitati sunt trimise intr-o singura bucata a raspunsului in flux
+MARIME_BUCATA_FLUX = 500
+
+def flux_activitati(campuri: set[str] | None = None):
+    """Genereaza activitatile ca NDJSON (cate una pe linie), in ordinea id-urilor, in bucati de MARIME_BUCATA_FLUX.
+    Fiecare bucata este citita sub lacat de dupa ultimul id trimis (cu bisect in ids_sortate), asa ca memoria
+    folosita nu creste cu numarul activitatilor. Activitatile sterse intre timp sunt sarite"""
+    ultimul = -1
+    while True:
+        with lacat_activitati:
+            inceput = bisect.bisect_right(ids_sortate, ultimul)
+            bucata = [activitati[id] for id in ids_sortate[inceput:inceput + MARIME_BUCATA_FLUX]]
+        if not bucata:
+            return
+        ultimul = bucata[-1].id
+        yield "\n".join(activitate.model_dump_json(include=campuri) for activitate in bucata) + "\n"
+
+#GET CONDITIONAT------------------------------------------------------------
+#Raspunsurile acestor cai depind doar de activitati, asa ca sunt etichetate cu versiunea colectiei
+CAI_VERSIONATE = ("/activitati", "/alegeactivitate", "/conflicte", "/disponibilitate", "/modificari", "/orar")
+
+def eticheta_potrivita(if_none_match: str | None, eticheta: str) -> bool:
+    if if_none_match is None:
+        return False
+    etichete = [e.strip().removeprefix("W/") for e in if_none_match.split(",")]
+    return "*" in etichete or eticheta.removeprefix("W/") in etichete
+
+@app.middleware("http")
+async def get_conditionat(request: Request, call_next):
+    """ETag si Last-Modified din versiunea colectiei; un If-None-Match potrivit primeste 304 fara a mai citi activitatile"""
+    cale = request.url.path
+    if request.method not in ("GET", "HEAD") or not (cale == "/" or cale.startswith(CAI_VERSIONATE)):
+        return await call_next(request)
+    antete = {"ETag": f'W/"{versiune_colectie}"', "Last-Modified": formatdate(modificat_la, usegmt=True)}
+    if eticheta_potrivita(request.headers.get("if-none-match"), antete["ETag"]):
+        return Response(status_code=304, headers=antete)
+    raspuns = await call_next(request)
+    if raspuns.status_code == 200:
+        raspuns.headers.update(antete)
+    return raspuns
+
+
 #GET------------------------------------------------------------------------
+@app.get("/modificari")
+def modificari(
+        since: int = Query(default=0, ge=0, description="Versiunea colectiei pe care o are deja clientul"),
+        limit: int | None = Query(default=None, ge=1, le=MARIME_MAXIMA_PAGINA)) -> dict[str, int | bool | list[dict]]:
+    """Activitatile modificate dupa versiunea `since`, in ordinea versiunilor; cele sterse au sters=true.
+    Daca `since` este dinaintea pornirii serverului, raspunsul are complet=true si contine toate activitatile:
+    clientul trebuie sa le arunce pe cele pe care nu le primeste.
+    Cu o limita, `versiune` este cea a ultimei modificari intoarse, iar `mai_multe` spune daca mai sunt"""
+    try:
+
+        with lacat_activitati:
+            versiune = versiune_colectie
+            noi = []
+            for id in reversed(istoric_modificari):
+                if istoric_modificari[id] <= since:
+                    break
+                noi.append((id, istoric_modificari[id], activitati.get(id)))
+        noi.reverse()
+        mai_multe = limit is not None and len(noi) > limit
+        if mai_multe:
+            noi = noi[:limit]
+            versiune = noi[-1][1]
+        rezultat = []
+        for id, versiune_id, activitate in noi:
+            modificare = {"id": id, "versiune": versiune_id, "sters": activitate is None}
+            if activitate is not None:
+                modificare["activitate"] = activitate
+            rezultat.append(modificare)
+        return {"versiune": versiune, "complet": since < VERSIUNE_PORNIRE, "mai_multe": mai_multe, "modificari": rezultat}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
 @app.get("/")
 @app.get("/activitati")
-def index() -> dict[str,dict[int, Activitate]]:
+def index(
+        stream: bool = False,
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MARIME_MAXIMA_PAGINA),
+        fields: str | None = Query(default=None, description="Campurile intoarse, separate prin virgula, de exemplu id,sala,ora"),
+        fast: bool = Query(default=False, description="Serializeaza activitatile direct, fara validarea raspunsului")) -> dict[str,dict[int, Activitate]|str|None]:
+    campuri = citeste_campuri(fields)
+    dupa = decodifica_cursor(cursor) if cursor is not None else None
     try:
 
+        if stream:
+            return StreamingResponse(flux_activitati(campuri), media_type="application/x-ndjson")
+        if cursor is not None or limit is not None:
+            ids, cursor_urmator = pagina(ids_sortate, dupa, limit)
+            selectate = {id: activitati[id] for id in ids if id in activitati}
+        else:
+            selectate, cursor_urmator = activitati, None
+        if fast:
+            corp = ADAPTOR_DICT_ACTIVITATI.dump_json(dict(selectate), include=include_campuri(campuri))
+            if cursor is not None or limit is not None:
+                return raspuns_json(activitati=corp, next_cursor=cursor_urmator)
+            return raspuns_json(activitati=corp)
+        if campuri is not None:
+            #activitatile proiectate sunt deja valori JSON, asa ca nu mai trec prin validarea modelului de raspuns
+            rezultat = {"activitati": {id: proiecteaza(activitate, campuri) for id, activitate in list(selectate.items())}}
+            if cursor is not None or limit is not None:
+                rezultat["next_cursor"] = cursor_urmator
+            return JSONResponse(rezultat)
+        if cursor is not None or limit is not None:
+            return {"activitati": selectate, "next_cursor": cursor_urmator}
         return {"activitati":activitati}
 
     except Exception as e:
@@ -166,11 +694,16 @@ def index() -> dict[str,dict[int, Activitate]]:
 
 
 @app.get("/activitati/{activitate_id}")
-def query_activitate_by_id(activitate_id: int = Path(ge=0)) -> Activitate:
+def query_activitate_by_id(
+        activitate_id: int = Path(ge=0),
+        fields: str | None = Query(default=None, description="Campurile intoarse, separate prin virgula")) -> Activitate:
+    campuri = citeste_campuri(fields)
     try:
 
         if activitate_id not in activitati:
             raise HTTPException(status_code=404, detail=f"Activitatea cu {activitate_id=} nu exista.")
+        if campuri is not None:
+            return JSONResponse(proiecteaza(activitati[activitate_id], campuri))
         return activitati[activitate_id]
 
     except Exception as e:
@@ -186,8 +719,14 @@ def cautare_activitate_cu_parametru(
         sala: str | None = None,
         zi: Zile | None = None,
         ora: int | None = Query(default=None, ge=1, le=24),
-        categorie: Categorie | None = None
-) -> dict[str, list[Selectie] | Selectie]:
+        categorie: Categorie | None = None,
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MARIME_MAXIMA_PAGINA),
+        fields: str | None = Query(default=None, description="Campurile intoarse, separate prin virgula, de exemplu id,sala,ora"),
+        fast: bool = Query(default=False, description="Serializeaza activitatile direct, fara validarea raspunsului")
+) -> dict[str, list[Activitate] | Selectie | str | None]:
+    campuri = citeste_campuri(fields)
+    dupa = decodifica_cursor(cursor) if cursor is not None else None
     try:
 
         def verifica_activitate(activitate: Activitate) -> bool:
@@ -203,28 +742,146 @@ def cautare_activitate_cu_parametru(
                     categorie is None or activitate.categorie is categorie
                 )
             )
-        selectie = [x for x in activitati.values() if verifica_activitate(x)]
-        return {
+        #campurile indexate restrang candidatii, restul sunt verificati doar pe acestia
+        candidati = cauta_in_index(profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
+        if id is not None:
+            candidati = {id} if candidati is None else candidati & {id}
+        cursor_urmator = None
+        if cursor is not None or limit is not None:
+            #fara filtre indexate sunt parcurse toate id-urile, dar doar de la cursor pana se umple pagina
+            ordonate = ids_sortate if candidati is None else sorted(candidati)
+            ids, cursor_urmator = pagina(ordonate, dupa, limit, lambda x: x in activitati and verifica_activitate(activitati[x]))
+            selectie = [activitati[x] for x in ids if x in activitati]
+        elif candidati is None:
+            selectie = [x for x in activitati.values() if verifica_activitate(x)]
+        else:
+            selectie = [activitati[x] for x in sorted(candidati) if x in activitati and verifica_activitate(activitati[x])]
+        rezultat = {
             "cautare": {"nume": nume, "durata": durata, "profesor": profesor, "sala": sala, "zi": zi, "ora": ora, "categorie": categorie},
             "selectie": selectie
         }
+        if cursor is not None or limit is not None:
+            rezultat["next_cursor"] = cursor_urmator
+        if fast:
+            rezultat["selectie"] = ADAPTOR_LISTA_ACTIVITATI.dump_json(rezultat["selectie"], include=include_campuri(campuri))
+            return raspuns_json(**rezultat)
+        if campuri is not None:
+            rezultat["cautare"] = jsonable_encoder(rezultat["cautare"])
+            rezultat["selectie"] = [proiecteaza(activitate, campuri) for activitate in rezultat["selectie"]]
+            return JSONResponse(rezultat)
+        return rezultat
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
 
+@app.get("/conflicte")
+def conflicte() -> dict[str, list[dict]]:
+    """Toate perechile de activitati care se suprapun in aceeasi sala sau la acelasi profesor, din grilele de ocupare"""
+    try:
+
+        with lacat_activitati:
+            suprapuneri = [
+                {"tip": tip, tip: cheie[0], "zi": cheie[1], "activitati": list(pereche), "ore": ore}
+                for tip, grila in (("sala", grila_sali), ("profesor", grila_profesori))
+                for cheie, pereche, ore in grila.suprapuneri()
+            ]
+        return {"conflicte": suprapuneri}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
+@app.get("/disponibilitate/sali")
+def sali_libere(
+        zi: Zile,
+        de_la: int = Query(ge=PRIMA_ORA, le=ULTIMA_ORA - 1),
+        pana_la: int = Query(ge=PRIMA_ORA + 1, le=ULTIMA_ORA)) -> dict[str, list[str]]:
+    """Salile cunoscute (cele care apar in orar) libere in ziua data in toate orele de_la..pana_la-1"""
+    if pana_la <= de_la:
+        raise HTTPException(status_code=400, detail=f"pana_la trebuie sa fie dupa de_la.")
+    try:
+
+        cerut = masca_ore(de_la, pana_la)
+        with lacat_activitati:
+            libere = [sala for sala in index_campuri["sala"] if not grila_sali.masca((sala, zi)) & cerut]
+        return {"sali": sorted(libere)}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
+def disponibilitate(grila: GrilaOcupare, valoare: str, zi: Zile | None) -> dict[Zile, list[dict[str, int]]]:
+    """Intervalele libere ale unei sali sau ale unui profesor, pentru ziua data sau pentru toata saptamana"""
+    with lacat_activitati:
+        return {z: intervale_libere(grila.masca((valoare, z))) for z in (Zile if zi is None else (zi,))}
+
+
+@app.get("/disponibilitate/sala/{sala}")
+def sala_libera(sala: str, zi: Zile | None = None) -> dict[str, dict[Zile, list[dict[str, int]]]]:
+    try:
+
+        return {"libera": disponibilitate(grila_sali, sala, zi)}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
+@app.get("/disponibilitate/profesor/{profesor}")
+def profesor_liber(profesor: str, zi: Zile | None = None) -> dict[str, dict[Zile, list[dict[str, int]]]]:
+    try:
+
+        return {"liber": disponibilitate(grila_profesori, profesor, zi)}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
+@app.get("/orar/profesor/{profesor}")
+def orar_profesor(profesor: str) -> dict[str, str | list[Activitate]]:
+    """Activitatile profesorului in ordinea din saptamana (zi, ora), servite direct din vederea gata serializata"""
+    try:
+
+        with lacat_activitati:
+            corp = vedere_profesori.serializat(profesor)
+        return raspuns_json(profesor=profesor, activitati=corp)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
+@app.get("/orar/sala/{sala}")
+def orar_sala(sala: str) -> dict[str, str | list[Activitate]]:
+    """Activitatile din sala in ordinea din saptamana (zi, ora)"""
+    try:
+
+        with lacat_activitati:
+            corp = vedere_sali.serializat(sala)
+        return raspuns_json(sala=sala, activitati=corp)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip get: {e}")
+
+
 #POST------------------------------------------------------------------------
 @app.post("/activitati")
 def add_activitate(activitate: Activitate) -> dict[str, Activitate]:
     try:
 
-        adaugare = adauga_activitate(id=activitate.id, nume=activitate.nume, durata=activitate.durata, profesor=activitate.profesor, sala=activitate.sala, zi=activitate.zi, ora=activitate.ora, categorie=activitate.categorie)
+        #id-ul generat implicit la parsare nu este rezervat, asa ca este alocat abia sub lacat
+        id = activitate.id if "id" in activitate.model_fields_set else None
+        adaugare = adauga_activitate(id=id, nume=activitate.nume, durata=activitate.durata, profesor=activitate.profesor, sala=activitate.sala, zi=activitate.zi, ora=activitate.ora, categorie=activitate.categorie)
         if adaugare == -1:
             raise HTTPException(status_code=400, detail=f"Activitatea deja exista.")
         if adaugare == -2:
             raise HTTPException(status_code=400, detail=f"Nu toti parametrii necesari pentru crearea unei activitati au fost specificati.")
+        if adaugare == -3:
+            raise HTTPException(status_code=409, detail=f"Activitatea se suprapune cu alte activitati din aceeasi sala sau ale aceluiasi profesor.")
         else:
-            return {"added":activitate}
+            return {"added":activitati[adaugare]}
 
+    #raspunsurile de eroare date mai sus (400, conflictele cu 409) ajung la client asa cum sunt
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip post: {e}")
 
@@ -262,6 +919,8 @@ def updateoradd(
                 raise HTTPException(status_code=400, detail=f"Exista deja o activitate cu noii parametrii.")
             if adaugare == -2:
                 raise HTTPException(status_code=400, detail=f"Nu toti noii parametrii au fost adaugati pentu creerea unei noi activitati, si nici nu a fost gasita o activitate cu vechii parametrii")
+            if adaugare == -3:
+                raise HTTPException(status_code=409, detail=f"Noua activitate se suprapune cu alte activitati din aceeasi sala sau ale aceluiasi profesor.")
             else:
                 return {"added": activitati[adaugare]}
 
@@ -275,9 +934,14 @@ def updateoradd(
                 raise HTTPException(status_code=400, detail=f"Exista deja o activitate cu noul ID")
             if actualizat == -2:
                 raise HTTPException(status_code=400, detail=f"Exista deja o activitate cu noii parametrii")
+            if actualizat == -3:
+                raise HTTPException(status_code=409, detail=f"Activitatea actualizata s-ar suprapune cu alte activitati din aceeasi sala sau ale aceluiasi profesor")
             else:
                 return {"updated": activitati[actualizat]}
 
+    #raspunsurile de eroare date mai sus (400, conflictele cu 409) ajung la client asa cum sunt
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip put: {e}")
 
@@ -319,9 +983,14 @@ def update(
                 raise HTTPException(status_code=400, detail=f"Exista deja o activitate cu noul ID")
             if actualizat == -2:
                 raise HTTPException(status_code=400, detail=f"Exista deja o activitate cu noii parametrii")
+            if actualizat == -3:
+                raise HTTPException(status_code=409, detail=f"Activitatea actualizata s-ar suprapune cu alte activitati din aceeasi sala sau ale aceluiasi profesor")
             else:
                 return {"updated": activitati[actualizat]}
 
+    #raspunsurile de eroare date mai sus (400, conflictele cu 409) ajung la client asa cum sunt
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip patch: {e}")
 
@@ -341,21 +1010,363 @@ def delete_activitate(
 ) -> dict[str, Activitate]:
     try:
 
-        exista = verifica_exista(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
+        with lacat_activitati:
+            exista = verifica_exista(id=id, nume=nume, durata=durata, profesor=profesor, sala=sala, zi=zi, ora=ora, categorie=categorie)
 
 
-        if exista == -1 and id is None and any(info is None for info in (nume, durata, profesor, sala, zi, ora, categorie)):
-            raise HTTPException(status_code=400, detail=f"Este necesar ori un ID al activitatii, ori toti parametrii acesteia.")
-        elif exista == -1:
-            raise HTTPException(status_code=400, detail=f"Activitatea specificata nu a fost gasita")
+            if exista == -1 and id is None and any(info is None for info in (nume, durata, profesor, sala, zi, ora, categorie)):
+                raise HTTPException(status_code=400, detail=f"Este necesar ori un ID al activitatii, ori toti parametrii acesteia.")
+            elif exista == -1:
+                raise HTTPException(status_code=400, detail=f"Activitatea specificata nu a fost gasita")
+            else:
+                activitate = elimina_activitate(exista)
+                return {"deleted": activitate}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip delete: {e}")
+
+
+#BULK------------------------------------------------------------------------
+#Cele mai multe inregistrari pe care le poate avea o singura cerere bulk
+MARIME_MAXIMA_LOT = 10000
+
+async def citeste_inregistrari(request: Request) -> list:
+    """Corpul unei cereri bulk: un vector JSON, sau NDJSON (cate o inregistrare pe linie) daca este trimis ca application/x-ndjson"""
+    corp = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            inregistrari = [json.loads(linie) for linie in corp.splitlines() if linie.strip()]
         else:
-            activitate = activitati.pop(id)
-            return {"deleted": activitate}
+            inregistrari = json.loads(corp)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Corp invalid: {e}")
+    if not isinstance(inregistrari, list):
+        raise HTTPException(status_code=400, detail=f"Corpul trebuie sa fie un vector de inregistrari.")
+    if len(inregistrari) > MARIME_MAXIMA_LOT:
+        raise HTTPException(status_code=413, detail=f"Cel mult {MARIME_MAXIMA_LOT} inregistrari pe cerere.")
+    return inregistrari
+
+class ModificareActivitate(BaseModel):
+    """O inregistrare din PATCH /activitati/bulk: id-ul activitatii si campurile care se schimba"""
+    id_vechi: int = Field(ge=0)
+    id: int | None = Field(default=None, ge=0)
+    nume: str | None = None
+    durata: int | None = Field(default=None, gt=0)
+    profesor: str | None = None
+    sala: str | None = None
+    zi: Zile | None = None
+    ora: int | None = Field(default=None, ge=1, le=24)
+    categorie: Categorie | None = None
+
+def eroare_validare(e: ValidationError):
+    return json.loads(e.json(include_url=False))
+
+def raport(rezultate: dict, scrise: int) -> dict:
+    return {"rezultate": [rezultate[pozitie] for pozitie in sorted(rezultate)], "scrise": scrise}
+
+def omite(rezultate: dict, perechi) -> dict:
+    """Modul atomic cu cel putin o inregistrare respinsa: nimic nu este scris, iar restul (pozitie, id) sunt marcate omise"""
+    for pozitie, id in perechi:
+        rezultate.setdefault(pozitie, {"index": pozitie, "status": "omis", "id": id})
+    return raport(rezultate, 0)
+
+def adauga_lot(inregistrari: list, atomic: bool) -> dict:
+    """Valideaza toate inregistrarile intr-o singura trecere, verifica duplicatele fata de indexul de unicitate
+    si in interiorul lotului, apoi le adauga pe toate sub o singura luare a lacatului.
+    Activitatile cu id dat sunt adaugate primele, ca alocatorul sa nu le dea id-ul altor activitati din lot"""
+    rezultate, valide = {}, []
+    with lacat_activitati:
+        chei_lot, ids_lot = set(), set()
+        #Ocuparea facuta de activitatile deja acceptate din lot, cu -pozitie-1 in loc de id (care poate inca lipsi)
+        sali_lot, profesori_lot = GrilaOcupare(), GrilaOcupare()
+        for pozitie, inregistrare in enumerate(inregistrari):
+            try:
+                activitate = Activitate.model_validate(inregistrare)
+            except ValidationError as e:
+                rezultate[pozitie] = {"index": pozitie, "status": "eroare", "detaliu": eroare_validare(e)}
+                continue
+            id_dat = "id" in activitate.model_fields_set
+            cheie = cheie_activitate(activitate)
+            if cheie in index_unicitate or cheie in chei_lot:
+                rezultate[pozitie] = {"index": pozitie, "status": "exista", "detaliu": f"Activitatea deja exista."}
+            elif id_dat and (activitate.id in activitati or activitate.id in ids_lot):
+                rezultate[pozitie] = {"index": pozitie, "status": "exista", "detaliu": f"Exista deja o activitate cu id={activitate.id}."}
+            elif conflicte := conflicte_activitate(activitate.sala, activitate.profesor, activitate.zi, activitate.ora, activitate.durata):
+                rezultate[pozitie] = {"index": pozitie, "status": "conflict", "detaliu": conflicte}
+            elif (sali_lot.ocupate((activitate.sala, activitate.zi), activitate.ora, activitate.durata)
+                  or profesori_lot.ocupate((activitate.profesor, activitate.zi), activitate.ora, activitate.durata)):
+                rezultate[pozitie] = {"index": pozitie, "status": "conflict", "detaliu": f"Se suprapune cu alta activitate din cerere."}
+            else:
+                sali_lot.ocupa((activitate.sala, activitate.zi), activitate.ora, activitate.durata, -pozitie - 1)
+                profesori_lot.ocupa((activitate.profesor, activitate.zi), activitate.ora, activitate.durata, -pozitie - 1)
+                chei_lot.add(cheie)
+                if id_dat:
+                    ids_lot.add(activitate.id)
+                valide.append((pozitie, activitate))
+        if atomic and rezultate:
+            return omite(rezultate, [(pozitie, activitate.id if "id" in activitate.model_fields_set else None) for pozitie, activitate in valide])
+
+        valide.sort(key=lambda pereche: "id" not in pereche[1].model_fields_set)
+        with grup_jurnal():
+            for pozitie, activitate in valide:
+                if "id" not in activitate.model_fields_set:
+                    activitate.id = alocator_id.urmatorul()
+                inregistreaza_activitate(activitate)
+                rezultate[pozitie] = {"index": pozitie, "status": "adaugat", "id": activitate.id}
+        return raport(rezultate, len(valide))
+
+def modifica_lot(inregistrari: list, atomic: bool) -> dict:
+    """Aplica modificarile in ordine prin update_activitate. In modul atomic fiecare activitate modificata
+    este copiata inainte, iar la prima modificare respinsa cele deja facute sunt anulate in ordine inversa"""
+    rezultate, valide = {}, []
+    for pozitie, inregistrare in enumerate(inregistrari):
+        try:
+            modificare = ModificareActivitate.model_validate(inregistrare)
+        except ValidationError as e:
+            rezultate[pozitie] = {"index": pozitie, "status": "eroare", "detaliu": eroare_validare(e)}
+            continue
+        if not modificare.model_fields_set - {"id_vechi"}:
+            rezultate[pozitie] = {"index": pozitie, "status": "eroare", "detaliu": f"Nu a fost scris niciun parametru pentru actualizare."}
+            continue
+        valide.append((pozitie, modificare))
+
+    with lacat_activitati, grup_jurnal():
+        if atomic and rezultate:
+            return omite(rezultate, [(pozitie, modificare.id_vechi) for pozitie, modificare in valide])
+
+        anulari = []
+        for pozitie, modificare in valide:
+            if modificare.id_vechi not in activitati:
+                actualizat = None
+            else:
+                vechea = activitati[modificare.id_vechi].model_copy()
+                actualizat = update_activitate(**modificare.model_dump())
+            if actualizat is not None and actualizat >= 0:
+                anulari.append((pozitie, actualizat, vechea))
+                rezultate[pozitie] = {"index": pozitie, "status": "actualizat", "id": actualizat}
+                continue
+            rezultate[pozitie] = {"index": pozitie, "status": {None: "lipseste", -3: "conflict"}.get(actualizat, "exista"), "id": modificare.id_vechi, "detaliu": {
+                -1: f"Exista deja o activitate cu noul ID",
+                -2: f"Exista deja o activitate cu noii parametrii",
+                -3: f"Activitatea actualizata s-ar suprapune cu alte activitati din aceeasi sala sau ale aceluiasi profesor",
+                None: f"Activitatea nu a fost gasita",
+            }[actualizat]}
+            if atomic:
+                for pozitie_anulata, id, vechea in reversed(anulari):
+                    elimina_activitate(id)
+                    inregistreaza_activitate(vechea)
+                    del rezultate[pozitie_anulata]
+                return omite(rezultate, [(pozitie, modificare.id_vechi) for pozitie, modificare in valide])
+        return raport(rezultate, len(anulari))
+
+def sterge_lot(inregistrari: list, atomic: bool) -> dict:
+    """Sterge activitatile date prin id (numar sau {"id": ...}). In modul atomic nu sterge nimic daca vreuna lipseste"""
+    rezultate, ids = {}, []
+    for pozitie, inregistrare in enumerate(inregistrari):
+        id = inregistrare.get("id") if isinstance(inregistrare, dict) else inregistrare
+        if not isinstance(id, int) or isinstance(id, bool) or id < 0:
+            rezultate[pozitie] = {"index": pozitie, "status": "eroare", "detaliu": f"Id invalid: {id!r}"}
+        elif id in ids:
+            rezultate[pozitie] = {"index": pozitie, "status": "eroare", "detaliu": f"Id-ul {id} apare de mai multe ori in cerere."}
+        else:
+            ids.append(id)
+    pozitii = [pozitie for pozitie in range(len(inregistrari)) if pozitie not in rezultate]
+
+    with lacat_activitati:
+        for pozitie, id in zip(pozitii, ids):
+            if id not in activitati:
+                rezultate[pozitie] = {"index": pozitie, "status": "lipseste", "id": id}
+        if atomic and rezultate:
+            return omite(rezultate, zip(pozitii, ids))
+
+        scrise = 0
+        with grup_jurnal():
+            for pozitie, id in zip(pozitii, ids):
+                if pozitie not in rezultate:
+                    elimina_activitate(id)
+                    rezultate[pozitie] = {"index": pozitie, "status": "sters", "id": id}
+                    scrise += 1
+        return raport(rezultate, scrise)
+
+
+@app.post("/activitati/bulk")
+async def add_activitati_bulk(request: Request, atomic: bool = False) -> dict:
+    """Adauga un vector de activitati (JSON sau NDJSON). Cu atomic=true nu adauga nimic daca vreuna este respinsa"""
+    inregistrari = await citeste_inregistrari(request)
+    try:
+
+        return await run_in_threadpool(adauga_lot, inregistrari, atomic)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip post: {e}")
+
+
+@app.patch("/activitati/bulk")
+async def update_activitati_bulk(request: Request, atomic: bool = False) -> dict:
+    """Actualizeaza activitatile date prin id_vechi si campurile noi"""
+    inregistrari = await citeste_inregistrari(request)
+    try:
+
+        return await run_in_threadpool(modifica_lot, inregistrari, atomic)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip patch: {e}")
+
+
+@app.delete("/activitati/bulk")
+async def delete_activitati_bulk(request: Request, atomic: bool = False) -> dict:
+    """Sterge activitatile cu id-urile date"""
+    inregistrari = await citeste_inregistrari(request)
+    try:
+
+        return await run_in_threadpool(sterge_lot, inregistrari, atomic)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip delete: {e}")
 
 
+#PLANIFICARE-----------------------------------------------------------------
+class ActivitateDePlanificat(BaseModel):
+    """O activitate fara zi, ora si sala, care urmeaza sa fie asezata de planificator"""
+    nume: str = Field(description="Numele activitatii")
+    durata: int = Field(description="Durata activitatii", gt=0)
+    profesor: str = Field(description="Profesorul care se ocupa de activitate")
+    categorie: Categorie = Field(description="Categoria activitatii (curs,seminar sau laborator)")
+    sali: list[str] | None = Field(default=None, description="Salile in care poate avea loc, implicit oricare din cerere")
+
+class CererePlanificare(BaseModel):
+    activitati: list[ActivitateDePlanificat] = Field(max_length=MARIME_MAXIMA_LOT)
+    sali: list[str] = Field(default_factory=list, description="Salile disponibile, implicit cele care apar deja in orar")
+    zile: list[Zile] = Field(default=[Zile.LUNI, Zile.MARTI, Zile.MIERCURI, Zile.JOI, Zile.VINERI], min_length=1)
+    de_la: int = Field(default=8, ge=PRIMA_ORA, le=ULTIMA_ORA - 1, description="Prima ora la care poate incepe o activitate")
+    pana_la: int = Field(default=20, ge=PRIMA_ORA + 1, le=ULTIMA_ORA, description="Ora pana la care trebuie sa se termine")
+    treceri: int = Field(default=10, ge=0, le=1000, description="Cele mai multe treceri de reparare dupa faza lacoma")
+    aplica: bool = Field(default=False, description="Adauga in orar activitatile asezate (toate sau niciuna)")
+    samanta: int | None = Field(default=None, description="Samanta pentru cautarea aleatoare, pentru rezultate reproductibile")
+
+#Cate planificari sunt pastrate; cand sunt mai multe, cele terminate mai vechi sunt uitate
+MAXIM_LUCRARI_PLANIFICARE = 100
+
+class LucrarePlanificare:
+    """O planificare rulata intr-un fir de fundal. Starea ei (in_asteptare, ruleaza, terminat, anulat, esuat),
+    progresul si rezultatul sunt citite prin GET /planificare/{id}"""
+
+    def __init__(self, cerere: CererePlanificare):
+        self.id = secrets.token_hex(8)
+        self.cerere = cerere
+        self.stare = "in_asteptare"
+        self.progres = {"faza": None, "facut": 0, "total": len(cerere.activitati)}
+        self.rezultat = None
+        self.eroare = None
+        self.pornit_la = time.time()
+        self.terminat_la = None
+        self.anulat = threading.Event()
+        self.fir = threading.Thread(target=self.ruleaza, name=f"planificare-{self.id}", daemon=True)
+
+    def actualizeaza_progres(self, faza: str, facut: int, total: int):
+        self.progres = {"faza": faza, "facut": facut, "total": total}
+
+    def ruleaza(self):
+        cerere = self.cerere
+        try:
+            self.stare = "ruleaza"
+            activitati_cerute = [activitate.model_dump() for activitate in cerere.activitati]
+            #Planificatorul porneste de la o copie a ocuparii curente, asa ca orarul nu ramane blocat cat timp cauta
+            with lacat_activitati:
+                sali = cerere.sali or sorted(index_campuri["sala"])
+                planificator = Planificator(activitati_cerute, sali, cerere.zile, cerere.de_la, cerere.pana_la,
+                                            dict(grila_sali.masti), dict(grila_profesori.masti), cerere.samanta)
+            planificator.oprit = self.anulat
+            planificator.progres = self.actualizeaza_progres
+            neasezate = planificator.ruleaza(cerere.treceri)
+
+            asezate = []
+            for i, (zi, ora, sala) in sorted(planificator.locuri.items()):
+                activitate = {camp: activitati_cerute[i][camp] for camp in ("nume", "durata", "profesor", "categorie")}
+                asezate.append({"index": i, **activitate, "sala": sala, "zi": zi, "ora": ora})
+            self.rezultat = {
+                "asezate": asezate,
+                "neasezate": [{"index": i, "nume": activitati_cerute[i]["nume"], "profesor": activitati_cerute[i]["profesor"]} for i in neasezate],
+                "asezate_lacom": planificator.asezate_lacom,
+                "durata_s": round(time.time() - self.pornit_la, 3),
+            }
+            if self.anulat.is_set():
+                self.stare = "anulat"
+                return
+            if cerere.aplica and asezate:
+                #orarul se poate schimba intre timp, asa ca activitatile sunt verificate din nou la adaugare
+                self.rezultat["aplicare"] = adauga_lot([{camp: valoare for camp, valoare in activitate.items() if camp != "index"} for activitate in asezate], atomic=True)
+            self.stare = "terminat"
+        except Exception as e:
+            self.stare = "esuat"
+            self.eroare = str(e)
+        finally:
+            self.terminat_la = time.time()
+
+    def descriere(self) -> dict:
+        return {
+            "id": self.id,
+            "stare": self.stare,
+            "progres": self.progres,
+            "pornit_la": self.pornit_la,
+            "terminat_la": self.terminat_la,
+            "rezultat": self.rezultat,
+            "eroare": self.eroare,
+        }
+
+#id -> planificare, in ordinea pornirii
+lucrari_planificare: dict[str, LucrarePlanificare] = {}
+
+def lucrare_planificare(id: str) -> LucrarePlanificare:
+    lucrare = lucrari_planificare.get(id)
+    if lucrare is None:
+        raise HTTPException(status_code=404, detail=f"Planificarea nu a fost gasita.")
+    return lucrare
+
+
+@app.post("/planificare", status_code=202)
+def porneste_planificare(cerere: CererePlanificare) -> dict[str, str]:
+    """Porneste in fundal asezarea activitatilor date (zi, ora si sala fara suprapuneri). Progresul si rezultatul
+    sunt citite cu GET /planificare/{id}; cu aplica=true activitatile asezate sunt si adaugate in orar"""
+    if cerere.pana_la <= cerere.de_la:
+        raise HTTPException(status_code=400, detail=f"pana_la trebuie sa fie dupa de_la.")
+    try:
+
+        terminate = [id for id, lucrare in lucrari_planificare.items() if lucrare.terminat_la is not None]
+        for id in terminate[:max(0, len(lucrari_planificare) - MAXIM_LUCRARI_PLANIFICARE + 1)]:
+            del lucrari_planificare[id]
+        lucrare = LucrarePlanificare(cerere)
+        lucrari_planificare[lucrare.id] = lucrare
+        lucrare.fir.start()
+        return {"id": lucrare.id, "stare": lucrare.stare}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eroare in cerere de tip post: {e}")
+
+
+@app.get("/planificare/{id}")
+def stare_planificare(id: str) -> dict:
+    lucrare = lucrare_planificare(id)
+    return lucrare.descriere()
+
+
+@app.delete("/planificare/{id}")
+def anuleaza_planificare(id: str) -> dict:
+    """Opreste o planificare care inca ruleaza; rezultatul partial ramane disponibil, dar nu este aplicat"""
+    lucrare = lucrare_planificare(id)
+    lucrare.anulat.set()
+    return lucrare.descriere()
+
+
+@app.on_event("shutdown")
+def inchide_jurnal():
+    """La oprire starea este compactata intr-un snapshot, ca urmatoarea pornire sa nu mai refaca jurnalul"""
+    if jurnal is not None:
+        with lacat_activitati:
+            jurnal.compacteaza()
+            jurnal.inchide()
+
+
 print("Working")
 
 
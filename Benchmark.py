@@ -0,0 +1,265 @@
+"""Load test of Api1.py, ApiOrar.py and FastAPIRedis.py, run in-process through httpx.ASGITransport.
+
+For every dataset size the apps are seeded with that many items/activities, then every endpoint below gets
+`requests` requests from `concurrency` concurrent clients (after a short warm-up). For each endpoint the
+p50/p99/mean latency, throughput and number of failed requests are printed and saved as JSON, so runs can be
+compared: with --compare the previous results are loaded and any endpoint slower by more than --tolerance
+(in p50, p99 or throughput) is reported, and the exit status is 1.
+
+FastAPIRedis runs on fakeredis by default (pip install fakeredis[lua]), or on a real server with --redis URL
+(the database in the URL is FLUSHED). Api1 is run once per storage backend given with --api1-storage, so the
+backends of Storage.py are compared side by side (as api1:memory, api1:redis, api1:sqlite); its redis backend
+uses the same server as FastAPIRedis, and its sqlite backend a new database file in a temporary directory. fakeredis runs SCAN in sorted key order at O(keys) per call, so the SCAN-paged
+/items of FastAPIRedis looks far slower on it than on a real server: compare it only between runs on the same backend.
+ApiOrar keeps its activities in the process, so its dataset only grows:
+sizes are run in increasing order and persistence (ORAR_DATE) should be left unset.
+
+Usage: python Benchmark.py [--sizes 1000,10000] [--requests 200] [--concurrency 10] [--apps api1,orar,redis]
+                           [--api1-storage memory,redis,sqlite] [--redis URL]
+                           [--output benchmark.json] [--compare previous.json] [--tolerance 0.2]"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+WARMUP_REQUESTS = 20
+SEED_BATCH = 1000
+
+
+class Endpoint:
+    """One benchmarked request; `build(i)` gives the url, query parameters and JSON body of the i-th request"""
+
+    def __init__(self, name: str, method: str, build):
+        self.name = name
+        self.method = method
+        self.build = build
+
+
+async def measure(client: httpx.AsyncClient, endpoint: Endpoint, requests: int, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    counter = iter(range(WARMUP_REQUESTS + requests))
+
+    async def worker(record: bool, remaining: int):
+        nonlocal errors
+        for _ in range(remaining):
+            url, params, body = endpoint.build(next(counter))
+            start = time.perf_counter()
+            response = await client.request(endpoint.method, url, params=params, json=body)
+            elapsed = time.perf_counter() - start
+            if record:
+                latencies.append(elapsed)
+                errors += response.status_code >= 400
+
+    await worker(False, WARMUP_REQUESTS)
+    start = time.perf_counter()
+    shares = [requests // concurrency + (k < requests % concurrency) for k in range(concurrency)]
+    await asyncio.gather(*(worker(True, share) for share in shares if share))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "rps": round(requests / wall, 1),
+    }
+
+
+#SEEDING AND ENDPOINTS-------------------------------------------------------
+def random_item(i: int) -> dict:
+    return {"name": f"Item {i}", "price": round(random.uniform(1, 100), 2), "count": random.randint(0, 500),
+            "id": i, "category": "tools" if i % 2 else "consumables"}
+
+
+def create_redis_client(redis_url: str | None):
+    if redis_url is None:
+        import fakeredis
+        return fakeredis.aioredis.FakeRedis()
+    import redis.asyncio as redis
+    return redis.from_url(redis_url)
+
+
+async def setup_api1(n: int, storage: str, redis_url: str | None, directory: str):
+    import Api1
+    from Storage import MemoryRepository, RedisRepository, SqliteRepository
+    await Api1.repository.close()
+    if storage == "redis":
+        Api1.repository = RedisRepository(Api1.Item, "api1_items", create_redis_client(redis_url))
+        await Api1.repository.redis.flushdb()
+    elif storage == "sqlite":
+        Api1.repository = SqliteRepository(Api1.Item, "api1_items", os.path.join(directory, f"api1_{n}.db"))
+    else:
+        Api1.repository = MemoryRepository(Api1.Item, "api1_items")
+    records = [Api1.Item(**random_item(i)) for i in range(n)]
+    if storage == "sqlite":
+        #one transaction for the whole dataset instead of a commit per record
+        with Api1.repository.lock:
+            Api1.repository.connection.executemany("INSERT INTO api1_items (id, data) VALUES (?, ?)",
+                                                   [(record.id, record.model_dump_json()) for record in records])
+            Api1.repository.connection.commit()
+    else:
+        for record in records:
+            await Api1.repository.put(record)
+    endpoints = [
+        Endpoint("GET /items?limit=100", "GET", lambda i: ("/items", {"limit": 100}, None)),
+        Endpoint("GET /items/{id}", "GET", lambda i: (f"/items/{random.randrange(n)}", None, None)),
+        Endpoint("GET /chooseitem?category", "GET", lambda i: ("/chooseitem", {"category": "tools", "limit": 100}, None)),
+        Endpoint("PATCH /items/{id}", "PATCH", lambda i: (f"/items/{random.randrange(n)}", {"count": i}, None)),
+        Endpoint("POST /items", "POST", lambda i: ("/items", None, random_item(n + i))),
+    ]
+    return Api1.app, endpoints
+
+
+async def setup_redis(n: int, redis_url: str | None):
+    import FastAPIRedis
+    from FastAPIRedis import app, prepare_redis, run_item_scripts
+    if getattr(app.state, "redis", None) is None:
+        app.state.redis = create_redis_client(redis_url)
+    await app.state.redis.flushdb()
+    #no invalidation listener runs here, so the process cache must not keep items of the previous size
+    FastAPIRedis.l1_cache.clear()
+    await prepare_redis()
+    calls = [("insert", i, random_item(i)) for i in range(n)]
+    for start in range(0, n, SEED_BATCH):
+        await run_item_scripts(calls[start:start + SEED_BATCH])
+    endpoints = [
+        Endpoint("GET /items?limit=100", "GET", lambda i: ("/items", {"limit": 100}, None)),
+        Endpoint("GET /items?limit=100&fast", "GET", lambda i: ("/items", {"limit": 100, "fast": "true"}, None)),
+        Endpoint("GET /items/{id}", "GET", lambda i: (f"/items/{random.randrange(n)}", None, None)),
+        Endpoint("GET /chooseitem?category", "GET", lambda i: ("/chooseitem", {"category": "tools", "limit": 100}, None)),
+        Endpoint("GET /stats", "GET", lambda i: ("/stats", None, None)),
+        Endpoint("PATCH /items/{id}", "PATCH", lambda i: (f"/items/{random.randrange(n)}", {"count": i}, None)),
+        Endpoint("POST /items", "POST", lambda i: ("/items", None, random_item(n + i))),
+    ]
+    return app, endpoints
+
+
+async def setup_orar(n: int):
+    import ApiOrar
+    from ApiOrar import Activitate, Categorie, Zile, inregistreaza_activitate, lacat_activitati
+    zile = list(Zile)
+    #each room fills its 7*24 weekly hours in turn. The professor of a room at a given hour is (room + hour) % 500
+    #within each block of 500 rooms, so rooms busy at the same hour never share one
+    profesori = 500 * -(-n // (168 * 500))
+    with lacat_activitati:
+        for i in range(len(ApiOrar.activitati), n):
+            sala, ora = divmod(i, 168)
+            profesor = (sala + ora) % 500 + sala // 500 * 500
+            inregistreaza_activitate(Activitate(id=ApiOrar.alocator_id.urmatorul(), nume=f"Activitate {i}", durata=1,
+                                                profesor=f"Profesor {profesor}", sala=f"S{sala}", zi=zile[ora // 24],
+                                                ora=1 + ora % 24, categorie=list(Categorie)[i % 3]))
+        #the API would reject an overlapping timetable, so it must not be measured either
+        if any(True for grila in (ApiOrar.grila_sali, ApiOrar.grila_profesori) for _ in grila.suprapuneri()):
+            raise RuntimeError(f"The generated timetable of {n} activities has overlaps")
+    ids = list(ApiOrar.activitati)
+    endpoints = [
+        Endpoint("GET /activitati?limit=100", "GET", lambda i: ("/activitati", {"limit": 100}, None)),
+        Endpoint("GET /activitati/{id}", "GET", lambda i: (f"/activitati/{random.choice(ids)}", None, None)),
+        Endpoint("GET /alegeactivitate?profesor", "GET", lambda i: ("/alegeactivitate", {"profesor": f"Profesor {random.randrange(profesori)}"}, None)),
+        Endpoint("GET /orar/profesor/{profesor}", "GET", lambda i: (f"/orar/profesor/Profesor {random.randrange(profesori)}", None, None)),
+        Endpoint("GET /disponibilitate/sali", "GET", lambda i: ("/disponibilitate/sali", {"zi": "luni", "de_la": 8, "pana_la": 10}, None)),
+        Endpoint("PATCH /activitati (nume)", "PATCH", lambda i: ("/activitati", {"id_vechi": random.choice(ids), "nume": f"Redenumita {i}"}, None)),
+    ]
+    return ApiOrar.app, endpoints
+
+
+#RUNNING AND COMPARING-------------------------------------------------------
+async def run(args) -> list[dict]:
+    results = []
+    #one run per Api1 storage backend, each named app:backend
+    runs = [(f"api1:{storage}", "api1", storage) for storage in args.api1_storage] if "api1" in args.apps else []
+    runs += [(name, name, None) for name in args.apps if name != "api1"]
+    with tempfile.TemporaryDirectory() as directory:
+        for n in sorted(args.sizes):
+            for label, name, storage in runs:
+                if name == "api1":
+                    app, endpoints = await setup_api1(n, storage, args.redis, directory)
+                elif name == "redis":
+                    app, endpoints = await setup_redis(n, args.redis)
+                else:
+                    app, endpoints = await setup_orar(n)
+                async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+                    for endpoint in endpoints:
+                        result = {"app": label, "endpoint": endpoint.name, "size": n,
+                                  **await measure(client, endpoint, args.requests, args.concurrency)}
+                        results.append(result)
+                        print(f"{label:12} {n:>8} {endpoint.name:34} p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms"
+                              f"  {result['rps']:9.1f} req/s  errors {result['errors']}")
+        if "api1" in args.apps:
+            import Api1
+            await Api1.repository.close()
+    return results
+
+
+def compare(previous: list[dict], current: list[dict], tolerance: float) -> list[str]:
+    """Endpoints slower than in the previous run by more than `tolerance` (0.2 = 20%)"""
+    before = {(result["app"], result["endpoint"], result["size"]): result for result in previous}
+    regressions = []
+    for result in current:
+        old = before.get((result["app"], result["endpoint"], result["size"]))
+        if old is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if result[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{result['app']} {result['endpoint']} n={result['size']}: {metric} {old[metric]} -> {result[metric]}")
+        if result["rps"] < old["rps"] / (1 + tolerance):
+            regressions.append(f"{result['app']} {result['endpoint']} n={result['size']}: rps {old['rps']} -> {result['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process load test of the API modules")
+    parser.add_argument("--sizes", type=lambda value: [int(n) for n in value.split(",")], default=[1000, 10000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--apps", type=lambda value: value.split(","), default=["api1", "orar", "redis"])
+    parser.add_argument("--api1-storage", type=lambda value: value.split(","), default=["memory"],
+                        help="Storage backends of Api1 to benchmark, out of memory, redis and sqlite")
+    parser.add_argument("--redis", default=None, help="URL of a Redis server to use instead of fakeredis (its database is flushed)")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="Results of a previous run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if unknown := set(args.apps) - {"api1", "orar", "redis"}:
+        parser.error(f"Unknown apps: {', '.join(sorted(unknown))}")
+    if unknown := set(args.api1_storage) - {"memory", "redis", "sqlite"}:
+        parser.error(f"Unknown Api1 storage backends: {', '.join(sorted(unknown))}")
+
+    random.seed(args.seed)
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "redis": args.redis or "fakeredis",
+            "api1_storage": args.api1_storage,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "results": results,
+        }, f, indent=2)
+    print(f"Saved {len(results)} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f)["results"], results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
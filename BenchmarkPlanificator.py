@@ -0,0 +1,69 @@
+"""Speed and quality of the timetable solver in Planificator.py on synthetic timetables:
+how many activities the greedy phase places, how many the repair phase adds, and the time taken.
+
+Each timetable has one activity per 10 hours of teaching per professor (so professors are about 40% busy
+in a 5 day, 8-20 week), rooms filled to about `load` of their hours, and every third activity (the labs)
+restricted to the lab rooms, which are the tightest resource.
+
+Usage: python BenchmarkPlanificator.py [load] [activities ...]
+Runs the solver directly and once through POST /planificare of ApiOrar.py for the largest size."""
+import random
+import sys
+import time
+
+from fastapi.testclient import TestClient
+
+import ApiOrar
+from ApiOrar import Zile
+from Planificator import Planificator
+
+DAYS = [Zile.LUNI, Zile.MARTI, Zile.MIERCURI, Zile.JOI, Zile.VINERI]
+START, END = 8, 20
+
+
+def synthetic(n: int, load: float, seed: int = 0) -> tuple[list[dict], list[str]]:
+    rng = random.Random(seed)
+    activities = [{"nume": f"Activitate {i}", "durata": rng.choice((1, 2, 2, 3)), "profesor": f"Profesor {i // 5}",
+                   "categorie": ("laborator", "curs", "seminar")[i % 3]} for i in range(n)]
+    hours = sum(activity["durata"] for activity in activities)
+    rooms = max(2, round(hours / (len(DAYS) * (END - START) * load)))
+    labs = [f"L{k}" for k in range(max(1, rooms // 3))]
+    for activity in activities:
+        if activity["categorie"] == "laborator":
+            activity["sali"] = labs
+    return activities, labs + [f"S{k}" for k in range(rooms - len(labs))]
+
+
+def solve(activities: list[dict], rooms: list[str]) -> tuple[float, int, int]:
+    start = time.perf_counter()
+    solver = Planificator(activities, rooms, DAYS, START, END, {}, {}, samanta=1)
+    unplaced = solver.ruleaza()
+    return time.perf_counter() - start, solver.asezate_lacom, len(activities) - len(unplaced)
+
+
+def through_api(activities: list[dict], rooms: list[str]) -> tuple[float, dict]:
+    client = TestClient(ApiOrar.app)
+    start = time.perf_counter()
+    job = client.post("/planificare", json={"activitati": activities, "sali": rooms, "samanta": 1}).json()
+    while (state := client.get(f"/planificare/{job['id']}").json())["stare"] in ("in_asteptare", "ruleaza"):
+        time.sleep(0.01)
+    return time.perf_counter() - start, state
+
+
+def main(load: float, sizes: list[int]):
+    print(f"{'activities':>10} {'rooms':>6} {'greedy':>8} {'repaired':>9} {'unplaced':>9} {'time':>8} {'act/s':>9}")
+    for n in sizes:
+        activities, rooms = synthetic(n, load)
+        elapsed, greedy, placed = solve(activities, rooms)
+        print(f"{n:10} {len(rooms):6} {greedy:8} {placed - greedy:9} {n - placed:9} {elapsed:7.2f}s {n / elapsed:9.0f}")
+
+    activities, rooms = synthetic(max(sizes), load)
+    elapsed, state = through_api(activities, rooms)
+    print(f"POST /planificare ({max(sizes)}): {state['stare']} in {elapsed:.2f}s, "
+          f"{len(state['rezultat']['asezate'])} placed, {len(state['rezultat']['neasezate'])} unplaced")
+
+
+if __name__ == "__main__":
+    load = float(sys.argv[1]) if len(sys.argv) > 1 else 0.9
+    sizes = [int(n) for n in sys.argv[2:]] or [1000, 2000, 5000, 10000]
+    main(load, sizes)
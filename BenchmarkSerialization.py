@@ -0,0 +1,74 @@
+"""Throughput of the big listings with and without the fast=true serialization path:
+/items and /chooseitem of FastAPIRedis.py (JSON spliced from Redis) and /activitati of ApiOrar.py
+(pydantic dump_json instead of response model validation).
+
+Usage: python BenchmarkSerialization.py [items] [requests] [db]
+Needs a running Redis server. The given db (default 15) is FLUSHED before and after."""
+import asyncio
+import random
+import sys
+import time
+
+import httpx
+
+import ApiOrar
+from ApiOrar import Activitate, Categorie, Zile, inregistreaza_activitate
+from FastAPIRedis import app, create_redis, prepare_redis, run_item_scripts, Category
+
+
+async def requests_per_second(client: httpx.AsyncClient, url: str, params: dict, requests: int) -> tuple[float, int]:
+    """Sequential requests per second and the size of one response"""
+    size = len((await client.get(url, params=params)).content)
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+    return requests / (time.perf_counter() - start), size
+
+
+async def compare(client: httpx.AsyncClient, label: str, url: str, params: dict, requests: int):
+    slow, size = await requests_per_second(client, url, params, requests)
+    fast, _ = await requests_per_second(client, url, dict(params, fast="true"), requests)
+    print(f"{label:32} {size / 1024:8.0f} KiB   {slow:8.1f} req/s   fast {fast:8.1f} req/s   x{fast / slow:.2f}")
+
+
+async def bench_redis(n: int, requests: int, db: int):
+    app.state.redis = create_redis(db)
+    await app.state.redis.flushdb()
+    await prepare_redis()
+    calls = [
+        ("insert", i, {"name": f"Item {i}", "price": round(random.uniform(1, 100), 2), "count": random.randint(0, 500),
+                       "category": Category.TOOLS if i % 2 else Category.CONSUMABLES})
+        for i in range(n)
+    ]
+    for start in range(0, n, 1000):
+        await run_item_scripts(calls[start:start + 1000])
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        await compare(client, f"/items ({n})", "/items", {}, requests)
+        await compare(client, f"/items?limit=1000", "/items", {"limit": 1000}, requests)
+        await compare(client, f"/chooseitem?category=tools", "/chooseitem", {"category": "tools"}, requests)
+
+    await app.state.redis.flushdb()
+    await app.state.redis.aclose()
+
+
+async def bench_orar(n: int, requests: int):
+    for i in range(len(ApiOrar.activitati), n):
+        inregistreaza_activitate(Activitate(id=i, nume=f"Activitate {i}", durata=1, profesor=f"Profesor {i % 500}", sala=f"S{i}",
+                                            zi=list(Zile)[i % 7], ora=1 + i % 24, categorie=list(Categorie)[i % 3]))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=ApiOrar.app), base_url="http://bench") as client:
+        await compare(client, f"/activitati ({n})", "/activitati", {}, requests)
+        await compare(client, f"/activitati?fields=id,sala,ora", "/activitati", {"fields": "id,sala,ora"}, requests)
+
+
+async def main(n: int, requests: int, db: int):
+    await bench_redis(n, requests, db)
+    await bench_orar(n, requests)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    db = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+    asyncio.run(main(n, requests, db))
@@ -0,0 +1,61 @@
+"""Compares the "json" and "hash" item storage formats of FastAPIRedis.py:
+memory used per item key (MEMORY USAGE) and the latency of a PATCH that changes only count.
+
+Usage: python BenchmarkStorage.py [items] [db]
+Needs a running Redis server. The given db (default 15) is FLUSHED before each format."""
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+import httpx
+
+import FastAPIRedis
+from FastAPIRedis import app, create_redis, prepare_redis, insert_item, Item, Category
+
+
+async def bench_format(storage: str, n: int, db: int) -> dict:
+    FastAPIRedis.ITEM_STORAGE = storage
+    app.state.redis = create_redis(db)
+    await app.state.redis.flushdb()
+    await prepare_redis()
+
+    for i in range(n):
+        category = Category.TOOLS if i % 2 else Category.CONSUMABLES
+        await insert_item(Item(name=f"Item {i}", price=round(random.uniform(1, 100), 2), count=random.randint(0, 500), id=i, category=category))
+
+    sample = random.sample(range(n), min(n, 1000))
+    async with app.state.redis.pipeline(transaction=False) as pipe:
+        for i in sample:
+            pipe.memory_usage(f"item:{i}")
+        memory = await pipe.execute()
+
+    latencies = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for i in sample:
+            start = time.perf_counter()
+            response = await client.patch(f"/items/{i}", params={"count": random.randint(0, 500)})
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    await app.state.redis.flushdb()
+    await app.state.redis.aclose()
+    latencies.sort()
+    return {
+        "bytes_per_key": statistics.mean(memory),
+        "patch_p50_ms": latencies[len(latencies) // 2] * 1000,
+        "patch_p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+async def main(n: int, db: int):
+    for storage in ("json", "hash"):
+        result = await bench_format(storage, n, db)
+        print(f"{storage:5} {result['bytes_per_key']:8.1f} bytes/key   PATCH count p50 {result['patch_p50_ms']:.3f} ms   p99 {result['patch_p99_ms']:.3f} ms")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    db = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    asyncio.run(main(n, db))
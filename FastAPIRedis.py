@@ -1,10 +1,26 @@
 from enum import Enum
 import uvicorn
-from fastapi import FastAPI, HTTPException, Path, Query
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, Header, HTTPException, Path, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 import redis.asyncio as redis
 import httpx
 import json
+import asyncio
+import time
+import base64
+import os
+import secrets
+from collections import OrderedDict
+from email.utils import formatdate
+from Metrics import Metrics
+from Profiling import Profiling
+
+#orjson is optional; pydantic_core (always installed with pydantic) is the fallback encoder for the fast path
+try:
+    from orjson import dumps
+except ImportError:
+    from pydantic_core import to_json as dumps
 
 app = FastAPI(
     title="FastAPI Redis",
@@ -12,6 +28,11 @@ app = FastAPI(
     version="0.1"
 )
 
+#Request latency and in-flight requests for every route, Redis and upstream timings, served on /metrics
+metrics = Metrics(app)
+#Sampling profiler switched on through /admin/profile, and the slow request log (see Profiling.py)
+profiling = Profiling(app)
+
 class Category(Enum):
     """Category of an item"""
     TOOLS = "tools"
@@ -35,85 +56,1099 @@ items = {
 
 Selection = dict[str,str|int|float|Category|None]
 
+#Page size used when a cursor is given without a limit, and the largest limit a client may ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(kind: str, position: int) -> str:
+    """Opaque cursor handed to clients; kind is "scan" for a Redis SCAN cursor and "id" for the last id returned"""
+    return base64.urlsafe_b64encode(f"{kind}:{position}".encode()).decode()
+
+def decode_cursor(cursor: str, kind: str) -> int:
+    try:
+        cursor_kind, position = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        if cursor_kind == kind:
+            return int(position)
+    except ValueError:
+        pass
+    raise HTTPException(status_code=400, detail=f"Invalid cursor.")
+
+
+#Invalidations are counted per slot of a fixed table rather than per key, so the counters never need
+#cleaning up; two keys sharing a slot only cost an occasional value that is not cached
+GENERATION_SLOTS = 4096
+
+class LRUCache:
+    """Bounded in-process cache of raw values in front of Redis. Evicts the least recently used
+    entries once the values add up to more than max_bytes, and forgets entries after ttl seconds.
+    A value read from Redis is cached with the generation taken before the read, and dropped
+    if the key was invalidated in the meantime, so a read racing a write cannot put the old value back"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generations = [0] * GENERATION_SLOTS
+        self.clears = 0
+
+    def generation(self, key: str) -> int:
+        """Changes whenever the key is invalidated or the cache cleared; taken before reading the value to cache"""
+        return self.clears + self.generations[hash(key) % GENERATION_SLOTS]
+
+    def get(self, key: str) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self.drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: bytes, generation: int | None = None):
+        if len(value) > self.max_bytes or (generation is not None and generation != self.generation(key)):
+            return
+        self.drop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def invalidate(self, key: str):
+        self.generations[hash(key) % GENERATION_SLOTS] += 1
+        self.drop(key)
+
+    def clear(self):
+        self.clears += 1
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+#L1 cache for /items/{item_id}, /catfact and /fish. Writes publish the changed key on L1_CHANNEL
+#so every worker drops its copy; the TTL bounds staleness if a message is ever missed
+L1_MAX_BYTES = int(os.environ.get("L1_MAX_BYTES", 16 * 1024 * 1024))
+L1_TTL = 30.0
+L1_CHANNEL = "l1:invalidate"
+l1_cache = LRUCache(L1_MAX_BYTES, L1_TTL)
+
+metrics.counter("l1_cache_hits_total", "Lookups served by the L1 cache", collect=lambda: {(): l1_cache.hits})
+metrics.counter("l1_cache_misses_total", "Lookups the L1 cache could not serve", collect=lambda: {(): l1_cache.misses})
+metrics.counter("l1_cache_evictions_total", "Entries evicted to stay under L1_MAX_BYTES", collect=lambda: {(): l1_cache.evictions})
+metrics.gauge("l1_cache_entries", "Entries in the L1 cache", collect=lambda: {(): len(l1_cache.entries)})
+metrics.gauge("l1_cache_bytes", "Bytes held by the L1 cache", collect=lambda: {(): l1_cache.size})
+
+async def listen_invalidations():
+    """Drop the L1 entries other workers changed; runs for the lifetime of the app"""
+    while True:
+        try:
+            #closing the pubsub gives its connection back, so a flapping Redis does not leak one per reconnect
+            async with app.state.redis.pubsub() as pubsub:
+                await pubsub.subscribe(L1_CHANNEL)
+                #anything published while we were not subscribed is lost, so start clean
+                l1_cache.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        l1_cache.invalidate(message["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            l1_cache.clear()
+            await asyncio.sleep(1)
+
+#Keys asked from Redis per SCAN call; each page is then fetched with a single MGET
+SCAN_BATCH_SIZE = 500
+
+#How items are stored under item:{id}:
+#  "json" - one string holding the whole item (model_dump_json)
+#  "hash" - one hash field per attribute, so a PATCH only writes the fields it changes
+#Switching formats on a database with items requires running MigrateItems.py first
+ITEM_STORAGE = os.environ.get("ITEM_STORAGE", "json")
+ITEM_FIELDS = ("name", "price", "count", "id", "category")
+
+#How each hash field is turned back into its JSON value
+FIELD_DECODERS = {"name": bytes.decode, "price": float, "count": int, "id": int, "category": bytes.decode}
+
+def encode_hash(item: dict) -> dict:
+    return {field: item[field] for field in ITEM_FIELDS}
+
+def decode_hash(raw: dict) -> dict:
+    return {field: FIELD_DECODERS[field](raw[field.encode()]) for field in ITEM_FIELDS}
+
+def parse_fields(fields: str | None) -> tuple[str, ...] | None:
+    """The comma separated `fields=` projection of a listing, or None for whole items"""
+    if fields is None:
+        return None
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in selected if field not in ITEM_FIELDS]
+    if unknown or not selected:
+        raise HTTPException(status_code=400, detail=f"Invalid fields {fields!r}, expected a comma separated subset of {', '.join(ITEM_FIELDS)}.")
+    return selected
+
+def project(item: dict, fields: tuple[str, ...] | None) -> dict:
+    return item if fields is None else {field: item[field] for field in fields}
+
+def raw_json_response(key: str, raw_items: list[bytes], headers: dict | None = None, **rest) -> Response:
+    """The fast path of the listings: {key: [items], **rest} built by joining already serialized items,
+    so nothing is parsed, validated or passed through jsonable_encoder"""
+    body = [b'{"', key.encode(), b'":[', b",".join(raw_items), b"]"]
+    for name, value in rest.items():
+        body += [b',"', name.encode(), b'":', dumps(value)]
+    body.append(b"}")
+    return Response(b"".join(body), media_type="application/json", headers=headers)
+
+def queue_write(pipe, item: dict):
+    """Queue the write of a whole item (as dumped to JSON) in the configured storage format"""
+    key = f"item:{item['id']}"
+    if ITEM_STORAGE == "hash":
+        pipe.hset(key, mapping=encode_hash(item))
+    else:
+        pipe.set(key, json.dumps(item, separators=(",", ":")))
+
+def queue_fetch(pipe, keys, fields: tuple[str, ...] | None = None):
+    """Queue the reads of the given item keys: one MGET, or one HGETALL per key for hashes.
+    With a projection hashes are read with HMGET, so only the chosen fields leave Redis"""
+    if ITEM_STORAGE == "hash" and fields is not None:
+        for key in keys:
+            pipe.hmget(key, fields)
+    elif ITEM_STORAGE == "hash":
+        for key in keys:
+            pipe.hgetall(key)
+    else:
+        pipe.mget(keys)
+
+def decode_fetched(results, fields: tuple[str, ...] | None = None, raw: bool = False) -> list[dict] | list[bytes]:
+    """Decode the results of queue_fetch, skipping items deleted in the meantime.
+    With raw=True the items are returned serialized; whole JSON items are then the stored bytes, untouched"""
+    if raw and ITEM_STORAGE == "json" and fields is None:
+        return [value for value in results[0] if value is not None]
+    if raw:
+        return [dumps(item) for item in decode_fetched(results, fields)]
+    if ITEM_STORAGE == "hash" and fields is not None:
+        return [
+            {field: FIELD_DECODERS[field](value) for field, value in zip(fields, values)}
+            for values in results if values[0] is not None
+        ]
+    if ITEM_STORAGE == "hash":
+        return [decode_hash(raw) for raw in results if raw]
+    return [project(json.loads(value), fields) for value in results[0] if value is not None]
+
+async def fetch_items(keys, fields: tuple[str, ...] | None = None, raw: bool = False) -> list[dict] | list[bytes]:
+    """Read the given item keys in one round trip"""
+    if not keys:
+        return []
+    async with app.state.redis.pipeline(transaction=False) as pipe:
+        queue_fetch(pipe, keys, fields)
+        return decode_fetched(await pipe.execute(), fields, raw)
+
+
+#Secondary indexes kept next to the items, so /chooseitem never has to scan item:*
+#  idx:item:all               sorted set of all ids, scored by the id so pages can start after any id
+#  idx:item:name:{name}       set of ids with that name
+#  idx:item:category:{cat}    set of ids in that category
+#  idx:item:count, idx:item:price   sorted sets of ids scored by count / price
+#  idx:item:stats             hash of running totals per category: {cat}:items (number of items),
+#                             {cat}:count (sum of count), {cat}:price (sum of price), {cat}:value (sum of price*count)
+ITEM_INDEX_PREFIX = "idx:item"
+ITEM_STATS = f"{ITEM_INDEX_PREFIX}:stats"
+#Holds ITEM_INDEX_VERSION once the indexes have been built from the items (see rebuild_indexes).
+#The version is bumped whenever the layout of the index keys changes, so older indexes are rebuilt
+ITEM_INDEX_BUILT = f"{ITEM_INDEX_PREFIX}:built"
+ITEM_INDEX_VERSION = "2"
+
+
+#Version of the whole item collection, kept apart from idx:item so rebuild_indexes leaves it alone
+#  items:version    bumped by every write, served as the ETag of the item listings
+#  items:modified   unix time of the last write, served as Last-Modified
+#  items:changes    sorted set of ids scored by the version of their last write, read by /changes
+#  items:stream     Redis Stream with one event per write (op, id, version and the item unless deleted),
+#                   trimmed to about ITEM_STREAM_MAXLEN entries and served by /events/items
+#  items:rebuild:lock     held by the worker running rebuild_indexes
+#  items:rebuild:idx:*    the indexes being rebuilt, renamed over idx:item:* when done;
+#                         items:rebuild:idx:keys is the set of those keys
+ITEM_COLLECTION = "items"
+ITEM_STREAM = f"{ITEM_COLLECTION}:stream"
+ITEM_STREAM_MAXLEN = int(os.environ.get("ITEM_STREAM_MAXLEN", 100000))
+
+#Lua functions shared by ITEM_SCRIPT and REBUILD_SCRIPT. The index functions take the prefix of the
+#index keys they write, idx:item or the prefix of the indexes being rebuilt
+ITEM_FUNCTIONS = """
+local function read_item(key, storage)
+    if storage == 'hash' then
+        local raw = redis.call('HGETALL', key)
+        if #raw == 0 then return nil end
+        local item = {}
+        for i = 1, #raw, 2 do item[raw[i]] = raw[i + 1] end
+        return item
+    end
+    local value = redis.call('GET', key)
+    if not value then return nil end
+    local item = cjson.decode(value)
+    -- cjson would round the numbers to 14 significant digits, so they are kept as their JSON text
+    -- (a key is the only place '"price":' can appear, a quote inside a string is escaped)
+    for _, field in ipairs({'price', 'count', 'id'}) do
+        item[field] = value:match('"' .. field .. '":([^,}]+)')
+    end
+    return item
+end
+
+local function stats_add(prefix, item, sign)
+    local price, count = tonumber(item.price), tonumber(item.count)
+    redis.call('HINCRBY', prefix .. ':stats', item.category .. ':items', sign)
+    redis.call('HINCRBY', prefix .. ':stats', item.category .. ':count', sign * count)
+    redis.call('HINCRBYFLOAT', prefix .. ':stats', item.category .. ':price', sign * price)
+    redis.call('HINCRBYFLOAT', prefix .. ':stats', item.category .. ':value', sign * price * count)
+end
+
+local function index_add(prefix, item)
+    stats_add(prefix, item, 1)
+    redis.call('ZADD', prefix .. ':all', item.id, item.id)
+    redis.call('SADD', prefix .. ':name:' .. item.name, item.id)
+    redis.call('SADD', prefix .. ':category:' .. item.category, item.id)
+    redis.call('ZADD', prefix .. ':count', item.count, item.id)
+    redis.call('ZADD', prefix .. ':price', item.price, item.id)
+end
+
+local function index_remove(prefix, item)
+    stats_add(prefix, item, -1)
+    redis.call('ZREM', prefix .. ':all', item.id)
+    redis.call('SREM', prefix .. ':name:' .. item.name, item.id)
+    redis.call('SREM', prefix .. ':category:' .. item.category, item.id)
+    redis.call('ZREM', prefix .. ':count', item.id)
+    redis.call('ZREM', prefix .. ':price', item.id)
+end
+
+-- index_add into the indexes being rebuilt, recording the keys written in {rebuild}:keys
+-- so the rebuild can rename or drop them without a SCAN
+local function rebuild_add(rebuild, item)
+    index_add(rebuild, item)
+    redis.call('SADD', rebuild .. ':keys', rebuild .. ':all', rebuild .. ':name:' .. item.name,
+               rebuild .. ':category:' .. item.category, rebuild .. ':count', rebuild .. ':price', rebuild .. ':stats')
+end
+"""
+
+#Every write of an item runs as this one script (EVALSHA), so it costs a single round trip
+#and concurrent writers can neither lose updates nor leave the indexes out of step with the items.
+#KEYS[1] is the item key; ARGV is the index prefix, the storage format, the mode
+#(insert | update | upsert | delete), the id, the L1 invalidation channel, the collection prefix,
+#the approximate length the event stream is trimmed to and then field/value pairs for the fields that were given.
+#Every write bumps the collection version, records it for the id in the changelog (see ITEM_COLLECTION)
+#and appends an event to the items:stream Redis Stream. While items:rebuild:lock exists the write
+#is applied to the indexes being rebuilt as well, so rebuild_indexes does not miss it or count it twice.
+#Returns {status} or {status, item as JSON}, status being added, updated, deleted, exists, missing or incomplete
+ITEM_SCRIPT = ITEM_FUNCTIONS + """
+local key = KEYS[1]
+local prefix, storage, mode, id, channel, collection, maxlen = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6], ARGV[7]
+local changes, changed = {}, {}
+for i = 8, #ARGV, 2 do
+    changes[ARGV[i]] = ARGV[i + 1]
+    table.insert(changed, ARGV[i])
+    table.insert(changed, ARGV[i + 1])
+end
+
+-- same field order and number style as Item.model_dump_json, so stored values read back identical.
+-- Numbers arrive as text (from ARGV, a hash field or the stored JSON) and are written back as given
+local function number(value, float)
+    local text = tostring(value)
+    if float and not text:find('[%.eEn]') then text = text .. '.0' end
+    return text
+end
+
+local function encode(item)
+    return '{"name":' .. cjson.encode(item.name) .. ',"price":' .. number(item.price, true) ..
+           ',"count":' .. number(item.count) .. ',"id":' .. number(item.id) ..
+           ',"category":' .. cjson.encode(item.category) .. '}'
+end
+
+local function write_item(item)
+    if storage == 'hash' then
+        redis.call('HSET', key, 'name', item.name, 'price', item.price, 'count', item.count,
+                   'id', item.id, 'category', item.category)
+    else
+        redis.call('SET', key, encode(item))
+    end
+end
+
+local rebuild = collection .. ':rebuild:idx'
+local rebuilding = redis.call('EXISTS', collection .. ':rebuild:lock') == 1
+
+local function unindex(item)
+    index_remove(prefix, item)
+    -- an item the rebuild has not reached yet is not in its indexes
+    if rebuilding and redis.call('ZSCORE', rebuild .. ':all', item.id) then index_remove(rebuild, item) end
+end
+
+local function reindex(item)
+    index_add(prefix, item)
+    if rebuilding then rebuild_add(rebuild, item) end
+end
+
+local function record_change(op, encoded)
+    local version = redis.call('INCR', collection .. ':version')
+    redis.call('ZADD', collection .. ':changes', version, id)
+    redis.call('SET', collection .. ':modified', redis.call('TIME')[1])
+    if encoded then
+        redis.call('XADD', collection .. ':stream', 'MAXLEN', '~', maxlen, '*', 'op', op, 'id', id, 'version', version, 'item', encoded)
+    else
+        redis.call('XADD', collection .. ':stream', 'MAXLEN', '~', maxlen, '*', 'op', op, 'id', id, 'version', version)
+    end
+    redis.call('PUBLISH', channel, key)
+end
+
+local item = read_item(key, storage)
+
+if mode == 'delete' then
+    if not item then return {'missing'} end
+    redis.call('DEL', key)
+    unindex(item)
+    record_change('deleted')
+    return {'deleted', encode(item)}
+end
+
+if item then
+    if mode == 'insert' then return {'exists'} end
+    unindex(item)
+    for field, value in pairs(changes) do item[field] = value end
+    if storage == 'hash' then
+        redis.call('HSET', key, unpack(changed))
+    else
+        write_item(item)
+    end
+    reindex(item)
+    local encoded = encode(item)
+    record_change('updated', encoded)
+    return {'updated', encoded}
+end
+
+if mode == 'update' then return {'missing'} end
+if not (changes.name and changes.price and changes.count and changes.category) then return {'incomplete'} end
+item = {name = changes.name, price = changes.price, count = changes.count, id = id, category = changes.category}
+write_item(item)
+reindex(item)
+local encoded = encode(item)
+record_change('added', encoded)
+return {'added', encoded}
+"""
+
+def item_script_args(mode: str, item_id: int, **fields) -> list:
+    args = [ITEM_INDEX_PREFIX, ITEM_STORAGE, mode, item_id, L1_CHANNEL, ITEM_COLLECTION, ITEM_STREAM_MAXLEN]
+    for field, value in fields.items():
+        if value is not None:
+            args += [field, value.value if isinstance(value, Category) else value]
+    return args
+
+def decode_script_result(result) -> tuple[str, Item | None]:
+    return result[0].decode(), Item(**json.loads(result[1])) if len(result) > 1 else None
+
+async def run_item_script(mode: str, item_id: int, **fields) -> tuple[str, Item | None]:
+    """Run ITEM_SCRIPT for one item; fields that are None are left untouched"""
+    key = f"item:{item_id}"
+    result = await app.state.item_script(keys=[key], args=item_script_args(mode, item_id, **fields))
+    #the other workers drop their copy when the script's PUBLISH reaches them, this one does it right away
+    l1_cache.invalidate(key)
+    return decode_script_result(result)
+
+async def execute_item_scripts(pipe, calls: list[tuple[str, int, dict]]) -> list[tuple[str, Item | None]]:
+    """Queue ITEM_SCRIPT for many items on a pipeline and execute it. In a MULTI started under WATCH
+    the execute raises redis.WatchError, and nothing is written, if a watched key changed since the WATCH"""
+    for mode, item_id, fields in calls:
+        await app.state.item_script(keys=[f"item:{item_id}"], args=item_script_args(mode, item_id, **fields), client=pipe)
+    results = await pipe.execute()
+    for _, item_id, _ in calls:
+        l1_cache.invalidate(f"item:{item_id}")
+    return [decode_script_result(result) for result in results]
+
+async def run_item_scripts(calls: list[tuple[str, int, dict]]) -> list[tuple[str, Item | None]]:
+    """Run ITEM_SCRIPT for many items in a single pipeline, without a transaction"""
+    async with app.state.redis.pipeline(transaction=False) as pipe:
+        return await execute_item_scripts(pipe, calls)
+
+
+REBUILD_LOCK = f"{ITEM_COLLECTION}:rebuild:lock"
+REBUILD_PREFIX = f"{ITEM_COLLECTION}:rebuild:idx"
+#Seconds the lock outlives a worker that died while rebuilding; every batch renews it
+REBUILD_LOCK_TTL = 60
+
+#The steps of rebuild_indexes, each run only while ARGV[2] still holds the lock (returns 0 otherwise).
+#ARGV is the lock, its token, the step, the index prefix, the rebuild prefix, the storage format, the lock ttl
+#and the index version.
+#  clear   drops what a previous, interrupted rebuild left in the rebuild keys
+#  batch   indexes the items KEYS into the rebuild keys, skipping the ones a write already put there
+#  swap    deletes the live index keys given after the version, renames the rebuild keys over them and releases the lock
+REBUILD_SCRIPT = ITEM_FUNCTIONS + """
+local lock, token, step, prefix, rebuild, storage, ttl, version = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6], ARGV[7], ARGV[8]
+if redis.call('GET', lock) ~= token then return 0 end
+local registry = rebuild .. ':keys'
+
+if step == 'clear' then
+    for _, key in ipairs(redis.call('SMEMBERS', registry)) do redis.call('DEL', key) end
+    redis.call('DEL', registry)
+elseif step == 'batch' then
+    for _, key in ipairs(KEYS) do
+        local item = read_item(key, storage)
+        if item and not redis.call('ZSCORE', rebuild .. ':all', item.id) then rebuild_add(rebuild, item) end
+    end
+elseif step == 'swap' then
+    for i = 9, #ARGV do redis.call('DEL', ARGV[i]) end
+    for _, key in ipairs(redis.call('SMEMBERS', registry)) do
+        if redis.call('EXISTS', key) == 1 then redis.call('RENAME', key, prefix .. string.sub(key, #rebuild + 1)) end
+    end
+    redis.call('DEL', registry, lock)
+    redis.call('SET', prefix .. ':built', version)
+    return 1
+end
+redis.call('EXPIRE', lock, ttl)
+return 1
+"""
+
+async def rebuild_indexes() -> bool:
+    """Rebuild the indexes from the stored items. Only the worker that takes REBUILD_LOCK rebuilds; it builds
+    under REBUILD_PREFIX, with ITEM_SCRIPT applying concurrent writes there too, and renames the result over
+    idx:item in one step. The others wait for the lock to go away.
+    Returns whether this worker rebuilt them"""
+    token = secrets.token_hex(16)
+    if not await app.state.redis.set(REBUILD_LOCK, token, nx=True, ex=REBUILD_LOCK_TTL):
+        while await app.state.redis.exists(REBUILD_LOCK):
+            await asyncio.sleep(0.1)
+        return False
+
+    async def step(name: str, keys=(), *args) -> bool:
+        args = [REBUILD_LOCK, token, name, ITEM_INDEX_PREFIX, REBUILD_PREFIX, ITEM_STORAGE, REBUILD_LOCK_TTL, ITEM_INDEX_VERSION, *args]
+        return await app.state.rebuild_script(keys=list(keys), args=args) == 1
+
+    if not await step("clear"):
+        return False
+    cursor = 0
+    while True:
+        cursor, keys = await app.state.redis.scan(cursor=cursor, match="item:*", count=SCAN_BATCH_SIZE)
+        #the lock expired in the middle, another worker may have taken over
+        if keys and not await step("batch", keys):
+            return False
+        if cursor == 0:
+            break
+    live = [key async for key in app.state.redis.scan_iter(match=f"{ITEM_INDEX_PREFIX}:*")]
+    return await step("swap", (), *live)
+
 
 async def insert_item(item: Item):
-    key = f"item:{item.id}"
-    value = item.model_dump_json()
-    return await app.state.redis.set(key,value)
+    """Create the item unless one with the same id exists; returns whether it was created"""
+    status, _ = await run_item_script("insert", item.id, name=item.name, price=item.price, count=item.count, category=item.category)
+    return status == "added"
 
 async def update_item(item_id,name,price,count,category):
-    key = f"item:{item_id}"
-    item_data = await app.state.redis.get(key)
-    item_data = json.loads(item_data)
+    """Update the given fields of an existing item; returns the updated item, or None if it does not exist"""
+    _, item = await run_item_script("update", item_id, name=name, price=price, count=count, category=category)
+    return item
+
+async def upsert_item(item_id,name,price,count,category):
+    """Update the item, or create it if it does not exist and all fields were given.
+    Returns the status (updated, added or incomplete) and the item"""
+    return await run_item_script("upsert", item_id, name=name, price=price, count=count, category=category)
+
+
+async def delete_item_by_id(id: int):
+    """Delete the item; returns it, or None if it did not exist"""
+    _, item = await run_item_script("delete", id)
+    return item
+
+async def return_hashes(batch_size: int = SCAN_BATCH_SIZE, fields: tuple[str, ...] | None = None, raw: bool = False):
+    """Return all items and the number of round trips to Redis it took.
+    The fetch of one SCAN page is sent in the same pipeline as the SCAN for the next page"""
+    items = []
+    round_trips = 0
+    cursor = 0
+    pending = []
+    scanning = True
+    while scanning or pending:
+        async with app.state.redis.pipeline(transaction=False) as pipe:
+            if scanning:
+                pipe.scan(cursor=cursor, match="item:*", count=batch_size)
+            if pending:
+                queue_fetch(pipe, pending, fields)
+            results = await pipe.execute()
+        round_trips += 1
+        if pending:
+            items.extend(decode_fetched(results[1:] if scanning else results, fields, raw))
+            pending = []
+        if scanning:
+            cursor, pending = results[0]
+            scanning = cursor != 0
+    return items, round_trips
+
+async def return_hashes_page(cursor: int, limit: int, fields: tuple[str, ...] | None = None, raw: bool = False):
+    """One page of items starting at a SCAN cursor, and the cursor of the next page (0 when done).
+    limit is passed to SCAN as COUNT, so like SCAN itself a page holds roughly, not exactly, limit items"""
+    while True:
+        cursor, keys = await app.state.redis.scan(cursor=cursor, match="item:*", count=limit)
+        if keys or cursor == 0:
+            break
+    return await fetch_items(keys, fields, raw), cursor
+
+async def stream_hashes(batch_size: int = SCAN_BATCH_SIZE, fields: tuple[str, ...] | None = None):
+    """Yield the stored items as NDJSON, one chunk per SCAN page, so only a single page is ever held in memory.
+    Whole JSON items are passed through as stored; hashes and projections are decoded first"""
+    cursor = 0
+    while True:
+        cursor, keys = await app.state.redis.scan(cursor=cursor, match="item:*", count=batch_size)
+        if keys and (ITEM_STORAGE == "hash" or fields is not None):
+            items = await fetch_items(keys, fields)
+            if items:
+                yield "".join(json.dumps(item, separators=(",", ":")) + "\n" for item in items).encode()
+        elif keys:
+            values = [value for value in await app.state.redis.mget(keys) if value is not None]
+            if values:
+                yield b"\n".join(values) + b"\n"
+        if cursor == 0:
+            break
+
+async def return_hashes_by_params(name,price,count,category,price_min=None,price_max=None,count_min=None,count_max=None,after=None,limit=None,fields=None,raw=False):
+    """Resolve the filters on the index sets on the server, then fetch only the matching items in one more round trip.
+    Without filters the page is read straight from idx:item:all; with filters the score ranges are copied
+    with ZRANGESTORE and intersected with the sets and idx:item:all by ZINTERSTORE into a temporary sorted set
+    scored by id, which is paged and deleted in the same transaction.
+    Items come ordered by id; with a limit only the first limit ids greater than after are fetched.
+    Returns the items and the last id of the page if there are more matches after it, else None"""
+    sets = []
     if name is not None:
-        item_data["name"] = name
+        sets.append(f"{ITEM_INDEX_PREFIX}:name:{name}")
+    if category is not None:
+        sets.append(f"{ITEM_INDEX_PREFIX}:category:{category.value}")
     if price is not None:
-        item_data["price"]= price
+        price_min = price_max = price
     if count is not None:
-        item_data["name"] = count
-    if category is not None:
-        item_data["category"] = category
-    item = Item(**item_data)
-    value = item.model_dump_json()
-    if await app.state.redis.set(key, value) is True:
-        return item
+        count_min = count_max = count
+    ranges = [
+        (f"{ITEM_INDEX_PREFIX}:{field}", low, high)
+        for field, low, high in (("price", price_min, price_max), ("count", count_min, count_max))
+        if low is not None or high is not None
+    ]
+
+    #one more id than the page tells whether there is a next page
+    page = {} if limit is None else {"start": 0, "num": limit + 1}
+    low = "-inf" if after is None else f"({after}"
+    if not sets and not ranges:
+        ids = await app.state.redis.zrangebyscore(f"{ITEM_INDEX_PREFIX}:all", low, "+inf", **page)
     else:
-        return False
+        query = f"{ITEM_COLLECTION}:query:{secrets.token_hex(8)}"
+        temporary = [query]
+        #the weights keep only the score of idx:item:all, the id
+        weights = {f"{ITEM_INDEX_PREFIX}:all": 1, **dict.fromkeys(sets, 0)}
+        async with app.state.redis.pipeline(transaction=True) as pipe:
+            for index, (key, range_low, range_high) in enumerate(ranges):
+                temporary.append(f"{query}:{index}")
+                pipe.zrangestore(temporary[-1], key, "-inf" if range_low is None else range_low,
+                                 "+inf" if range_high is None else range_high, byscore=True)
+                weights[temporary[-1]] = 0
+            pipe.zinterstore(query, weights)
+            pipe.zrangebyscore(query, low, "+inf", **page)
+            pipe.delete(*temporary)
+            ids = (await pipe.execute())[-2]
 
+    ids = [int(id) for id in ids]
+    next_after = None
+    if limit is not None and len(ids) > limit:
+        ids = ids[:limit]
+        next_after = ids[-1]
+    if not ids:
+        return [], None
+    return await fetch_items([f"item:{id}" for id in ids], fields, raw), next_after
 
-async def delete_item_by_id(id: int):
-    #return await app.state.redis.delete(f"item:{id}")
-    item = await app.state.redis.execute_command("GETDEL", f"item:{id}")
-    return json.loads(item)
-async def exists_item(item: Item):
-    return await app.state.redis.exists(f"item:{item.id}")
+async def return_item(id: int):
+    key = f"item:{id}"
+    cached = l1_cache.get(key)
+    if cached is not None:
+        return json.loads(cached)
+    generation = l1_cache.generation(key)
+    items = await fetch_items([key])
+    if not items:
+        return None
+    l1_cache.set(key, json.dumps(items[0]).encode(), generation)
+    return items[0]
 
-async def exists_id(id: int):
-    return await app.state.redis.exists(f"item:{id}")
 
-async def return_hashes():
-    items = []
-    async for key in app.state.redis.scan_iter(type=str, match="item:*"):
-        value = await app.state.redis.get(key)
-        items.append(json.loads(value))
-    return items
+#BULK------------------------------------------------------------------------
+#Largest number of records a single bulk request may carry
+MAX_BULK_SIZE = 10000
 
-async def return_hashes_by_params(name,price,count,category):
-    items = []
-    item = 0
-    async for key in app.state.redis.scan_iter(type=str, match="item:*"):
-        item = await app.state.redis.get(key)
-        item = json.loads(item)
-        if all(
-            (
-                name is None or item["name"] == name,
-                price is None or item["price"] == price,
-                count is None or item["count"] == count,
-                category is None or item["category"] is category
-            )
-        ) == 1:
-            items.append(item)
-    return items
+async def read_records(request: Request) -> list:
+    """Body of a bulk request: a JSON array, or NDJSON (one record per line) when sent as application/x-ndjson"""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            records = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid body: {e}")
+    if not isinstance(records, list):
+        raise HTTPException(status_code=400, detail=f"The body must be an array of records.")
+    if len(records) > MAX_BULK_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_SIZE} records per request.")
+    return records
 
+def validate_records(records: list, model: type[BaseModel]):
+    """Validate every record in one pass. Returns the valid (position, record) pairs and the errors by position"""
+    valid, errors = [], {}
+    seen = set()
+    for position, record in enumerate(records):
+        try:
+            record = model.model_validate(record)
+        except ValidationError as e:
+            errors[position] = json.loads(e.json(include_url=False))
+            continue
+        if record.id in seen:
+            errors[position] = f"Item with id={record.id} appears more than once in the request."
+            continue
+        seen.add(record.id)
+        valid.append((position, record))
+    return valid, errors
 
+async def bulk_write(valid: list, errors: dict, mode: str, atomic: bool, must_exist: bool | None) -> dict:
+    """Run one ITEM_SCRIPT mode over validated records in a single pipeline and report a result per record.
+    In atomic mode nothing is written unless every record is valid and every key exists (must_exist=True)
+    or none does (must_exist=False). The keys are watched before they are checked, on the connection
+    that then runs the writes as one MULTI/EXEC, so a write to any of them in between fails the whole batch"""
+    keys = [f"item:{record.id}" for _, record in valid]
+    calls = [
+        (mode, record.id, {} if mode == "delete" else record.model_dump(exclude={"id"}))
+        for _, record in valid
+    ]
+    results = {position: {"index": position, "status": "error", "detail": detail} for position, detail in errors.items()}
 
-async def return_item(id: int):
-    item = await app.state.redis.get(f"item:{id}")
-    return json.loads(item)
+    def report(written: int) -> dict:
+        return {"results": [results[position] for position in sorted(results)], "written": written}
+
+    if atomic and errors:
+        for position, record in valid:
+            results[position] = {"index": position, "id": record.id, "status": "skipped"}
+        return report(0)
+
+    if not calls:
+        outcomes = []
+    elif not atomic:
+        outcomes = await run_item_scripts(calls)
+    else:
+        async with app.state.redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(*keys)
+            #in watching mode the pipeline runs commands right away; one EXISTS over all keys counts them
+            found = await pipe.exists(*keys) if must_exist is not None else None
+            if found is not None and found != (len(keys) if must_exist else 0):
+                #nothing is written, so which keys clash is read outside the watch, in one more round trip
+                async with app.state.redis.pipeline(transaction=False) as check:
+                    for key in keys:
+                        check.exists(key)
+                    found = await check.execute()
+                clash = "missing" if must_exist else "exists"
+                for (position, record), present in zip(valid, found):
+                    results[position] = {"index": position, "id": record.id, "status": clash if bool(present) != must_exist else "skipped"}
+                return report(0)
+            pipe.multi()
+            try:
+                outcomes = await execute_item_scripts(pipe, calls)
+            except redis.WatchError:
+                raise HTTPException(status_code=409, detail=f"Items changed while the request was running, nothing was written.")
+
+    written = 0
+    for (position, record), (status, _) in zip(valid, outcomes):
+        results[position] = {"index": position, "id": record.id, "status": status}
+        written += status in ("added", "updated", "deleted")
+    return report(written)
+
+class ItemId(BaseModel):
+    """Record of a bulk delete"""
+    id: int = Field(description="Unique identifier of the item", ge=0)
+
+@app.post("/items/bulk")
+async def add_items(request: Request, atomic: bool = False) -> dict[str, list[dict] | int]:
+    """Create many items (JSON array or NDJSON) in one pipeline; existing ids are reported, not overwritten"""
+    valid, errors = validate_records(await read_records(request), Item)
+    return await bulk_write(valid, errors, "insert", atomic, must_exist=False)
+
+@app.put("/items/bulk")
+async def upsert_items(request: Request, atomic: bool = False) -> dict[str, list[dict] | int]:
+    """Create or fully replace many items in one pipeline"""
+    valid, errors = validate_records(await read_records(request), Item)
+    return await bulk_write(valid, errors, "upsert", atomic, must_exist=None)
+
+@app.delete("/items/bulk")
+async def delete_items(request: Request, atomic: bool = False) -> dict[str, list[dict] | int]:
+    """Delete many items given as an array of ids (or of {"id": ...} records)"""
+    records = [{"id": record} if isinstance(record, int) else record for record in await read_records(request)]
+    valid, errors = validate_records(records, ItemId)
+    return await bulk_write(valid, errors, "delete", atomic, must_exist=True)
+
+
+#STATS----------------------------------------------------------------------
+class StatsSource(Enum):
+    """Where /stats takes its numbers from"""
+    AUTO = "auto"
+    AGGREGATES = "aggregates"
+    SCAN = "scan"
+
+class RankBy(Enum):
+    """Sorted set index /stats/top ranks by"""
+    COUNT = "count"
+    PRICE = "price"
+
+def summarize(totals: dict[str, dict[str, float]]) -> dict:
+    """Per category and overall numbers from running totals (items, count, price, value) per category"""
+    categories = {}
+    for category, total in sorted(totals.items()):
+        items = int(total["items"])
+        if items <= 0:
+            continue
+        categories[category] = {
+            "items": items,
+            "count": int(total["count"]),
+            "value": round(total["value"], 2),
+            "average_price": round(total["price"] / items, 2),
+            "average_count": round(total["count"] / items, 2),
+        }
+    items = sum(category["items"] for category in categories.values())
+    count = sum(category["count"] for category in categories.values())
+    price = sum(totals[category]["price"] for category in categories)
+    overall = {
+        "items": items,
+        "count": count,
+        "value": round(sum(totals[category]["value"] for category in categories), 2),
+        "average_price": round(price / items, 2) if items else 0.0,
+        "average_count": round(count / items, 2) if items else 0.0,
+    }
+    return {"total": overall, "categories": categories}
+
+async def aggregate_totals() -> dict[str, dict[str, float]] | None:
+    """The running totals kept in idx:item:stats by every write, or None if the hash is missing"""
+    raw = await app.state.redis.hgetall(ITEM_STATS)
+    if not raw:
+        return None
+    totals = {}
+    for field, value in raw.items():
+        category, name = field.decode().rsplit(":", 1)
+        totals.setdefault(category, {"items": 0, "count": 0, "price": 0.0, "value": 0.0})[name] = float(value)
+    return totals
+
+async def scan_totals() -> dict[str, dict[str, float]]:
+    """The same totals computed by reading every item"""
+    items, _ = await return_hashes()
+    totals = {}
+    for item in items:
+        total = totals.setdefault(item["category"], {"items": 0, "count": 0, "price": 0.0, "value": 0.0})
+        total["items"] += 1
+        total["count"] += item["count"]
+        total["price"] += item["price"]
+        total["value"] += item["price"] * item["count"]
+    return totals
+
+@app.get("/stats")
+async def inventory_stats(source: StatsSource = StatsSource.AUTO) -> dict[str, dict | str]:
+    """Stock value (sum of price*count), item counts and averages, overall and per category.
+    Read from the running totals in one HGETALL; source=scan recomputes them from all items,
+    which is also what auto falls back to when the totals are missing"""
+    totals = None if source is StatsSource.SCAN else await aggregate_totals()
+    if totals is None and source is StatsSource.AGGREGATES:
+        raise HTTPException(status_code=503, detail=f"Running totals are not available.")
+    used = StatsSource.AGGREGATES
+    if totals is None:
+        totals, used = await scan_totals(), StatsSource.SCAN
+    return {**summarize(totals), "source": used.value}
+
+@app.get("/stats/top")
+async def top_items(
+        by: RankBy = RankBy.COUNT,
+        n: int = Query(default=10, ge=1, le=MAX_PAGE_SIZE),
+        ascending: bool = False) -> dict[str, list[dict]]:
+    """The n items with the highest (or lowest) count or price, straight from the sorted set index"""
+    key = f"{ITEM_INDEX_PREFIX}:{by.value}"
+    ids = await (app.state.redis.zrange(key, 0, n - 1) if ascending else app.state.redis.zrevrange(key, 0, n - 1))
+    items = {item["id"]: item for item in await fetch_items([f"item:{int(id)}" for id in ids])}
+    return {"items": [items[int(id)] for id in ids if int(id) in items]}
+
+@app.get("/stats/low-stock")
+async def low_stock_items(
+        threshold: int = Query(default=5, ge=0),
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)) -> dict[str, list[dict]]:
+    """Items whose count is at most threshold, lowest first, from the count index"""
+    ids = await app.state.redis.zrangebyscore(f"{ITEM_INDEX_PREFIX}:count", "-inf", threshold, start=0, num=limit)
+    items = {item["id"]: item for item in await fetch_items([f"item:{int(id)}" for id in ids])}
+    return {"items": [items[int(id)] for id in ids if int(id) in items]}
+
+
+#EVENTS---------------------------------------------------------------------
+#Events a subscriber may fall behind by before it is cut off (it then reconnects with Last-Event-ID),
+#and seconds between keepalive comments on an idle connection
+EVENT_QUEUE_SIZE = 1000
+EVENT_KEEPALIVE = 15.0
+#Marks a subscriber that was cut off because its queue filled up
+LAGGED = object()
+
+def stream_id(entry_id: str) -> tuple[int, int]:
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+def format_event(entry_id: bytes, fields: dict) -> tuple[str, str]:
+    """An item stream entry as a server-sent event, with the entry id as the SSE id"""
+    entry_id = entry_id.decode()
+    data = {"op": fields[b"op"].decode(), "id": int(fields[b"id"]), "version": int(fields[b"version"])}
+    data_json = json.dumps(data, separators=(",", ":"))
+    if b"item" in fields:
+        data_json = data_json[:-1] + ',"item":' + fields[b"item"].decode() + "}"
+    return entry_id, f"id: {entry_id}\nevent: {data['op']}\ndata: {data_json}\n\n"
+
+class EventBroadcaster:
+    """Tails the item stream with one XREAD per worker and fans every event out to the subscribers.
+    Each subscriber has a bounded queue; one that lets it fill up is cut off instead of slowing the others"""
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: set[asyncio.Queue] = set()
+        self.task: asyncio.Task | None = None
+
+    def subscribe(self) -> asyncio.Queue:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(LAGGED)
+
+    async def run(self):
+        last_id = "$"
+        while True:
+            try:
+                response = await app.state.redis.xread({ITEM_STREAM: last_id}, count=500, block=5000)
+                for _, entries in response:
+                    for entry_id, fields in entries:
+                        last_id = entry_id
+                        self.publish(format_event(entry_id, fields))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(1)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+event_broadcaster = EventBroadcaster()
+
+async def replay_events(after: str):
+    """Events after the given stream id, read in pages with XRANGE"""
+    while True:
+        entries = await app.state.redis.xrange(ITEM_STREAM, min=f"({after}", count=500)
+        for entry_id, fields in entries:
+            yield format_event(entry_id, fields)
+        if len(entries) < 500:
+            return
+        after = entries[-1][0].decode()
+
+async def broadcast_events(request: Request, last_event_id: str | None):
+    """SSE body for a plain subscriber: the missed events first (when reconnecting), then the live ones"""
+    queue = event_broadcaster.subscribe()
+    try:
+        last_sent = None
+        if last_event_id is not None:
+            async for entry_id, event in replay_events(last_event_id):
+                last_sent = stream_id(entry_id)
+                yield event
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is LAGGED:
+                yield "event: lagged\ndata: {}\n\n"
+                return
+            entry_id, event = event
+            #live events queued while the replay was running may already have been sent
+            if last_sent is None or stream_id(entry_id) > last_sent:
+                yield event
+    finally:
+        event_broadcaster.unsubscribe(queue)
+
+async def group_events(request: Request, group: str, consumer: str):
+    """SSE body for a member of a consumer group: each event goes to only one consumer of the group,
+    and is acknowledged once it has been handed to the connection"""
+    try:
+        await app.state.redis.xgroup_create(ITEM_STREAM, group, id="$", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    #entries delivered to this consumer before a disconnect but never acknowledged come first
+    pending = "0"
+    while not await request.is_disconnected():
+        response = await app.state.redis.xreadgroup(group, consumer, {ITEM_STREAM: pending}, count=100,
+                                                    block=None if pending == "0" else int(EVENT_KEEPALIVE * 1000))
+        entries = [entry for _, stream_entries in response or [] for entry in stream_entries]
+        if not entries:
+            if pending == "0":
+                pending = ">"
+            else:
+                yield ": keepalive\n\n"
+            continue
+        for entry_id, fields in entries:
+            #entries trimmed from the stream while pending come back without fields
+            if fields:
+                yield format_event(entry_id, fields)[1]
+        await app.state.redis.xack(ITEM_STREAM, group, *[entry_id for entry_id, _ in entries])
+
+@app.get("/events/items")
+async def item_events(
+        request: Request,
+        last_event_id: str | None = Header(default=None),
+        group: str | None = Query(default=None, description="Consumer group; each event then goes to one consumer of the group"),
+        consumer: str | None = Query(default=None, description="Name of this consumer within the group")):
+    """Server-sent events for every item write: added, updated (both with the item) and deleted.
+    A subscriber that falls more than EVENT_QUEUE_SIZE events behind gets a `lagged` event and is disconnected;
+    reconnecting with Last-Event-ID replays what it missed while the stream still holds it"""
+    if last_event_id is not None:
+        try:
+            stream_id(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid Last-Event-ID.")
+    if (group is None) != (consumer is None):
+        raise HTTPException(status_code=400, detail=f"group and consumer must be given together.")
+    body = group_events(request, group, consumer) if group is not None else broadcast_events(request, last_event_id)
+    return StreamingResponse(body, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+#CONDITIONAL GET------------------------------------------------------------
+#Responses of these paths only depend on the items, so they are tagged with the collection version.
+#Single items are not: /items/{item_id} is served from L1 without going to Redis, which reading the version would undo
+VERSIONED_PATHS = ("/items", "/chooseitem", "/testing", "/changes", "/stats", "/stats/top", "/stats/low-stock")
+
+async def collection_version() -> tuple[int, int | None]:
+    """The collection version and the unix time of the last write, in one round trip"""
+    version, modified = await app.state.redis.mget(f"{ITEM_COLLECTION}:version", f"{ITEM_COLLECTION}:modified")
+    return int(version or 0), int(modified) if modified is not None else None
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    """ETag/Last-Modified from the collection version; a matching If-None-Match gets a 304
+    before the handler runs, so nothing but the version is read from Redis"""
+    path = request.url.path
+    if request.method not in ("GET", "HEAD") or path not in VERSIONED_PATHS:
+        return await call_next(request)
+    version, modified = await collection_version()
+    headers = {"ETag": f'W/"{version}"'}
+    if modified is not None:
+        headers["Last-Modified"] = formatdate(modified, usegmt=True)
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
 
 
 #GET------------------------------------------------------------------------
+@app.get("/changes")
+async def query_changes(
+        since: int = Query(default=0, ge=0, description="Collection version the client already has"),
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE)) -> dict[str, int | bool | list[dict]]:
+    """Items written after version `since`, in version order. Deleted items come with deleted=true.
+    With a limit, `version` is that of the last change returned and `more` tells whether to ask again"""
+    async with app.state.redis.pipeline(transaction=True) as pipe:
+        pipe.get(f"{ITEM_COLLECTION}:version")
+        if limit is None:
+            pipe.zrangebyscore(f"{ITEM_COLLECTION}:changes", f"({since}", "+inf", withscores=True)
+        else:
+            pipe.zrangebyscore(f"{ITEM_COLLECTION}:changes", f"({since}", "+inf", start=0, num=limit + 1, withscores=True)
+        version, changed = await pipe.execute()
+    version = int(version or 0)
+    more = limit is not None and len(changed) > limit
+    if more:
+        changed = changed[:limit]
+        version = int(changed[-1][1])
+
+    items = {item["id"]: item for item in await fetch_items([f"item:{int(id)}" for id, _ in changed])}
+    changes = []
+    for id, changed_at in changed:
+        item = items.get(int(id))
+        change = {"id": int(id), "version": int(changed_at), "deleted": item is None}
+        if item is not None:
+            change["item"] = item
+        changes.append(change)
+    return {"version": version, "more": more, "changes": changes}
+
 @app.get("/items")
-async def index() -> dict[str,list[dict]]:
-    items = await return_hashes()
+async def index(
+        response: Response,
+        batch_size: int = Query(default=SCAN_BATCH_SIZE, ge=1, le=10000),
+        stream: bool = False,
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+        fields: str | None = Query(default=None, description="Comma separated fields to return, e.g. id,name"),
+        fast: bool = Query(default=False, description="Send the items as stored, without validating and re-encoding them")) -> dict[str,list[dict]|str|None]:
+    fields = parse_fields(fields)
+    if stream:
+        return StreamingResponse(stream_hashes(batch_size, fields), media_type="application/x-ndjson")
+    if cursor is not None or limit is not None:
+        position = decode_cursor(cursor, "scan") if cursor is not None else 0
+        items, position = await return_hashes_page(position, limit or DEFAULT_PAGE_SIZE, fields, raw=fast)
+        next_cursor = encode_cursor("scan", position) if position != 0 else None
+        if fast:
+            return raw_json_response("items", items, next_cursor=next_cursor)
+        result = {"items": items, "next_cursor": next_cursor}
+        #projected items are already plain JSON values, so they skip response model validation
+        return JSONResponse(result) if fields is not None else result
+    items, round_trips = await return_hashes(batch_size, fields, raw=fast)
+    if fast:
+        return raw_json_response("items", items, headers={"X-Redis-Round-Trips": str(round_trips)})
+    if fields is not None:
+        return JSONResponse({"items": items}, headers={"X-Redis-Round-Trips": str(round_trips)})
+    response.headers["X-Redis-Round-Trips"] = str(round_trips)
     return {"items":items}
 
 @app.get("/items/{item_id}")
-async def query_item_by_id(item_id: int = Path(ge=0)) -> dict[str,dict]:
-    if await exists_id(item_id) == 0:
-        raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
+async def query_item_by_id(
+        item_id: int = Path(ge=0),
+        fields: str | None = Query(default=None, description="Comma separated fields to return, e.g. id,name")) -> dict[str,dict]:
+    fields = parse_fields(fields)
     item = await return_item(item_id)
-    return {f"item with {item_id=}": item}
+    if item is None:
+        raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
+    return {f"item with {item_id=}": project(item, fields)}
 
 
 @app.get("/sth")
@@ -121,8 +1156,20 @@ def show_test_string() -> str:
     return "something"
 
 @app.get("/testing")
-async def query_all_items() -> list[dict]:
-    items = await return_hashes()
+async def query_all_items(
+        response: Response,
+        batch_size: int = Query(default=SCAN_BATCH_SIZE, ge=1, le=10000),
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE)) -> list[dict]:
+    if cursor is not None or limit is not None:
+        #the body is a bare list, so the next cursor travels in a header
+        position = decode_cursor(cursor, "scan") if cursor is not None else 0
+        items, position = await return_hashes_page(position, limit or DEFAULT_PAGE_SIZE)
+        if position != 0:
+            response.headers["X-Next-Cursor"] = encode_cursor("scan", position)
+        return items
+    items, round_trips = await return_hashes(batch_size)
+    response.headers["X-Redis-Round-Trips"] = str(round_trips)
     return items
 
 
@@ -131,26 +1178,49 @@ async def query_item_by_parameters(
         name: str | None = None,
         price: float | None = Query(default=None,ge=0),
         count: int | None = Query(default=None,ge=0),
-        category: Category | None = None) -> dict[str, dict|list]:
+        category: Category | None = None,
+        price_min: float | None = Query(default=None,ge=0),
+        price_max: float | None = Query(default=None,ge=0),
+        count_min: int | None = Query(default=None,ge=0),
+        count_max: int | None = Query(default=None,ge=0),
+        cursor: str | None = None,
+        limit: int | None = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+        fields: str | None = Query(default=None, description="Comma separated fields to return, e.g. id,name"),
+        fast: bool = Query(default=False, description="Send the items as stored, without validating and re-encoding them")) -> dict[str, dict|list|str|None]:
 
-    selection = await return_hashes_by_params(name=name,price=price,count=count,category=category)
-    return {
-        "query": {"name": name, "price": price, "count": count, "category": category},
+    fields = parse_fields(fields)
+    after = decode_cursor(cursor, "id") if cursor is not None else None
+    if cursor is not None and limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    selection, next_after = await return_hashes_by_params(name=name,price=price,count=count,category=category,
+                                                          price_min=price_min,price_max=price_max,count_min=count_min,count_max=count_max,
+                                                          after=after,limit=limit,fields=fields,raw=fast)
+    if fast:
+        query = {"name": name, "price": price, "count": count, "category": category,
+                 "price_min": price_min, "price_max": price_max, "count_min": count_min, "count_max": count_max}
+        extra = {"next_cursor": encode_cursor("id", next_after) if next_after is not None else None} if limit is not None else {}
+        return raw_json_response("selection", selection, query=query, **extra)
+    result = {
+        "query": {"name": name, "price": price, "count": count, "category": category,
+                  "price_min": price_min, "price_max": price_max, "count_min": count_min, "count_max": count_max},
         "selection": selection
     }
+    if limit is not None:
+        result["next_cursor"] = encode_cursor("id", next_after) if next_after is not None else None
+    if fields is not None:
+        result["query"]["category"] = category.value if category is not None else None
+        return JSONResponse(result)
+    return result
 
 
 #POST------------------------------------------------------------------------
 @app.post("/items")
 async def add_item(item: Item) -> dict[str, Item]:
 
-    if await exists_item(item):
-        raise HTTPException(status_code=400, detail=f"Item with {item.id=} already exists.")
-
     if await insert_item(item):
         return {"added":item}
     else:
-        raise HTTPException(status_code=400, detail=f"Something happened, item not added.")
+        raise HTTPException(status_code=400, detail=f"Item with {item.id=} already exists.")
 
 
 #PUT------------------------------------------------------------------------
@@ -165,18 +1235,9 @@ async def updateoradd(
     #    raise HTTPException(status_code=400, detail=f"Item with {item_id=} does not exist.")
     if all(info is None for info in (name, price, count, category)):
         raise HTTPException(status_code=400, detail=f"No parameters provided.")
-    if await exists_id(item_id):
-        item = await update_item(item_id=item_id, name=name, price=price, count=count, category=category)
-        if item is not None:
-            return {"updated": item}
-        else:
-            raise HTTPException(status_code=400, detail=f"Something happened, item not updated.")
-    elif all(info is not None for info in (name, price, count, category)):
-        item = Item(name=name, price=price, count=count, id=item_id, category=category)
-        if await insert_item(item):
-            return {"added": item}
-        else:
-            raise HTTPException(status_code=400, detail=f"Something happened, item not added.")
+    status, item = await upsert_item(item_id=item_id, name=name, price=price, count=count, category=category)
+    if status in ("updated", "added"):
+        return {status: item}
     else:
         raise HTTPException(status_code=400, detail=f"Item with {item_id=} does not exist and not all parameters were added for creating a new Item")
 
@@ -189,8 +1250,6 @@ async def update(
         price: float | None = Query(default=None,ge=0),
         count: int | None = Query(default=None,ge=0),
         category: Category | None = None):
-    if await exists_id(item_id) == 0:
-        raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
     if all(info is None for info in (name, price, count, category)):
         raise HTTPException(status_code=400, detail=f"No parameters provided for update.")
 
@@ -199,7 +1258,7 @@ async def update(
     if item is not None:
         return {"updated":item}
     else:
-        raise HTTPException(status_code=400, detail=f"Something happened, item not updated.")
+        raise HTTPException(status_code=404, detail=f"Item with {item_id=} does not exist.")
 
 
 
@@ -207,14 +1266,11 @@ async def update(
 @app.delete("/items/{item_id}")
 async def delete_item(item_id: int = Path(ge=0)) -> dict[str, Item]:
 
-    if await exists_id(item_id) == 0:
-        raise HTTPException(status_code=400, detail=f"The item with {item_id=} doesn't exist.")
-
     item = await delete_item_by_id(item_id)
     if item is not None:
         return {"deleted": item}
     else:
-        raise HTTPException(status_code=400, detail=f"Something happened, item was not deleted.")
+        raise HTTPException(status_code=400, detail=f"The item with {item_id=} doesn't exist.")
 
 
 print("Working")
@@ -224,44 +1280,105 @@ print("Working")
 
 
 #STEP 2 - CACHING
+def create_redis(db: int = 1):
+    pool = redis.ConnectionPool(host="127.0.0.1", port=int(6379), db=int(db), password="parola divina23^&")
+    return redis.Redis(connection_pool=pool)
+
+async def prepare_redis():
+    """Register the scripts on app.state.redis and build the indexes if they were never built, or by an older version"""
+    app.state.item_script = app.state.redis.register_script(ITEM_SCRIPT)
+    app.state.rebuild_script = app.state.redis.register_script(REBUILD_SCRIPT)
+    while await app.state.redis.get(ITEM_INDEX_BUILT) != ITEM_INDEX_VERSION.encode():
+        await rebuild_indexes()
+
 @app.on_event("startup")
 async def startup_event():
-    pool = redis.ConnectionPool(host="127.0.0.1", port=int(6379), db=int(1), password="parola divina23^&")
-    app.state.redis = redis.Redis(connection_pool=pool)
-    app.state.http_client = httpx.AsyncClient()
+    app.state.redis = metrics.instrument_redis(create_redis())
+    app.state.http_client = metrics.instrument_http_client(httpx.AsyncClient())
+    await prepare_redis()
+    app.state.invalidation_listener = asyncio.create_task(listen_invalidations())
 
 @app.on_event("shutdown")
 async def shutdown():
+    app.state.invalidation_listener.cancel()
+    event_broadcaster.stop()
     app.state.redis.close()
 
+#Upstream APIs behind /catfact and /fish, overridable so they can point at a local mock
+CATFACT_URL = os.environ.get("CATFACT_URL", "https://catfact.ninja/fact")
+FISHWATCH_URL = os.environ.get("FISHWATCH_URL", "https://www.fishwatch.gov/api/species")
+#Seconds an upstream answer is fresh, and how long after that it may still be served while it is refreshed
+CACHE_TTL = 1800
+CACHE_STALE_TTL = 600
+STALE_WHILE_REVALIDATE = os.environ.get("STALE_WHILE_REVALIDATE", "1") == "1"
+
+#Upstream fetches in progress, by cache key, so that concurrent misses share a single request
+in_flight: dict[str, asyncio.Task] = {}
+
+#Where each read of an upstream answer was served from: l1, redis, stale (while refreshing) or upstream (a miss)
+cache_lookups = metrics.counter("upstream_cache_lookups_total", "Reads of cached upstream answers by where they were served from", ("cache", "result"))
+
+async def fetch_upstream(key: str, url: str, not_found: str):
+    response = await app.state.http_client.get(url)
+    if response.text == "":
+        raise HTTPException(status_code=404, detail=not_found)
+    value = response.json()
+    entry = {"value": value, "fresh_until": time.time() + CACHE_TTL}
+    async with app.state.redis.pipeline(transaction=False) as pipe:
+        pipe.set(key, json.dumps(entry), ex=CACHE_TTL + CACHE_STALE_TTL)
+        pipe.publish(L1_CHANNEL, key)
+        await pipe.execute()
+    l1_cache.invalidate(key)
+    return value
+
+def start_fetch(key: str, url: str, not_found: str) -> asyncio.Task:
+    """Start the upstream fetch for a key, or join the one already running"""
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_upstream(key, url, not_found))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+        #background refreshes are never awaited, so their errors are collected here
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+    return task
+
+async def read_cached(cache: str, key: str, url: str, not_found: str):
+    """Cache-aside read of an upstream answer with single-flight fetches on a miss.
+    A stale answer is served as is while a refresh runs in the background.
+    `cache` names the upstream in the metrics"""
+    source = "l1"
+    cached = l1_cache.get(key)
+    if cached is None:
+        source = "redis"
+        generation = l1_cache.generation(key)
+        cached = await app.state.redis.get(key)
+        if cached is not None:
+            l1_cache.set(key, cached, generation)
+    if cached is not None:
+        entry = json.loads(cached)
+        if entry["fresh_until"] > time.time():
+            cache_lookups.inc(cache, source)
+            return entry["value"]
+        if STALE_WHILE_REVALIDATE:
+            cache_lookups.inc(cache, "stale")
+            start_fetch(key, url, not_found)
+            return entry["value"]
+    cache_lookups.inc(cache, "upstream")
+    #shielded so a client that disconnects does not cancel the fetch the others are waiting on
+    return await asyncio.shield(start_fetch(key, url, not_found))
+
+@app.get("/cache/stats")
+async def cache_stats() -> dict[str, int | float]:
+    return l1_cache.stats()
+
 #CATFACT
 @app.get("/catfact")
 async def read_item():
-    value = app.state.redis.get("catfact")
-
-    if value is None:
-        response = await app.state.http_client.get("https://catfact.ninja/fact")
-        value = response.json()
-        data_str = json.dumps(value)
-        app.state.redis.set("catfact", data_str, ex=1800)
-        return value
-
-    return json.loads(value)
+    return await read_cached("catfact", "catfact", CATFACT_URL, f"Cat fact not found")
 
 @app.get("/fish/{species}")
 async def read_fish(species: str):
-    value = app.state.redis.get(f"fish_{species}")
-
-    if value is None:
-        response = await app.state.http_client.get(f"https://www.fishwatch.gov/api/species/{species}")
-        if response.text == "":
-            raise HTTPException(status_code=404, detail=f"Species not found")
-        value = response.json()
-        data_str = json.dumps(value)
-        app.state.redis.set(f"fish_{species}", data_str, ex=1800)
-        return value
-
-    return json.loads(value)
+    return await read_cached("fish", f"fish_{species}", f"{FISHWATCH_URL}/{species}", f"Species not found")
 
 
 
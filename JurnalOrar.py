@@ -0,0 +1,173 @@
+"""Persistenta pentru activitatile din ApiOrar: un jurnal in care se adauga fiecare modificare (write-ahead log)
+si un snapshot compactat, din care starea este refacuta la pornire.
+
+In director sunt doua fisiere:
+    snapshot.bin - toata starea de la ultima compactare, ca lista de tuple serializata cu pickle
+    jurnal.log   - modificarile de dupa snapshot, cate o linie JSON pe grup de operatii
+Operatiile sunt ["p", tupla] (activitatea este pusa peste cea cu acelasi id) si ["d", id] (este stearsa).
+Refacerea aplica jurnalul peste snapshot; o linie scrisa pe jumatate la o cadere este ignorata,
+iar operatiile unui grup (de exemplu mutarea unei activitati pe alt id) sunt aplicate impreuna sau deloc.
+
+fsync-ul este grupat: cu interval_fsync=0 fiecare scriere asteapta fsync, altfel un fir de fundal
+face fsync cel mult o data la interval_fsync secunde pentru toate scrierile adunate intre timp.
+Cu interval_fsync=None fsync-ul este lasat in seama sistemului de operare."""
+import json
+import os
+import pickle
+import threading
+from contextlib import contextmanager
+
+FISIER_SNAPSHOT = "snapshot.bin"
+FISIER_JURNAL = "jurnal.log"
+VERSIUNE_SNAPSHOT = 1
+
+
+class Jurnal:
+
+    def __init__(self, director: str, stare, interval_fsync: float | None = 0.05, prag_compactare: int = 10000):
+        """`stare` este apelata la compactare si intoarce toate tuplele curente"""
+        self.director = director
+        self.stare = stare
+        self.interval_fsync = interval_fsync
+        self.prag_compactare = prag_compactare
+        self.cale_snapshot = os.path.join(director, FISIER_SNAPSHOT)
+        self.cale_jurnal = os.path.join(director, FISIER_JURNAL)
+        os.makedirs(director, exist_ok=True)
+
+        self.lacat = threading.Lock()
+        self.fisier = None
+        self.intrari = 0
+        self.nescrise = False
+        self.grup: list | None = None
+        self.adancime_grup = 0
+        self.oprit = threading.Event()
+        self.fir_fsync = None
+
+    def incarca(self) -> dict[int, tuple] | None:
+        """Starea salvata (id -> tupla), sau None daca directorul nu are inca date.
+        Dupa incarcare jurnalul este deschis pentru adaugare"""
+        if not os.path.exists(self.cale_snapshot) and not os.path.exists(self.cale_jurnal):
+            self.deschide()
+            return None
+
+        stare = {}
+        if os.path.exists(self.cale_snapshot):
+            with open(self.cale_snapshot, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot["versiune"] != VERSIUNE_SNAPSHOT:
+                raise ValueError(f"Versiune de snapshot necunoscuta: {snapshot['versiune']}")
+            stare = {tupla[0]: tupla for tupla in snapshot["activitati"]}
+
+        valid = 0
+        if os.path.exists(self.cale_jurnal):
+            with open(self.cale_jurnal, "rb") as f:
+                for linie in f:
+                    if not linie.endswith(b"\n"):
+                        break
+                    try:
+                        operatii = json.loads(linie)
+                    except ValueError:
+                        break
+                    for operatie, valoare in operatii:
+                        if operatie == "p":
+                            stare[valoare[0]] = tuple(valoare)
+                        else:
+                            stare.pop(valoare, None)
+                    valid += len(linie)
+                    self.intrari += 1
+            #Ce a ramas dupa ultima linie completa (o scriere intrerupta) este taiat, ca adaugarile sa continue curat
+            if valid != os.path.getsize(self.cale_jurnal):
+                with open(self.cale_jurnal, "r+b") as f:
+                    f.truncate(valid)
+
+        self.deschide()
+        return stare
+
+    def deschide(self):
+        self.fisier = open(self.cale_jurnal, "ab")
+        if self.interval_fsync and self.fir_fsync is None:
+            self.fir_fsync = threading.Thread(target=self.sincronizeaza_periodic, name="jurnal-fsync", daemon=True)
+            self.fir_fsync.start()
+
+    def scrie(self, *operatie):
+        """Adauga o operatie ("p", tupla) sau ("d", id). In interiorul unui grup doar o retine"""
+        if self.grup is not None:
+            self.grup.append(operatie)
+        else:
+            self.scrie_linie([operatie])
+
+    @contextmanager
+    def in_grup(self):
+        """Operatiile scrise in interior ajung intr-o singura linie, adica sunt refacute toate sau niciuna.
+        Grupurile pot fi imbricate; linia este scrisa la iesirea din cel exterior"""
+        if self.adancime_grup == 0:
+            self.grup = []
+        self.adancime_grup += 1
+        try:
+            yield
+        finally:
+            self.adancime_grup -= 1
+            if self.adancime_grup == 0:
+                grup, self.grup = self.grup, None
+                if grup:
+                    self.scrie_linie(grup)
+
+    def scrie_linie(self, operatii: list):
+        linie = json.dumps(operatii, separators=(",", ":")).encode() + b"\n"
+        with self.lacat:
+            self.fisier.write(linie)
+            self.fisier.flush()
+            self.nescrise = True
+            if self.interval_fsync == 0:
+                os.fsync(self.fisier.fileno())
+                self.nescrise = False
+        self.intrari += 1
+        if self.intrari >= self.prag_compactare:
+            self.compacteaza()
+
+    def sincronizeaza(self):
+        with self.lacat:
+            if self.nescrise:
+                os.fsync(self.fisier.fileno())
+                self.nescrise = False
+
+    def sincronizeaza_periodic(self):
+        while not self.oprit.wait(self.interval_fsync):
+            self.sincronizeaza()
+
+    def compacteaza(self):
+        """Scrie starea curenta ca snapshot (intr-un fisier temporar mutat apoi peste cel vechi) si goleste jurnalul.
+        O cadere intre cei doi pasi nu pierde nimic: jurnalul ramas este doar aplicat din nou peste snapshot"""
+        temporar = self.cale_snapshot + ".tmp"
+        with open(temporar, "wb") as f:
+            pickle.dump({"versiune": VERSIUNE_SNAPSHOT, "activitati": list(self.stare())}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporar, self.cale_snapshot)
+        sincronizeaza_director(self.director)
+        with self.lacat:
+            if self.fisier is not None:
+                self.fisier.close()
+            self.fisier = open(self.cale_jurnal, "wb")
+            os.fsync(self.fisier.fileno())
+            self.nescrise = False
+        self.intrari = 0
+
+    def inchide(self):
+        self.oprit.set()
+        if self.fisier is not None:
+            self.sincronizeaza()
+            with self.lacat:
+                self.fisier.close()
+                self.fisier = None
+
+
+def sincronizeaza_director(director: str):
+    """fsync pe director, ca redenumirea snapshot-ului sa supravietuiasca unei caderi (nu exista pe Windows)"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(director, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
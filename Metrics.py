@@ -0,0 +1,228 @@
+"""Metrics in the Prometheus text format, without depending on prometheus_client.
+
+    metrics = Metrics(app)                  times every request and serves GET /metrics
+    metrics.instrument_redis(client)        counts and times the commands and pipelines of a redis.asyncio client
+    metrics.instrument_http_client(client)  times the responses of an httpx.AsyncClient per host
+    metrics.counter(...), .gauge(...), .histogram(...) add app specific metrics
+
+The request and Redis metrics are updated on the event loop, so recording is a few dict and list operations
+with no locking. Values an app already keeps (cache sizes, record counts) are better exposed with `collect`,
+a function called only when /metrics is scraped."""
+import bisect
+import time
+
+from fastapi import Response
+from starlette.routing import Match
+
+#Upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """A metric with one value per combination of label values. With `collect`, the values are not recorded
+    but asked for at every scrape: collect() returns {label values: value}"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.values: dict[tuple, float] = {}
+
+    def render(self) -> list[str]:
+        values = self.collect() if self.collect is not None else self.values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}" for labels, value in values.items())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Counts per bucket are kept non-cumulative, so an observation touches a single bucket; they are summed at render"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        #label values -> [count per bucket (the last one is +Inf), sum]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        names = self.labels + ("le",)
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def command_name(args: tuple) -> str:
+    name = args[0] if args else "UNKNOWN"
+    return (name.decode() if isinstance(name, bytes) else str(name)).upper()
+
+
+def route_template(scope, routes) -> str:
+    """The path template of the route that served the request, which keeps the number of label values bounded.
+    The router leaves it in the scope; answers given by a middleware before routing (a 304) are matched here"""
+    route = scope.get("route")
+    if route is None:
+        route = next((route for route in routes if route.matches(scope)[0] is Match.FULL), None)
+    return getattr(route, "path", "<unmatched>")
+
+
+class Metrics:
+    """The metrics of one app"""
+
+    def __init__(self, app=None, path: str = "/metrics"):
+        self.metrics: list[Metric] = []
+        self.requests = self.histogram("http_request_duration_seconds", "Time to serve a request, by route template and status", ("method", "route", "status"))
+        self.in_flight = self.gauge("http_requests_in_flight", "Requests being served (open streams included)")
+        self.redis_commands = self.histogram("redis_command_duration_seconds", "Round trip of a Redis command; a whole pipeline counts as PIPELINE", ("command",))
+        self.redis_pipelined = self.counter("redis_pipelined_commands_total", "Commands sent inside pipelines", ("command",))
+        self.redis_errors = self.counter("redis_command_errors_total", "Redis commands and pipelines that raised", ("command",))
+        self.upstream = self.histogram("upstream_request_duration_seconds", "Time until the response headers of an upstream HTTP request", ("host", "status"))
+        if app is not None:
+            self.instrument_app(app, path)
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = (), collect=None) -> Counter:
+        return self.add(Counter(name, help, labels, collect))
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = (), collect=None) -> Gauge:
+        return self.add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+    def instrument_app(self, app, path: str = "/metrics"):
+        """Time every request and add the scrape endpoint. The timing wraps the whole middleware stack,
+        whenever it is built, so it is outermost no matter in which order the app adds its own middleware"""
+        build = app.build_middleware_stack
+        app.build_middleware_stack = lambda: self.timed_app(build(), app.router.routes)
+        app.add_api_route(path, self.scrape, methods=["GET"], include_in_schema=False)
+
+    async def scrape(self) -> Response:
+        return Response(self.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    def timed_app(self, app, routes):
+        async def timed(scope, receive, send):
+            if scope["type"] != "http":
+                return await app(scope, receive, send)
+            status = 500
+
+            async def send_with_status(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                await send(message)
+
+            self.in_flight.inc()
+            start = time.perf_counter()
+            try:
+                await app(scope, receive, send_with_status)
+            finally:
+                self.in_flight.dec()
+                self.requests.observe(time.perf_counter() - start, scope["method"], route_template(scope, routes), str(status))
+        return timed
+
+    def instrument_redis(self, client):
+        """Wrap execute_command and pipeline() of a redis.asyncio client (fakeredis included) in place"""
+        execute_command = client.execute_command
+
+        async def timed_command(*args, **options):
+            start = time.perf_counter()
+            try:
+                return await execute_command(*args, **options)
+            except Exception:
+                self.redis_errors.inc(command_name(args))
+                raise
+            finally:
+                self.redis_commands.observe(time.perf_counter() - start, command_name(args))
+
+        pipeline = client.pipeline
+
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def timed_execute(*args, **kwargs):
+                for command, _ in pipe.command_stack:
+                    self.redis_pipelined.inc(command_name(command))
+                start = time.perf_counter()
+                try:
+                    return await execute(*args, **kwargs)
+                except Exception:
+                    self.redis_errors.inc("PIPELINE")
+                    raise
+                finally:
+                    self.redis_commands.observe(time.perf_counter() - start, "PIPELINE")
+
+            pipe.execute = timed_execute
+            return pipe
+
+        client.execute_command = timed_command
+        client.pipeline = timed_pipeline
+        return client
+
+    def instrument_http_client(self, client):
+        """Time the responses of an httpx.AsyncClient through its event hooks"""
+        async def started(request):
+            request.extensions["metrics_start"] = time.perf_counter()
+
+        async def finished(response):
+            start = response.request.extensions.get("metrics_start")
+            if start is not None:
+                self.upstream.observe(time.perf_counter() - start, response.request.url.host, str(response.status_code))
+
+        client.event_hooks["request"].append(started)
+        client.event_hooks["response"].append(finished)
+        return client
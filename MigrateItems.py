@@ -0,0 +1,60 @@
+"""Converts the items stored by FastAPIRedis.py between the "json" and "hash" storage formats.
+
+Usage: python MigrateItems.py hash|json [db]
+Stop FastAPIRedis.py first, then start it again with ITEM_STORAGE set to the new format.
+Keys already in the target format are left alone, so the migration can be run again after an interruption."""
+import asyncio
+import json
+import sys
+
+from FastAPIRedis import create_redis, encode_hash, decode_hash, SCAN_BATCH_SIZE
+
+
+async def migrate(target: str, db: int = 1) -> int:
+    r = create_redis(db)
+    source_type = b"string" if target == "hash" else b"hash"
+    converted = 0
+    cursor = 0
+    while True:
+        cursor, keys = await r.scan(cursor=cursor, match="item:*", count=SCAN_BATCH_SIZE)
+
+        async with r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.type(key)
+            types = await pipe.execute()
+        keys = [key for key, key_type in zip(keys, types) if key_type == source_type]
+
+        if keys:
+            async with r.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    if target == "hash":
+                        pipe.get(key)
+                    else:
+                        pipe.hgetall(key)
+                values = await pipe.execute()
+
+            #every key of the page is rewritten in the same transaction
+            async with r.pipeline(transaction=True) as pipe:
+                for key, value in zip(keys, values):
+                    if not value:
+                        continue
+                    pipe.delete(key)
+                    if target == "hash":
+                        pipe.hset(key, mapping=encode_hash(json.loads(value)))
+                    else:
+                        pipe.set(key, json.dumps(decode_hash(value), separators=(",", ":")))
+                    converted += 1
+                await pipe.execute()
+
+        if cursor == 0:
+            break
+    await r.aclose()
+    return converted
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("hash", "json"):
+        print(__doc__)
+        sys.exit(1)
+    db = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    print(f"Converted {asyncio.run(migrate(sys.argv[1], db))} items to {sys.argv[1]}")
@@ -0,0 +1,159 @@
+"""Planificarea automata a activitatilor din ApiOrar: activitatilor care au doar durata, profesor si salile permise
+le gaseste zi, ora si sala, fara suprapuneri intre ele sau cu activitatile aflate deja in orar.
+
+Ocuparea este tinuta ca masti de biti pe (sala, zi) si (profesor, zi), ca in GrilaOcupare din ApiOrar,
+asa ca orele la care poate incepe o activitate intr-o zi si o sala se afla cu cateva operatii pe biti.
+Cautarea are doua faze:
+    lacoma   - activitatile cele mai greu de asezat (cu cele mai putine sali permise, ale profesorilor cei mai incarcati,
+               cele mai lungi) sunt asezate primele, in ziua cea mai libera a profesorului, la cea mai devreme ora posibila
+    reparare - pentru fiecare activitate ramasa sunt incercate, in ordine aleatoare, locurile blocate de o singura activitate
+               asezata de planificator, care este mutata in alt loc liber (cautare locala cu un pas de ejectie).
+               Trecerile se repeta cat timp mai este asezata macar o activitate
+Activitatile aflate deja in orar nu sunt mutate niciodata."""
+import random
+import threading
+
+
+def inceputuri(libere: int, durata: int) -> int:
+    """Masca orelor h pentru care h..h+durata-1 sunt toate libere"""
+    masca = libere
+    for k in range(1, durata):
+        masca &= libere >> k
+    return masca
+
+
+class Planificator:
+
+    def __init__(self, activitati: list[dict], sali: list[str], zile: list, de_la: int, pana_la: int,
+                 masti_sali: dict[tuple, int], masti_profesori: dict[tuple, int], samanta: int | None = None):
+        """`activitati` au durata, profesor si optional sali (salile permise, implicit toate `sali`).
+        `masti_sali` si `masti_profesori` sunt ocuparea de pornire, cheie (sala/profesor, zi) -> masca de ore"""
+        self.activitati = activitati
+        self.zile = list(zile)
+        self.fereastra = (1 << pana_la) - (1 << de_la)
+        self.sali_permise = [activitate.get("sali") or sali for activitate in activitati]
+        self.fixe_sali = masti_sali
+        self.fixe_profesori = masti_profesori
+        self.masti_sali = dict(masti_sali)
+        self.masti_profesori = dict(masti_profesori)
+        #(sala, zi, ora) si (profesor, zi, ora) -> activitatea asezata de planificator care ocupa ora
+        self.in_sala: dict[tuple, int] = {}
+        self.la_profesor: dict[tuple, int] = {}
+        #activitate -> (zi, ora, sala)
+        self.locuri: dict[int, tuple] = {}
+        self.asezate_lacom = 0
+        self.random = random.Random(samanta)
+        self.oprit = threading.Event()
+        self.progres = lambda faza, facut, total: None
+
+    def cauta_loc(self, i: int) -> tuple | None:
+        """Un loc liber (zi, ora, sala) pentru activitatea i: ziua cea mai libera a profesorului, apoi ora cea mai devreme"""
+        durata, profesor = self.activitati[i]["durata"], self.activitati[i]["profesor"]
+        for zi in sorted(self.zile, key=lambda zi: self.masti_profesori.get((profesor, zi), 0).bit_count()):
+            libere = self.fereastra & ~self.masti_profesori.get((profesor, zi), 0)
+            posibile = inceputuri(libere, durata)
+            if not posibile:
+                continue
+            cea_mai_devreme = posibile & -posibile
+            gasit = None
+            for sala in self.sali_permise[i]:
+                masca = inceputuri(libere & ~self.masti_sali.get((sala, zi), 0), durata)
+                if masca:
+                    bit = masca & -masca
+                    if gasit is None or bit < gasit[0]:
+                        gasit = (bit, sala)
+                        if bit == cea_mai_devreme:
+                            break
+            if gasit is not None:
+                return zi, gasit[0].bit_length() - 1, gasit[1]
+        return None
+
+    def aseaza(self, i: int, zi, ora: int, sala: str):
+        durata, profesor = self.activitati[i]["durata"], self.activitati[i]["profesor"]
+        ore = (1 << ora + durata) - (1 << ora)
+        self.masti_sali[(sala, zi)] = self.masti_sali.get((sala, zi), 0) | ore
+        self.masti_profesori[(profesor, zi)] = self.masti_profesori.get((profesor, zi), 0) | ore
+        for h in range(ora, ora + durata):
+            self.in_sala[(sala, zi, h)] = i
+            self.la_profesor[(profesor, zi, h)] = i
+        self.locuri[i] = (zi, ora, sala)
+
+    def ridica(self, i: int) -> tuple:
+        zi, ora, sala = self.locuri.pop(i)
+        durata, profesor = self.activitati[i]["durata"], self.activitati[i]["profesor"]
+        ore = (1 << ora + durata) - (1 << ora)
+        self.masti_sali[(sala, zi)] &= ~ore
+        self.masti_profesori[(profesor, zi)] &= ~ore
+        for h in range(ora, ora + durata):
+            del self.in_sala[(sala, zi, h)]
+            del self.la_profesor[(profesor, zi, h)]
+        return zi, ora, sala
+
+    def repara(self, i: int) -> bool:
+        """Incearca sa aseze activitatea i mutand o singura activitate asezata deja de planificator"""
+        durata, profesor = self.activitati[i]["durata"], self.activitati[i]["profesor"]
+        candidati = []
+        for zi in self.zile:
+            libere = self.fereastra & ~self.fixe_profesori.get((profesor, zi), 0)
+            for sala in self.sali_permise[i]:
+                masca = inceputuri(libere & ~self.fixe_sali.get((sala, zi), 0), durata)
+                while masca:
+                    bit = masca & -masca
+                    masca ^= bit
+                    candidati.append((zi, bit.bit_length() - 1, sala))
+        self.random.shuffle(candidati)
+
+        for zi, ora, sala in candidati:
+            blocante = {self.in_sala.get((sala, zi, h)) for h in range(ora, ora + durata)}
+            blocante |= {self.la_profesor.get((profesor, zi, h)) for h in range(ora, ora + durata)}
+            blocante.discard(None)
+            if not blocante:
+                self.aseaza(i, zi, ora, sala)
+                return True
+            if len(blocante) > 1:
+                continue
+            j = blocante.pop()
+            vechi = self.ridica(j)
+            self.aseaza(i, zi, ora, sala)
+            loc = self.cauta_loc(j)
+            if loc is not None:
+                self.aseaza(j, *loc)
+                return True
+            self.ridica(i)
+            self.aseaza(j, *vechi)
+        return False
+
+    def ruleaza(self, treceri: int = 10) -> list[int]:
+        """Aseaza activitatile in self.locuri si intoarce activitatile (pozitiile lor) ramase neasezate"""
+        n = len(self.activitati)
+        ore_profesor: dict[str, int] = {}
+        for activitate in self.activitati:
+            ore_profesor[activitate["profesor"]] = ore_profesor.get(activitate["profesor"], 0) + activitate["durata"]
+        ordine = sorted(range(n), key=lambda i: (len(self.sali_permise[i]), -ore_profesor[self.activitati[i]["profesor"]], -self.activitati[i]["durata"]))
+
+        neasezate = []
+        for facut, i in enumerate(ordine):
+            if self.oprit.is_set():
+                return neasezate + ordine[facut:]
+            loc = self.cauta_loc(i)
+            if loc is not None:
+                self.aseaza(i, *loc)
+            else:
+                neasezate.append(i)
+            if facut % 100 == 0:
+                self.progres("lacoma", facut, n)
+        self.asezate_lacom = n - len(neasezate)
+        self.progres("lacoma", n, n)
+
+        for _ in range(treceri):
+            if not neasezate or self.oprit.is_set():
+                break
+            ramase = []
+            for i in neasezate:
+                if self.oprit.is_set() or not self.repara(i):
+                    ramase.append(i)
+            self.progres("reparare", n - len(ramase), n)
+            if len(ramase) == len(neasezate):
+                break
+            neasezate = ramase
+        return sorted(neasezate)
@@ -0,0 +1,275 @@
+"""Profiling that can be switched on at runtime, and a log of slow requests with their stacks.
+
+    profiling = Profiling(app)
+
+adds, guarded by the X-Admin-Token header (equal to the ADMIN_TOKEN environment variable; without it they answer 404):
+    POST   /admin/profile?requests=N[&route=/items/{item_id}][&interval_ms=1]
+           profile the next N requests (only those served by the given route template, if one is given)
+    GET    /admin/profile[?format=json]
+           the samples taken so far in the collapsed stack format ("outer;inner;innermost count" per line),
+           which flamegraph.pl, speedscope and inferno read directly; format=json gives the session state instead
+    DELETE /admin/profile
+           stop the session, keeping its samples for GET
+
+Profiling is by sampling: while a profiled request is running, a thread reads the stacks of all the other threads
+every interval_ms (the event loop, and the worker threads running sync endpoints) and counts each stack.
+Threads blocked in a selector or a lock wait are idle and skipped. Requests running at the same time as a profiled
+one show up in its samples too, so profile under the load you want to look at, or on a quiet instance.
+
+Every request running longer than SLOW_REQUEST_SECONDS (default 1, 0 turns it off) is logged as a warning on the
+"slow_requests" logger by a watchdog thread, while it is still running, together with the await chain of its task
+and the current stacks of the threads running code of this repository. Streaming responses (Server-Sent Events,
+NDJSON) stop being watched once their headers are sent: they stay open as long as the client reads them."""
+import asyncio
+import io
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
+
+from Metrics import route_template
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "1"))
+PROFILE_PATH = "/admin/profile"
+#Modules a thread is idle in when its innermost frame is theirs
+IDLE_MODULES = ("selectors.py", "threading.py", "queue.py")
+#Responses of these content types are streams, left out of the slow request log
+STREAMING_TYPES = ("text/event-stream", "application/x-ndjson")
+#Threads are included in the slow request log when they run code from here (this module's own threads excepted)
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+slow_requests = logging.getLogger("slow_requests")
+#Samplers and watchdogs of all the apps in the process, never sampled themselves
+profiler_threads: set[int] = set()
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def collapse(frame) -> tuple[str, ...]:
+    """The stack of a frame, outermost first"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+def in_repository(filename: str) -> bool:
+    """Code of the apps, not of the libraries or of this module"""
+    path = os.path.abspath(filename)
+    return path.startswith(REPO_DIRECTORY) and path != os.path.abspath(__file__) and "site-packages" not in path
+
+
+def idle(frame) -> bool:
+    return frame.f_code.co_filename.endswith(IDLE_MODULES)
+
+
+def streaming(message) -> bool:
+    """Whether an http.response.start message starts a stream"""
+    content_type = next((value for name, value in message.get("headers", ()) if name.lower() == b"content-type"), b"")
+    return content_type.split(b";")[0].strip().decode("latin-1") in STREAMING_TYPES
+
+
+class ProfileSession:
+    """The next `requests` requests (served by `route`, if given) are sampled every `interval` seconds"""
+
+    def __init__(self, requests: int, route: str | None, interval: float):
+        self.requests = requests
+        self.route = route
+        self.interval = interval
+        self.remaining = requests
+        self.running = 0
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.samples = 0
+        self.sampler: threading.Thread | None = None
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def state(self) -> dict:
+        return {
+            "requests": self.requests,
+            "route": self.route,
+            "interval_ms": self.interval * 1000,
+            "remaining": self.remaining,
+            "running": self.running,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiling:
+
+    def __init__(self, app, slow_seconds: float = SLOW_REQUEST_SECONDS):
+        self.session: ProfileSession | None = None
+        self.lock = threading.Lock()
+        self.slow_seconds = slow_seconds
+        #requests in progress, for the watchdog: key -> [start, method, path, thread id, task, logged]
+        self.running: dict[int, list] = {}
+        self.watchdog: threading.Thread | None = None
+        self.routes = app.router.routes
+
+        build = app.build_middleware_stack
+        app.build_middleware_stack = lambda: self.watched_app(build())
+        app.add_api_route(PROFILE_PATH, self.start, methods=["POST"], include_in_schema=False)
+        app.add_api_route(PROFILE_PATH, self.result, methods=["GET"], include_in_schema=False)
+        app.add_api_route(PROFILE_PATH, self.stop, methods=["DELETE"], include_in_schema=False)
+
+    #ADMIN ENDPOINTS------------------------------------------------------------
+    @staticmethod
+    def authorize(request: Request):
+        token = request.headers.get("x-admin-token")
+        if not ADMIN_TOKEN:
+            raise HTTPException(status_code=404, detail=f"Not Found")
+        if token is None or not secrets.compare_digest(token, ADMIN_TOKEN):
+            raise HTTPException(status_code=403, detail=f"Invalid admin token.")
+
+    async def start(
+            self,
+            request: Request,
+            requests: int = Query(default=10, ge=1, le=10000),
+            route: str | None = Query(default=None, description="Route template to profile, e.g. /items/{item_id}"),
+            interval_ms: float = Query(default=1.0, ge=0.1, le=1000)) -> dict:
+        self.authorize(request)
+        if route is not None and route not in {getattr(known, "path", None) for known in self.routes}:
+            raise HTTPException(status_code=400, detail=f"Unknown route {route!r}.")
+        with self.lock:
+            if self.session is not None and self.session.finished_at is None:
+                raise HTTPException(status_code=409, detail=f"A profiling session is already running.")
+            self.session = ProfileSession(requests, route, interval_ms / 1000)
+            return self.session.state()
+
+    async def result(self, request: Request, format: str = Query(default="collapsed", pattern="^(collapsed|json)$")) -> Response:
+        self.authorize(request)
+        session = self.session
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"No profiling session.")
+        with self.lock:
+            if format == "json":
+                return JSONResponse(session.state())
+            return Response(session.collapsed(), media_type="text/plain; charset=utf-8")
+
+    async def stop(self, request: Request) -> dict:
+        self.authorize(request)
+        with self.lock:
+            session = self.session
+            if session is None:
+                raise HTTPException(status_code=404, detail=f"No profiling session.")
+            session.remaining = 0
+            if session.finished_at is None and session.running == 0:
+                session.finished_at = time.time()
+            return session.state()
+
+    #SAMPLING-------------------------------------------------------------------
+    def take(self, scope) -> ProfileSession | None:
+        """The session that should profile this request, if any; counts the request against it"""
+        session = self.session
+        if session is None or session.remaining <= 0 or scope["path"] == PROFILE_PATH:
+            return None
+        if session.route is not None and route_template(scope, self.routes) != session.route:
+            return None
+        with self.lock:
+            if session.remaining <= 0:
+                return None
+            session.remaining -= 1
+            session.running += 1
+            if session.sampler is None:
+                session.sampler = threading.Thread(target=self.sample, args=(session,), name="profiling-sampler", daemon=True)
+                session.sampler.start()
+        return session
+
+    def release(self, session: ProfileSession):
+        with self.lock:
+            session.running -= 1
+            if session.remaining <= 0 and session.running == 0 and session.finished_at is None:
+                session.finished_at = time.time()
+
+    def sample(self, session: ProfileSession):
+        """Runs while requests of the session are in progress"""
+        profiler_threads.add(threading.get_ident())
+        while True:
+            with self.lock:
+                if session.running == 0:
+                    session.sampler = None
+                    profiler_threads.discard(threading.get_ident())
+                    return
+            stacks = [collapse(frame) for thread, frame in sys._current_frames().items() if thread not in profiler_threads and not idle(frame)]
+            with self.lock:
+                session.stacks.update(stacks)
+                session.samples += 1
+            time.sleep(session.interval)
+
+    #SLOW REQUESTS--------------------------------------------------------------
+    def watch(self):
+        """Logs every request that has been running for longer than slow_seconds, once"""
+        while True:
+            time.sleep(self.slow_seconds / 4)
+            now = time.perf_counter()
+            for entry in list(self.running.values()):
+                start, method, path, thread, task, logged = entry
+                if not logged and now - start > self.slow_seconds:
+                    entry[5] = True
+                    slow_requests.warning(f"Slow request {method} {path}: running for {now - start:.3f}s\n{self.stacks(thread, task)}")
+
+    @staticmethod
+    def stacks(thread: int, task) -> str:
+        """The await chain of the request task and the stacks of the threads running code of this repository"""
+        text = io.StringIO()
+        if task is not None:
+            try:
+                task.print_stack(file=text)
+            except Exception:
+                pass
+        frames = sys._current_frames()
+        for ident, frame in frames.items():
+            stack = traceback.extract_stack(frame)
+            if ident == thread or any(in_repository(entry.filename) for entry in stack):
+                name = next((t.name for t in threading.enumerate() if t.ident == ident), ident)
+                text.write(f"Thread {name}:\n{''.join(traceback.format_list(stack))}")
+        return text.getvalue()
+
+    def watched_app(self, app):
+        async def watched(scope, receive, send):
+            if scope["type"] != "http":
+                return await app(scope, receive, send)
+            session = self.take(scope)
+            key = None
+            if self.slow_seconds > 0:
+                if self.watchdog is None:
+                    self.watchdog = threading.Thread(target=self.watch, name="slow-request-watchdog", daemon=True)
+                    self.watchdog.start()
+                    profiler_threads.add(self.watchdog.ident)
+                key = id(scope)
+                start = time.perf_counter()
+                self.running[key] = [start, scope["method"], scope["path"], threading.get_ident(), asyncio.current_task(), False]
+
+                async def send_watched(message):
+                    if message["type"] == "http.response.start" and streaming(message):
+                        self.running.pop(key, None)
+                    await send(message)
+            try:
+                await app(scope, receive, send if key is None else send_watched)
+            finally:
+                if session is not None:
+                    self.release(session)
+                if key is not None:
+                    entry = self.running.pop(key, None)
+                    if entry is not None and entry[5]:
+                        slow_requests.warning(f"Slow request {scope['method']} {scope['path']} finished after {time.perf_counter() - start:.3f}s")
+        return watched
+
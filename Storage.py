@@ -0,0 +1,226 @@
+"""Async storage backends for pydantic records keyed by an integer `id` field.
+
+All backends implement Repository, so an API can run unchanged on whichever one fits a deployment:
+    memory - a dict in the process, fastest, lost on restart
+    redis  - one JSON string per record plus a sorted set of ids for ordered paging
+    sqlite - one row per record in a local file, in WAL mode
+create_repository picks one by name, usually taken from an environment variable."""
+import asyncio
+import bisect
+import itertools
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+from pydantic import BaseModel
+
+
+class Repository(ABC):
+    """CRUD on records of one model. Listings come ordered by id; `after` and `limit` page through them"""
+
+    def __init__(self, model: type[BaseModel], name: str):
+        self.model = model
+        self.name = name
+
+    @abstractmethod
+    async def get(self, id: int) -> BaseModel | None: ...
+
+    @abstractmethod
+    async def put(self, record: BaseModel): ...
+
+    @abstractmethod
+    async def delete(self, id: int) -> BaseModel | None: ...
+
+    @abstractmethod
+    async def scan(self, after: int | None = None, limit: int | None = None) -> list[BaseModel]: ...
+
+    async def exists(self, id: int) -> bool:
+        return await self.get(id) is not None
+
+    async def find(self, after: int | None = None, limit: int | None = None, **filters) -> list[BaseModel]:
+        """Records whose fields equal all the given filters (None filters are ignored)"""
+        filters = {field: value for field, value in filters.items() if value is not None}
+        found = []
+        while limit is None or len(found) < limit:
+            page = await self.scan(after=after, limit=500)
+            found.extend(record for record in page if matches(record, filters))
+            if len(page) < 500:
+                break
+            after = page[-1].id
+        return found if limit is None else found[:limit]
+
+    async def seed(self, records):
+        """Store the records if the repository is still empty"""
+        if not await self.scan(limit=1):
+            for record in records:
+                await self.put(record)
+
+    async def close(self):
+        pass
+
+
+def matches(record: BaseModel, filters: dict) -> bool:
+    return all(getattr(record, field) == value for field, value in filters.items())
+
+
+class MemoryRepository(Repository):
+    """Records in a dict, with a sorted list of their ids so a page starts with a bisect instead of a pass over all ids"""
+
+    def __init__(self, model: type[BaseModel], name: str):
+        super().__init__(model, name)
+        self.records: dict[int, BaseModel] = {}
+        self.ids: list[int] = []
+
+    def start(self, after: int | None) -> int:
+        return 0 if after is None else bisect.bisect_right(self.ids, after)
+
+    async def get(self, id):
+        return self.records.get(id)
+
+    async def put(self, record):
+        if record.id not in self.records:
+            bisect.insort(self.ids, record.id)
+        self.records[record.id] = record
+
+    async def delete(self, id):
+        record = self.records.pop(id, None)
+        if record is not None:
+            del self.ids[bisect.bisect_left(self.ids, id)]
+        return record
+
+    async def scan(self, after=None, limit=None):
+        start = self.start(after)
+        ids = self.ids[start:] if limit is None else self.ids[start:start + limit]
+        return [self.records[id] for id in ids]
+
+    async def find(self, after=None, limit=None, **filters):
+        filters = {field: value for field, value in filters.items() if value is not None}
+        found = (self.records[id] for id in itertools.islice(self.ids, self.start(after), None) if matches(self.records[id], filters))
+        return list(itertools.islice(found, limit))
+
+
+class RedisRepository(Repository):
+    """Records under {name}:{id}, with the sorted set {name}:ids giving the id order for paging"""
+
+    def __init__(self, model: type[BaseModel], name: str, client=None):
+        super().__init__(model, name)
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.Redis(host=os.environ.get("STORAGE_REDIS_HOST", "127.0.0.1"), port=6379, db=1, password="parola divina23^&")
+        self.redis = client
+
+    def key(self, id) -> str:
+        return f"{self.name}:{int(id)}"
+
+    async def get(self, id):
+        value = await self.redis.get(self.key(id))
+        return self.model.model_validate_json(value) if value is not None else None
+
+    async def exists(self, id):
+        return await self.redis.exists(self.key(id)) == 1
+
+    async def put(self, record):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self.key(record.id), record.model_dump_json())
+            pipe.zadd(f"{self.name}:ids", {record.id: record.id})
+            await pipe.execute()
+
+    async def delete(self, id):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.getdel(self.key(id))
+            pipe.zrem(f"{self.name}:ids", id)
+            value, _ = await pipe.execute()
+        return self.model.model_validate_json(value) if value is not None else None
+
+    async def scan(self, after=None, limit=None):
+        low = "-inf" if after is None else f"({after}"
+        if limit is None:
+            ids = await self.redis.zrangebyscore(f"{self.name}:ids", low, "+inf")
+        else:
+            ids = await self.redis.zrangebyscore(f"{self.name}:ids", low, "+inf", start=0, num=limit)
+        if not ids:
+            return []
+        values = await self.redis.mget([self.key(id) for id in ids])
+        return [self.model.model_validate_json(value) for value in values if value is not None]
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+class SqliteRepository(Repository):
+    """One table per repository holding the record JSON; filters run inside SQLite with json_extract.
+    sqlite3 is blocking, so every call runs in a worker thread on a single shared connection"""
+
+    def __init__(self, model: type[BaseModel], name: str, path: str | None = None):
+        super().__init__(model, name)
+        if not name.isidentifier():
+            raise ValueError(f"Invalid table name {name!r}")
+        self.connection = sqlite3.connect(path or os.environ.get("STORAGE_SQLITE_PATH", "storage.db"), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.connection.commit()
+
+    def execute(self, query: str, parameters=(), commit: bool = False):
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+            if commit:
+                self.connection.commit()
+            return rows
+
+    async def run(self, query: str, parameters=(), commit: bool = False):
+        return await asyncio.to_thread(self.execute, query, parameters, commit)
+
+    async def get(self, id):
+        rows = await self.run(f"SELECT data FROM {self.name} WHERE id = ?", (id,))
+        return self.model.model_validate_json(rows[0][0]) if rows else None
+
+    async def put(self, record):
+        await self.run(f"INSERT OR REPLACE INTO {self.name} (id, data) VALUES (?, ?)", (record.id, record.model_dump_json()), commit=True)
+
+    async def delete(self, id):
+        rows = await self.run(f"DELETE FROM {self.name} WHERE id = ? RETURNING data", (id,), commit=True)
+        return self.model.model_validate_json(rows[0][0]) if rows else None
+
+    async def scan(self, after=None, limit=None):
+        return await self.find(after=after, limit=limit)
+
+    async def find(self, after=None, limit=None, **filters):
+        conditions, parameters = [], []
+        if after is not None:
+            conditions.append("id > ?")
+            parameters.append(after)
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if field not in self.model.model_fields:
+                raise ValueError(f"Unknown field {field!r}")
+            conditions.append(f"json_extract(data, '$.{field}') = ?")
+            parameters.append(getattr(value, "value", value))
+        query = f"SELECT data FROM {self.name}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        rows = await self.run(query, parameters)
+        return [self.model.model_validate_json(row[0]) for row in rows]
+
+    async def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+BACKENDS = {
+    "memory": MemoryRepository,
+    "redis": RedisRepository,
+    "sqlite": SqliteRepository,
+}
+
+def create_repository(model: type[BaseModel], name: str, backend: str = "memory", **options) -> Repository:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend](model, name, **options)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+#the modules under test are flat scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def anyio_backend():
+    #redis.asyncio and the apps' background tasks need asyncio
+    return "asyncio"
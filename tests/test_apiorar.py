@@ -0,0 +1,123 @@
+from ApiOrar import AlocatorId, MARJA_COMPACTARE_ID
+
+
+def test_alocator_refoloseste_cel_mai_mic_id_liber():
+    folosite = dict.fromkeys(range(10))
+    alocator = AlocatorId(folosite)
+    for id in (7, 3):
+        del folosite[id]
+        alocator.eliberat(id)
+    assert alocator.urmatorul() == 3
+    folosite[3] = None
+    alocator.ocupat(3)
+    assert alocator.urmatorul() == 7
+
+
+def test_alocator_heap_marginit_la_update_repetat():
+    folosite = dict.fromkeys(range(1, 100))
+    alocator = AlocatorId(folosite)
+    #un update scoate si readauga acelasi id, in timp ce 0 ramane liber
+    for _ in range(2000):
+        del folosite[1]
+        alocator.eliberat(1)
+        folosite[1] = None
+        alocator.ocupat(1)
+    assert len(alocator.libere) <= 2 + MARJA_COMPACTARE_ID
+    assert alocator.urmatorul() == 0
+
+
+def test_paginarea_parcurge_toate_activitatile_in_ordine():
+    from fastapi.testclient import TestClient
+    import ApiOrar
+    client = TestClient(ApiOrar.app)
+    vazute, cursor = [], None
+    while True:
+        raspuns = client.get("/activitati", params={"limit": 3, **({"cursor": cursor} if cursor else {})}).json()
+        vazute += [int(id) for id in raspuns["activitati"]]
+        cursor = raspuns["next_cursor"]
+        if cursor is None:
+            break
+    assert vazute == sorted(ApiOrar.activitati)
+
+    raspuns = client.get("/alegeactivitate", params={"profesor": "Catalin", "limit": 1}).json()
+    assert [a["id"] for a in raspuns["selectie"]] == [0]
+    raspuns = client.get("/alegeactivitate", params={"profesor": "Catalin", "limit": 1, "cursor": raspuns["next_cursor"]}).json()
+    assert [a["id"] for a in raspuns["selectie"]] == [3] and raspuns["next_cursor"] is None
+
+
+def test_modificare_bulk_lipsa_conflict_si_anulare():
+    from fastapi.testclient import TestClient
+    import ApiOrar
+    client = TestClient(ApiOrar.app)
+    noi = [{"nume": f"Test {i}", "durata": 1, "profesor": f"Profesor test {i}", "sala": "T1", "zi": "duminica", "ora": 8 + i, "categorie": "curs"} for i in range(2)]
+    a, b = [r["id"] for r in client.post("/activitati/bulk", json=noi).json()["rezultate"]]
+    try:
+        raspuns = client.patch("/activitati/bulk", json=[{"id_vechi": a, "nume": "Redenumita"}, {"id_vechi": 999999, "nume": "Y"},
+                                                         {"id_vechi": b, "ora": 8}])
+        assert raspuns.status_code == 200
+        assert [r["status"] for r in raspuns.json()["rezultate"]] == ["actualizat", "lipseste", "conflict"]
+        assert raspuns.json()["scrise"] == 1
+        assert ApiOrar.activitati[a].nume == "Redenumita"
+
+        #a doua inregistrare lipseste, sau s-ar suprapune cu noua ora a primei
+        for gresita in ({"id_vechi": 999999, "nume": "Y"}, {"id_vechi": b, "ora": 10}):
+            raspuns = client.patch("/activitati/bulk", params={"atomic": "true"}, json=[{"id_vechi": a, "nume": "Alt nume", "ora": 10}, gresita])
+            assert raspuns.status_code == 200
+            assert [r["status"] for r in raspuns.json()["rezultate"]] == ["omis", "lipseste" if gresita["id_vechi"] == 999999 else "conflict"]
+            assert raspuns.json()["scrise"] == 0
+            assert (ApiOrar.activitati[a].nume, ApiOrar.activitati[a].ora) == ("Redenumita", 8)
+            assert ApiOrar.grila_sali.ocupate(("T1", ApiOrar.Zile.DUMINICA), 10, 1) == set()
+    finally:
+        client.request("DELETE", "/activitati/bulk", json=[a, b])
+
+
+def test_campuri_invalide_dau_400():
+    from fastapi.testclient import TestClient
+    import ApiOrar
+    client = TestClient(ApiOrar.app)
+    for cale in ("/activitati", "/activitati/0", "/alegeactivitate"):
+        assert client.get(cale, params={"fields": "bogus"}).status_code == 400
+
+
+def test_cursor_invalid_da_400():
+    from fastapi.testclient import TestClient
+    import ApiOrar
+    client = TestClient(ApiOrar.app)
+    for cale in ("/activitati", "/alegeactivitate"):
+        assert client.get(cale, params={"cursor": "zzz"}).status_code == 400
+
+
+def test_interval_invers_la_sali_libere_da_400():
+    from fastapi.testclient import TestClient
+    import ApiOrar
+    client = TestClient(ApiOrar.app)
+    assert client.get("/disponibilitate/sali", params={"zi": "luni", "de_la": 12, "pana_la": 10}).status_code == 400
+    assert client.get("/disponibilitate/sali", params={"zi": "luni", "de_la": 10, "pana_la": 12}).status_code == 200
+
+
+def test_suprapunerea_da_409():
+    from fastapi.testclient import TestClient
+    import ApiOrar
+    client = TestClient(ApiOrar.app)
+    activitate = {"nume": "Test", "durata": 2, "profesor": "Profesor test", "sala": "T2", "zi": "duminica", "ora": 8, "categorie": "curs"}
+    id = client.post("/activitati", json=activitate).json()["added"]["id"]
+    alta = client.post("/activitati", json={**activitate, "ora": 12}).json()["added"]["id"]
+    try:
+        #aceeasi sala la 9, cand prima activitate tine 8-10
+        assert client.post("/activitati", json={**activitate, "profesor": "Alt profesor", "ora": 9}).status_code == 409
+        assert client.put("/activitati", params={**activitate, "profesor": "Alt profesor", "ora": 9}).status_code == 409
+        assert client.patch("/activitati", params={"id_vechi": alta, "ora": 9}).status_code == 409
+        assert client.put("/activitati", params={"id_vechi": alta, "ora": 9}).status_code == 409
+        assert client.patch("/activitati", params={"id_vechi": alta, "ora": 10}).status_code == 200
+    finally:
+        client.request("DELETE", "/activitati/bulk", json=[id, alta])
+
+
+def test_fluxul_parcurge_activitatile_in_bucati(monkeypatch):
+    import json
+    import ApiOrar
+    monkeypatch.setattr(ApiOrar, "MARIME_BUCATA_FLUX", 2)
+    bucati = list(ApiOrar.flux_activitati({"id"}))
+    assert all(bucata.count("\n") <= 2 for bucata in bucati)
+    ids = [json.loads(linie)["id"] for bucata in bucati for linie in bucata.splitlines()]
+    assert ids == sorted(ApiOrar.activitati)
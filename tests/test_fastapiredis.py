@@ -0,0 +1,223 @@
+import asyncio
+import json
+import time
+
+import fakeredis
+import httpx
+import pytest
+
+import FastAPIRedis
+from FastAPIRedis import app, prepare_redis
+
+
+@pytest.fixture
+async def client():
+    app.state.redis = fakeredis.aioredis.FakeRedis()
+    FastAPIRedis.l1_cache.clear()
+    await prepare_redis()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+    await app.state.redis.aclose()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("storage", ["json", "hash"])
+async def test_patch_keeps_untouched_numbers_exact(client, monkeypatch, storage):
+    monkeypatch.setattr(FastAPIRedis, "ITEM_STORAGE", storage)
+    item = {"name": "H", "price": 0.30000000000000004, "count": 123456789012345, "id": 0, "category": "tools"}
+    assert (await client.post("/items", json=item)).status_code == 200
+    response = await client.patch("/items/0", params={"name": "H2"})
+    assert response.json() == {"updated": {**item, "name": "H2"}}
+    if storage == "json":
+        stored = json.loads(await app.state.redis.get("item:0"))
+        assert stored == {**item, "name": "H2"}
+    assert (await client.get("/items/0")).json() == {"item with item_id=0": {**item, "name": "H2"}}
+
+
+@pytest.fixture
+def upstream():
+    """A local mock of the cat fact API that counts its calls and answers after a short delay"""
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"fact": f"fact {len(calls)}"})
+
+    app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    yield calls
+    FastAPIRedis.in_flight.clear()
+
+
+@pytest.mark.anyio
+async def test_concurrent_misses_share_one_upstream_call(client, upstream):
+    responses = await asyncio.gather(*(client.get("/catfact") for _ in range(50)))
+    assert len(upstream) == 1
+    assert {response.json()["fact"] for response in responses} == {"fact 1"}
+
+
+@pytest.mark.anyio
+async def test_stale_answer_is_served_while_refreshed_once(client, upstream):
+    stale = {"value": {"fact": "old"}, "fresh_until": time.time() - 1}
+    await app.state.redis.set("catfact", json.dumps(stale))
+    responses = await asyncio.gather(*(client.get("/catfact") for _ in range(10)))
+    assert {response.json()["fact"] for response in responses} == {"old"}
+    await asyncio.gather(*FastAPIRedis.in_flight.values())
+    assert len(upstream) == 1
+    assert (await client.get("/catfact")).json() == {"fact": "fact 1"}
+    assert len(upstream) == 1
+
+
+@pytest.mark.anyio
+async def test_read_racing_a_write_does_not_cache_the_old_value(client, monkeypatch):
+    item = {"name": "H", "price": 1.0, "count": 1, "id": 0, "category": "tools"}
+    await client.post("/items", json=item)
+    fetch_items = FastAPIRedis.fetch_items
+
+    async def fetch_then_write(keys, *args, **kwargs):
+        #the write commits and invalidates after the read got the old value, before it is cached
+        items = await fetch_items(keys, *args, **kwargs)
+        await FastAPIRedis.update_item(0, None, None, 2, None)
+        return items
+
+    monkeypatch.setattr(FastAPIRedis, "fetch_items", fetch_then_write)
+    assert (await client.get("/items/0")).json()["item with item_id=0"]["count"] == 1
+    monkeypatch.setattr(FastAPIRedis, "fetch_items", fetch_items)
+    assert (await client.get("/items/0")).json()["item with item_id=0"]["count"] == 2
+
+
+def bulk_items(ids):
+    return [{"name": f"Item {id}", "price": 1.5, "count": id, "id": id, "category": "tools"} for id in ids]
+
+
+@pytest.mark.anyio
+async def test_atomic_bulk_insert_reports_clashes_and_writes_nothing(client):
+    await client.post("/items/bulk", json=bulk_items([1]))
+    result = (await client.post("/items/bulk", params={"atomic": "true"}, json=bulk_items([0, 1, 2]))).json()
+    assert [record["status"] for record in result["results"]] == ["skipped", "exists", "skipped"]
+    assert result["written"] == 0
+    assert await app.state.redis.exists("item:0", "item:2") == 0
+
+
+@pytest.mark.anyio
+async def test_atomic_bulk_insert_fails_on_a_write_after_the_check(client, monkeypatch):
+    execute_item_scripts = FastAPIRedis.execute_item_scripts
+
+    async def concurrent_insert_then_execute(pipe, calls):
+        #another client creates one of the items after the existence check passed
+        await FastAPIRedis.insert_item(FastAPIRedis.Item(**bulk_items([2])[0]))
+        return await execute_item_scripts(pipe, calls)
+
+    monkeypatch.setattr(FastAPIRedis, "execute_item_scripts", concurrent_insert_then_execute)
+    response = await client.post("/items/bulk", params={"atomic": "true"}, json=bulk_items([0, 1, 2]))
+    assert response.status_code == 409
+    assert await app.state.redis.exists("item:0", "item:1") == 0
+
+
+@pytest.mark.anyio
+async def test_only_collection_reads_fetch_the_version(client, monkeypatch):
+    await client.post("/items", json=bulk_items([0])[0])
+    reads = []
+    collection_version = FastAPIRedis.collection_version
+
+    async def counted():
+        reads.append(1)
+        return await collection_version()
+
+    monkeypatch.setattr(FastAPIRedis, "collection_version", counted)
+    for _ in range(3):
+        assert (await client.get("/items/0")).status_code == 200
+    assert reads == []
+    etag = (await client.get("/items")).headers["ETag"]
+    assert (await client.get("/items", headers={"If-None-Match": etag})).status_code == 304
+    assert len(reads) == 2
+
+
+async def stats_agree(client):
+    aggregates = (await client.get("/stats", params={"source": "aggregates"})).json()
+    scanned = (await client.get("/stats", params={"source": "scan"})).json()
+    return {**aggregates, "source": None} == {**scanned, "source": None}
+
+
+@pytest.mark.anyio
+async def test_concurrent_rebuilds_do_not_double_the_totals(client):
+    await client.post("/items/bulk", json=bulk_items(range(10)))
+    await app.state.redis.delete(FastAPIRedis.ITEM_INDEX_BUILT)
+    rebuilt = await asyncio.gather(*(FastAPIRedis.rebuild_indexes() for _ in range(3)))
+    assert sorted(rebuilt) == [False, False, True]
+    assert await stats_agree(client)
+    assert await app.state.redis.zcard(f"{FastAPIRedis.ITEM_INDEX_PREFIX}:all") == 10
+    assert await app.state.redis.exists(FastAPIRedis.REBUILD_LOCK) == 0
+
+
+@pytest.mark.anyio
+async def test_writes_during_a_rebuild_are_counted_once(client, monkeypatch):
+    await client.post("/items/bulk", json=bulk_items(range(4)))
+    await app.state.redis.delete(FastAPIRedis.ITEM_INDEX_BUILT)
+    rebuild_script = app.state.rebuild_script
+
+    async def write_then_step(keys, args):
+        if args[2] == "batch":
+            #an update of an item of this batch, a delete, and an item the scan may or may not find
+            await client.patch("/items/1", params={"count": 50})
+            await client.delete("/items/2")
+            await client.post("/items", json=bulk_items([7])[0])
+        return await rebuild_script(keys=keys, args=args)
+
+    monkeypatch.setattr(app.state, "rebuild_script", write_then_step)
+    assert await FastAPIRedis.rebuild_indexes()
+    assert await stats_agree(client)
+    assert list(map(int, await app.state.redis.zrange(f"{FastAPIRedis.ITEM_INDEX_PREFIX}:all", 0, -1))) == [0, 1, 3, 7]
+
+
+async def chooseitem_pages(client, **params):
+    ids, cursor = [], None
+    while True:
+        result = (await client.get("/chooseitem", params={**params, "limit": 3, **({"cursor": cursor} if cursor else {})})).json()
+        ids += [item["id"] for item in result["selection"]]
+        cursor = result["next_cursor"]
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.anyio
+async def test_chooseitem_pages_are_intersected_on_the_server(client):
+    items = bulk_items(range(12))
+    for item in items[::2]:
+        item["category"] = "consumables"
+    await client.post("/items/bulk", json=items)
+    assert await chooseitem_pages(client) == list(range(12))
+    assert await chooseitem_pages(client, category="consumables", count_min=3) == [4, 6, 8, 10]
+    assert await chooseitem_pages(client, category="tools", count_min=2, count_max=9, price=1.5) == [3, 5, 7, 9]
+    assert [key async for key in app.state.redis.scan_iter(match=f"{FastAPIRedis.ITEM_COLLECTION}:query:*")] == []
+
+
+@pytest.mark.anyio
+async def test_invalidation_listener_closes_its_pubsub(client, monkeypatch):
+    pubsubs, closed = [], []
+    pubsub = app.state.redis.pubsub
+
+    def tracked_pubsub():
+        created = pubsub()
+        aclose = created.aclose
+
+        async def tracked_aclose():
+            closed.append(created)
+            await aclose()
+
+        created.aclose = tracked_aclose
+        pubsubs.append(created)
+        if len(pubsubs) == 1:
+            async def broken(*channels):
+                raise ConnectionError("Redis went away")
+            created.subscribe = broken
+        return created
+
+    monkeypatch.setattr(app.state.redis, "pubsub", tracked_pubsub)
+    listener = asyncio.create_task(FastAPIRedis.listen_invalidations())
+    await asyncio.sleep(0.1)
+    #the failed subscription was closed before waiting to reconnect
+    assert closed == pubsubs[:1]
+    listener.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await listener
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from Profiling import Profiling
+
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    Profiling(app, slow_seconds=0.05)
+
+    @app.get("/slow")
+    async def slow():
+        await asyncio.sleep(0.2)
+        return {}
+
+    @app.get("/events")
+    async def events():
+        async def body():
+            for number in range(4):
+                await asyncio.sleep(0.05)
+                yield f"data: {number}\n\n"
+        return StreamingResponse(body(), media_type="text/event-stream")
+
+    return app
+
+
+@pytest.mark.anyio
+async def test_streams_are_not_logged_as_slow_requests(app, caplog):
+    caplog.set_level(logging.WARNING, logger="slow_requests")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        assert (await client.get("/events")).text.count("data:") == 4
+        assert not caplog.records
+        await client.get("/slow")
+    assert [record.getMessage().startswith("Slow request GET /slow") for record in caplog.records] == [True, True]
@@ -0,0 +1,22 @@
+import pytest
+from pydantic import BaseModel
+
+from Storage import MemoryRepository
+
+
+class Record(BaseModel):
+    id: int
+    kind: str
+
+
+@pytest.mark.anyio
+async def test_memory_repository_pages_in_id_order():
+    repository = MemoryRepository(Record, "records")
+    for id in (5, 1, 9, 3, 7):
+        await repository.put(Record(id=id, kind="odd" if id % 3 else "three"))
+    await repository.put(Record(id=5, kind="odd"))
+    await repository.delete(9)
+    assert [record.id for record in await repository.scan()] == [1, 3, 5, 7]
+    assert [record.id for record in await repository.scan(after=1, limit=2)] == [3, 5]
+    assert [record.id for record in await repository.find(after=3, kind="odd")] == [5, 7]
+    assert [record.id for record in await repository.find(kind="odd", limit=1)] == [1]